@@ -0,0 +1,133 @@
+import os
+import codecs
+import logging
+import aiohttp
+from dotenv import load_dotenv
+from inference import InferenceQueueFull
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Адреса реплик сервиса инференса через запятую (http://127.0.0.1:8100,http://127.0.0.1:8101).
+# Пусто — модель работает в процессе бота, как раньше.
+AI_SERVICE_URLS = [url.strip().rstrip("/") for url in os.getenv("AI_SERVICE_URLS", "").split(",") if url.strip()]
+AI_SERVICE_TIMEOUT = float(os.getenv("AI_SERVICE_TIMEOUT", "300"))
+
+
+class AIServiceUnavailable(Exception):
+    pass
+
+
+class RemoteAI:
+    """
+    Клиент сервиса инференса (ai_service.py) с тем же интерфейсом, что у AIService.
+
+    Пользователь закреплен за одной репликой (user_id по модулю числа реплик): там хранится
+    KV-кэш его диалога. Если реплика недоступна, запрос уходит следующей — диалог при этом
+    начинается заново.
+    """
+
+    def __init__(self, urls, timeout=AI_SERVICE_TIMEOUT):
+        self.urls = urls
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session = None
+
+    async def start(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=self.timeout)
+            logger.info(f"Using AI service replicas: {', '.join(self.urls)}")
+
+    async def stop(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _replicas(self, user_id):
+        first = user_id % len(self.urls)
+        return self.urls[first:] + self.urls[:first]
+
+    async def _json(self, method, path, user_id=0, **kwargs):
+        await self.start()
+        for url in self._replicas(user_id):
+            try:
+                async with self._session.request(method, f"{url}{path}", **kwargs) as response:
+                    response.raise_for_status()
+                    return await response.json()
+            except aiohttp.ClientConnectionError as e:
+                logger.warning(f"AI replica {url} is unreachable: {str(e)}")
+        raise AIServiceUnavailable("No AI service replica is reachable")
+
+    async def status(self, user_id=0):
+        try:
+            return await self._json("GET", "/status", user_id)
+        except AIServiceUnavailable:
+            return {"enabled": True, "ready": False, "error": "No AI service replica is reachable"}
+
+    async def has_dialogue(self, user_id):
+        return (await self._json("GET", f"/dialogue/{user_id}", user_id))["active"]
+
+    async def drop_dialogue(self, user_id):
+        try:
+            await self._json("DELETE", f"/dialogue/{user_id}", user_id)
+        except AIServiceUnavailable:
+            pass
+
+    async def reply(self, user_id, query, training="", nutrition="", stream=False):
+        await self.start()
+        payload = {"user_id": user_id, "query": query, "training": training, "nutrition": nutrition,
+                   "stream": stream}
+        for url in self._replicas(user_id):
+            try:
+                response = await self._session.post(f"{url}/reply", json=payload)
+            except aiohttp.ClientConnectionError as e:
+                logger.warning(f"AI replica {url} is unreachable: {str(e)}")
+                continue
+            async with response:
+                if response.status == 429:
+                    raise InferenceQueueFull("AI queue is full")
+                if response.status != 200:
+                    raise RuntimeError(await response.text())
+                # Фрагменты приходят как есть, многобайтный символ может разорваться между ними
+                decoder = codecs.getincrementaldecoder("utf-8")()
+                async for data in response.content.iter_any():
+                    text = decoder.decode(data)
+                    if text:
+                        yield text
+                tail = decoder.decode(b"", final=True)
+                if tail:
+                    yield tail
+            return
+        raise AIServiceUnavailable("No AI service replica is reachable")
+
+    async def index_material(self, material_id, text):
+        await self.start()
+        # У каждой реплики свой векторный индекс, обновляются все
+        chunks = 0
+        for url in self.urls:
+            try:
+                async with self._session.put(f"{url}/knowledge/{material_id}", json={"text": text}) as response:
+                    response.raise_for_status()
+                    chunks = (await response.json())["chunks"]
+            except aiohttp.ClientError as e:
+                logger.warning(f"Failed to index material {material_id} on {url}: {str(e)}")
+        return chunks
+
+    async def remove_material(self, material_id):
+        await self.start()
+        for url in self.urls:
+            try:
+                async with self._session.delete(f"{url}/knowledge/{material_id}") as response:
+                    response.raise_for_status()
+            except aiohttp.ClientError as e:
+                logger.warning(f"Failed to remove material {material_id} on {url}: {str(e)}")
+
+
+def create_client(urls=AI_SERVICE_URLS):
+    if urls:
+        return RemoteAI(urls)
+    # Модель, диалоги и векторный индекс в процессе бота
+    import ai_service
+    return ai_service.service
+
+
+client = create_client()
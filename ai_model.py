@@ -1,10 +1,12 @@
 import re
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM
+import os
+import functools
+import asyncio
+import threading
 import logging
-import PyPDF2
-from database import Session
-from models import KnowledgeBase
+import knowledge_cache
+import knowledge_index
+import knowledge_search
 from dotenv import load_dotenv
 
 # Настройка логирования
@@ -14,19 +16,120 @@ logger = logging.getLogger(__name__)
 # Загрузка переменных окружения
 load_dotenv()
 
-# Установка устройства
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-logger.info(f"Using device: {device}")
-
-model_name = "Soorya03/Llama-3.2-1B-Instruct-FitnessAssistant"
-tokenizer = AutoTokenizer.from_pretrained(model_name)
-model = AutoModelForCausalLM.from_pretrained(
-    model_name,
-    device_map="auto",
-    torch_dtype=torch.float16,
-    low_cpu_mem_usage=True
+# AI_ENABLED=0 полностью отключает ИИ (облегченный режим без torch и модели)
+AI_ENABLED = os.getenv("AI_ENABLED", "1").lower() not in ("0", "false", "no")
+model_name = os.getenv("AI_MODEL_NAME", "Soorya03/Llama-3.2-1B-Instruct-FitnessAssistant")
+# Бэкенд инференса: torch (fp16 на GPU, fp32 на CPU), int8 (динамическая квантизация на CPU), onnx (optimum)
+AI_BACKEND = os.getenv("AI_BACKEND", "torch").lower()
+AI_NUM_THREADS = int(os.getenv("AI_NUM_THREADS", "0"))
+# ONNX Runtime не принимает KV-кэш transformers между вызовами generate
+SUPPORTS_KV_REUSE = AI_BACKEND != "onnx"
+
+# Базовая инструкция на английском
+BASE_INSTRUCTION = "topic: Powerlifting fitness for teenagers."
+# Лимит токенов промпта и бюджеты секций контекста в порядке приоритета
+PROMPT_MAX_TOKENS = int(os.getenv("AI_PROMPT_MAX_TOKENS", "1024"))
+PROMPT_SECTION_BUDGETS = (
+    ("Training history", int(os.getenv("AI_TRAINING_TOKENS", "300"))),
+    ("Nutrition history", int(os.getenv("AI_NUTRITION_TOKENS", "200"))),
+    ("Knowledge base", int(os.getenv("AI_KNOWLEDGE_TOKENS", "400"))),
 )
-logger.info(f"Loaded model: {model_name}")
+
+# Модель загружается в фоне после старта бота, см. warm_up()
+device = None
+tokenizer = None
+model = None
+_load_lock = threading.Lock()
+_warmup_task = None
+# Причина неудачной загрузки модели: ИИ недоступен до перезапуска, а не "еще прогревается"
+load_error = None
+
+
+def is_ready():
+    return model is not None and tokenizer is not None
+
+
+def _load_torch_model(torch, quantize=False):
+    from transformers import AutoModelForCausalLM
+
+    if quantize:
+        # Динамическая int8-квантизация линейных слоев: только CPU, веса загружаются в float32
+        loaded_model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch.float32,
+                                                            low_cpu_mem_usage=True)
+        return torch.quantization.quantize_dynamic(loaded_model, {torch.nn.Linear}, dtype=torch.qint8)
+    # fp16 имеет смысл только на GPU, на CPU матричные операции в fp16 медленные
+    dtype = torch.float16 if device.type == "cuda" else torch.float32
+    return AutoModelForCausalLM.from_pretrained(
+        model_name,
+        device_map="auto",
+        torch_dtype=dtype,
+        low_cpu_mem_usage=True
+    )
+
+
+def _load_onnx_model():
+    from optimum.onnxruntime import ORTModelForCausalLM
+    return ORTModelForCausalLM.from_pretrained(model_name, export=True, use_cache=True)
+
+
+def load_model():
+    """
+    Загружает токенизатор и модель выбранного бэкенда (AI_BACKEND). Блокирующая операция,
+    вызывается в отдельном потоке.
+    """
+    global device, tokenizer, model
+    with _load_lock:
+        if is_ready():
+            return
+        import torch
+        from transformers import AutoTokenizer
+
+        if AI_NUM_THREADS:
+            torch.set_num_threads(AI_NUM_THREADS)
+        # Установка устройства: квантизованные и ONNX-бэкенды работают только на CPU
+        use_cuda = AI_BACKEND == "torch" and torch.cuda.is_available()
+        device = torch.device("cuda" if use_cuda else "cpu")
+        logger.info(f"Using device: {device}, backend: {AI_BACKEND}, threads: {torch.get_num_threads()}")
+
+        loaded_tokenizer = AutoTokenizer.from_pretrained(model_name)
+        if AI_BACKEND == "int8":
+            loaded_model = _load_torch_model(torch, quantize=True)
+        elif AI_BACKEND == "onnx":
+            loaded_model = _load_onnx_model()
+        elif AI_BACKEND == "torch":
+            loaded_model = _load_torch_model(torch)
+        else:
+            raise ValueError(f"Unknown AI_BACKEND: {AI_BACKEND}")
+        tokenizer, model = loaded_tokenizer, loaded_model
+        logger.info(f"Loaded model: {model_name}")
+
+
+def _warm_up_blocking():
+    load_model()
+    if knowledge_index.KnowledgeIndex.available():
+        knowledge_index.index.load()
+
+
+async def warm_up():
+    """
+    Запускает загрузку модели в фоне, не задерживая старт диспетчера.
+    """
+    global _warmup_task
+    if not AI_ENABLED:
+        logger.info("AI is disabled (AI_ENABLED=0), model will not be loaded")
+        return
+    if _warmup_task is None:
+        _warmup_task = asyncio.create_task(asyncio.to_thread(_warm_up_blocking))
+        _warmup_task.add_done_callback(_log_warmup_result)
+
+
+def _log_warmup_result(task):
+    global load_error
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Model warm-up failed: {task.exception()}")
+        # Сбой загрузки векторного индекса после модели не мешает генерации
+        if not is_ready():
+            load_error = str(task.exception())
 
 
 def clean_response(response):
@@ -55,106 +158,199 @@ def truncate_to_token_limit(text, token_limit):
 
 def get_knowledge_base_summary(word_limit=1000):
     """
-    Возвращает сокращенную версию базы знаний, извлекая текст из PDF и TXT файлов, игнорируя изображения.
+    Возвращает сокращенную версию базы знаний из кэша извлеченного текста, игнорируя изображения.
+    Сводка пересобирается только после добавления или удаления материалов.
     """
-    logger.info("Starting to generate knowledge base summary")
-    session = Session()
     try:
-        materials = session.query(KnowledgeBase).all()
-        summary = ""
-        for material in materials:
-            if material.type == 'text' and material.content:
-                summary += material.content + "\n"
-            elif material.type == 'file' and material.file_path:
-                if material.file_path.endswith('.pdf'):
-                    try:
-                        with open(material.file_path, 'rb') as f:
-                            reader = PyPDF2.PdfReader(f)
-                            text = ""
-                            for page in reader.pages:
-                                page_text = page.extract_text() or ""
-                                text += page_text + "\n"
-                            summary += text + "\n"
-                    except Exception as e:
-                        logger.warning(f"Failed to read PDF {material.file_path}: {str(e)}")
-                elif material.file_path.endswith('.txt'):
-                    try:
-                        with open(material.file_path, 'r', encoding='utf-8') as f:
-                            text = f.read()
-                            summary += text + "\n"
-                    except Exception as e:
-                        logger.warning(f"Failed to read TXT {material.file_path}: {str(e)}")
-            elif material.type == 'file' and material.text_content:
-                summary += material.text_content + "\n"
-        words = summary.split()
-        if len(words) > word_limit:
-            summary = " ".join(words[:word_limit]) + "..."
-        logger.info(f"Generated knowledge base summary with {len(words)} words")
-        return summary
+        return knowledge_cache.cache.get_summary(word_limit)
     except Exception as e:
         logger.error(f"Error generating knowledge base summary: {str(e)}")
         return "Knowledge base unavailable."
-    finally:
-        session.close()
 
 
-def generate_response(training_entries="", nutrition_entries="", knowledge_base="", user_query="", max_tokens=2 ** 13):
+def get_knowledge_context(user_query, top_k=4, token_budget=400):
     """
-    Генерирует ответ на основе предоставленных данных, приоритизируя историю тренировок,
-    затем питание, затем базу знаний, с учетом лимита токенов. Запросы и ответы на английском.
+    Возвращает фрагменты базы знаний, наиболее релевантные запросу, в пределах token_budget.
+    Если векторный индекс недоступен, использует полнотекстовый поиск (BM25),
+    а если и он ничего не нашел — общую сводку базы знаний.
+    """
+    count_tokens = get_token_count if is_ready() else None
+    if knowledge_index.KnowledgeIndex.available():
+        try:
+            chunks = knowledge_index.index.search(user_query, top_k=top_k, token_budget=token_budget,
+                                                  count_tokens=count_tokens)
+            logger.info(f"Retrieved {len(chunks)} knowledge base chunks")
+            return "\n".join(chunks)
+        except Exception as e:
+            logger.warning(f"Knowledge base retrieval failed, falling back to full-text search: {str(e)}")
+    try:
+        fragments = knowledge_search.lexical_context(user_query, top_k=top_k, token_budget=token_budget,
+                                                     count_tokens=count_tokens)
+        if fragments:
+            logger.info(f"Retrieved {len(fragments)} knowledge base fragments by full-text search")
+            return "\n".join(fragments)
+    except Exception as e:
+        logger.warning(f"Full-text knowledge search failed, falling back to summary: {str(e)}")
+    return get_knowledge_base_summary(word_limit=token_budget)
 
-    Args:
-        training_entries (str): История тренировок в виде строки.
-        nutrition_entries (str): История питания в виде строки.
-        knowledge_base (str): База знаний в виде строки.
-        user_query (str): Запрос пользователя на английском.
-        max_tokens (int): Максимальное количество токенов для промпта.
+
+@functools.lru_cache(maxsize=64)
+def encode_static(text):
+    """
+    Токенизирует неизменяемые части промпта (инструкцию, заголовки секций) один раз.
+    """
+    return tuple(tokenizer.encode(text, add_special_tokens=False))
+
+
+def build_prompt_ids(training_entries="", nutrition_entries="", knowledge_base="", user_query="",
+                     max_tokens=PROMPT_MAX_TOKENS):
+    """
+    Собирает промпт сразу в виде токенов с бюджетом на каждую секцию контекста.
+
+    Инструкция, запрос пользователя и подсказка "Assistant:" сохраняются всегда. Оставшийся бюджет
+    распределяется по приоритету: история тренировок, затем питание, затем база знаний;
+    каждая секция обрезается до своего лимита из PROMPT_SECTION_BUDGETS.
 
     Returns:
-        str: Сгенерированный ответ на английском языке или сообщение об ошибке.
+        list[int]: Токены промпта.
     """
-    logger.info("Starting response generation")
-    try:
-        # Базовая инструкция на английском
-        base_instruction = "topic: Powerlifting fitness for teenagers.\n"
+    bos = [tokenizer.bos_token_id] if tokenizer.bos_token_id is not None else []
+    header = list(encode_static("Context:\n" + BASE_INSTRUCTION + "\n"))
+    # Запрос может занять не больше половины бюджета, чтобы осталось место для контекста
+    query_ids = tokenizer.encode(user_query, add_special_tokens=False)[:max_tokens // 2]
+    query = list(encode_static("\nUser query: ")) + query_ids + list(encode_static("\n\nAssistant:"))
+    newline = list(encode_static("\n"))
 
-        # Формируем промпт с четким разделением контекста и запроса
-        prompt = f"""Context:
-        {base_instruction}
-        Training history: {training_entries}
-        Nutrition history: {nutrition_entries}
-        Knowledge base: {knowledge_base}
+    budget = max_tokens - len(bos) - len(header) - len(query)
+    body = []
+    sections = (training_entries, nutrition_entries, knowledge_base)
+    for (label, section_budget), text in zip(PROMPT_SECTION_BUDGETS, sections):
+        label_ids = list(encode_static(f"{label}: "))
+        allowed = min(section_budget, budget - len(label_ids) - len(newline))
+        if allowed <= 0:
+            break
+        text_ids = tokenizer.encode(text, add_special_tokens=False)[:allowed]
+        body += label_ids + text_ids + newline
+        budget -= len(label_ids) + len(text_ids) + len(newline)
 
-        User query: {user_query}
+    prompt_ids = bos + header + body + query
+    logger.info(f"Prompt built: {len(prompt_ids)} tokens (limit {max_tokens})")
+    return prompt_ids
 
-        Assistant:"""
 
-        # Токенизация промпта
-        inputs = tokenizer(prompt, return_tensors='pt', padding=True, truncation=True, max_length=max_tokens)
-        input_ids = inputs['input_ids'].to(device)
-        attention_mask = inputs['attention_mask'].to(device)
-        logger.info(f"Input tokenized: {input_ids.shape}, prompt length: {len(prompt)}")
+def generate_batch(prompts, max_new_tokens=100):
+    """
+    Генерирует ответы сразу для нескольких промптов одним вызовом model.generate.
+    Промпты дополняются паддингом слева, чтобы генерация у всех начиналась с одной позиции.
 
-        # Генерация ответа
+    Args:
+        prompts (list[list[int]]): Токены промптов из build_prompt_ids.
+        max_new_tokens (int): Максимальное количество генерируемых токенов.
+
+    Returns:
+        list[str]: Очищенные ответы в том же порядке, что и промпты.
+    """
+    import torch
+
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    input_length = max(len(prompt) for prompt in prompts)
+    input_ids = torch.tensor(
+        [[pad_token_id] * (input_length - len(prompt)) + list(prompt) for prompt in prompts], device=device)
+    attention_mask = torch.tensor(
+        [[0] * (input_length - len(prompt)) + [1] * len(prompt) for prompt in prompts], device=device)
+    logger.info(f"Batch tokenized: {input_ids.shape}")
+
+    with torch.no_grad():
         output = model.generate(
             input_ids,
             attention_mask=attention_mask,
-            max_new_tokens=100,
+            max_new_tokens=max_new_tokens,
             do_sample=True,
             temperature=0.5,
-            pad_token_id=tokenizer.eos_token_id
+            pad_token_id=pad_token_id
         )
-        logger.info(f"Generated output shape: {output.shape}")
+    logger.info(f"Generated output shape: {output.shape}")
 
-        # Извлекаем только сгенерированные токены
-        input_length = input_ids.size(1)
-        generated_ids = output[0][input_length:]
-        response = tokenizer.decode(generated_ids, skip_special_tokens=True)
-        logger.info(f"Decoded response length: {len(response)}")
+    # Извлекаем только сгенерированные токены
+    responses = []
+    for row in output:
+        response = tokenizer.decode(row[input_length:], skip_special_tokens=True)
+        responses.append(clean_response(response.strip()))
+    return responses
+
+
+def generate_with_cache(prompt_ids, past_key_values=None, on_text=None, max_new_tokens=100):
+    """
+    Генерирует ответ для одного промпта, переиспользуя past_key_values для уже обработанного префикса.
+    Блокирующая функция: вызывается в потоке воркера инференса.
+
+    Args:
+        prompt_ids (list[int]): Полная последовательность токенов (префикс из кэша + новые токены).
+        past_key_values: KV-кэш модели для начала последовательности или None.
+        on_text (callable): Если задан, вызывается с фрагментами текста по мере генерации.
+        max_new_tokens (int): Максимальное количество генерируемых токенов.
+
+    Returns:
+        tuple: (очищенный ответ, все токены последовательности, KV-кэш для следующего хода).
+    """
+    import torch
+    from transformers import TextStreamer
+
+    class CallbackStreamer(TextStreamer):
+        def on_finalized_text(self, text, stream_end=False):
+            if text:
+                on_text(text)
+
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    input_ids = torch.tensor([list(prompt_ids)], device=device)
+    streamer = CallbackStreamer(tokenizer, skip_prompt=True, skip_special_tokens=True) if on_text else None
+    with torch.no_grad():
+        output = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict_in_generate=True,
+            max_new_tokens=max_new_tokens,
+            do_sample=True,
+            temperature=0.5,
+            pad_token_id=pad_token_id,
+            streamer=streamer
+        )
+    sequence = output.sequences[0]
+    response = tokenizer.decode(sequence[len(prompt_ids):], skip_special_tokens=True)
+    return clean_response(response.strip()), sequence.tolist(), output.past_key_values
 
-        # Очищаем ответ от лишних пробелов
-        response = response.strip()
-        return clean_response(response)
+
+def generate_stream(prompt_ids, on_text, max_new_tokens=100):
+    """
+    Генерирует ответ для одного промпта, передавая текст в on_text по мере появления токенов.
+    """
+    return generate_with_cache(prompt_ids, on_text=on_text, max_new_tokens=max_new_tokens)[0]
+
+
+def generate_response(training_entries="", nutrition_entries="", knowledge_base="", user_query="",
+                      max_tokens=PROMPT_MAX_TOKENS):
+    """
+    Генерирует ответ на основе предоставленных данных, приоритизируя историю тренировок,
+    затем питание, затем базу знаний, с учетом лимита токенов. Запросы и ответы на английском.
+
+    Args:
+        training_entries (str): История тренировок в виде строки.
+        nutrition_entries (str): История питания в виде строки.
+        knowledge_base (str): База знаний в виде строки.
+        user_query (str): Запрос пользователя на английском.
+        max_tokens (int): Максимальное количество токенов для промпта.
+
+    Returns:
+        str: Сгенерированный ответ на английском языке или сообщение об ошибке.
+    """
+    logger.info("Starting response generation")
+    try:
+        prompt_ids = build_prompt_ids(training_entries, nutrition_entries, knowledge_base, user_query, max_tokens)
+        response = generate_batch([prompt_ids])[0]
+        logger.info(f"Decoded response length: {len(response)}")
+        return response
     except Exception as e:
         logger.error(f"Error during response generation: {str(e)}")
         return f"Error generating response: {str(e)}"
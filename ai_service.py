@@ -0,0 +1,239 @@
+"""
+Сервис инференса: модель, диалоги с KV-кэшем, кэш ответов и векторный индекс базы знаний
+в отдельном процессе, доступные боту по HTTP (см. ai_client.py):
+
+    python ai_service.py --port 8100 --replicas 2
+
+Реплики слушают порты port, port+1, ...; их адреса перечисляются в AI_SERVICE_URLS бота.
+"""
+import os
+import asyncio
+import logging
+import argparse
+import weakref
+import functools
+import multiprocessing
+from aiohttp import web
+from dotenv import load_dotenv
+import ai_model
+import inference
+import dialogue
+import response_cache
+import knowledge_cache
+import knowledge_index
+import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+AI_SERVICE_HOST = os.getenv("AI_SERVICE_HOST", "127.0.0.1")
+AI_SERVICE_PORT = int(os.getenv("AI_SERVICE_PORT", "8100"))
+AI_SERVICE_REPLICAS = int(os.getenv("AI_SERVICE_REPLICAS", "1"))
+
+
+class AIService:
+    """
+    Все операции с ИИ, которые нужны обработчикам. Без AI_SERVICE_URLS объект используется
+    в процессе бота напрямую, иначе — через HTTP-приложение create_app() в процессе сервиса.
+    """
+
+    def __init__(self):
+        # Блокировка на пользователя живет, пока ее кто-то держит или ждет
+        self._user_locks = weakref.WeakValueDictionary()
+
+    async def start(self):
+        await ai_model.warm_up()
+        await inference.worker.start()
+
+    async def stop(self):
+        await inference.worker.stop()
+
+    async def status(self, user_id=0):
+        return {"enabled": ai_model.AI_ENABLED, "ready": ai_model.is_ready(), "error": ai_model.load_error}
+
+    async def has_dialogue(self, user_id):
+        return dialogue.AI_DIALOGUE_ENABLED and dialogue.store.has(user_id)
+
+    async def drop_dialogue(self, user_id):
+        dialogue.store.drop(user_id)
+
+    def _user_lock(self, user_id):
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = self._user_locks[user_id] = asyncio.Lock()
+        return lock
+
+    async def reply(self, user_id, query, training="", nutrition="", stream=False):
+        """
+        Асинхронно отдает ответ на запрос: по фрагментам при stream=True, иначе одним куском.
+        Продолжение диалога использует KV-кэш пользователя; если диалог уже вытеснен или слишком
+        длинный, запрос обрабатывается как новый: контекст собирается из истории и базы знаний,
+        сначала проверяется кэш ответов. Ходы одного пользователя выполняются по очереди.
+        """
+        async with self._user_lock(user_id):
+            if await self.has_dialogue(user_id):
+                # Контекст уже в KV-кэше диалога, кодируется только новый запрос
+                prompt_ids = await asyncio.to_thread(dialogue.store.turn_ids, query)
+                generate = functools.partial(dialogue.store.generate_turn, user_id, continuation=True)
+                try:
+                    async for chunk in self._generate(prompt_ids, generate, stream):
+                        yield chunk
+                    return
+                except dialogue.DialogueExpired:
+                    # Выбрасывается до генерации, ни одного фрагмента еще не отдано
+                    logger.info(f"Dialogue of user {user_id} expired, rebuilding the full prompt")
+            async for chunk in self._first_turn(user_id, query, training, nutrition, stream):
+                yield chunk
+
+    async def _first_turn(self, user_id, query, training, nutrition, stream):
+        knowledge = await asyncio.to_thread(ai_model.get_knowledge_context, query,
+                                            token_budget=ai_model.PROMPT_SECTION_BUDGETS[2][1])
+        context_hash = response_cache.context_fingerprint(training, nutrition, knowledge)
+        if response_cache.AI_CACHE_ENABLED:
+            cached = await asyncio.to_thread(response_cache.cache.get, query, context_hash)
+            if cached is not None:
+                yield cached
+                return
+        prompt_ids = await asyncio.to_thread(ai_model.build_prompt_ids, training, nutrition, knowledge, query)
+        # Без потоковой выдачи первый ход идет в общий пакет, диалог начинается с готового ответа
+        generate = None
+        if dialogue.AI_DIALOGUE_ENABLED and stream:
+            generate = functools.partial(dialogue.store.generate_turn, user_id)
+        text = ""
+        async for chunk in self._generate(prompt_ids, generate, stream):
+            text += chunk
+            yield chunk
+        response = ai_model.clean_response(text)
+        if dialogue.AI_DIALOGUE_ENABLED and generate is None:
+            await asyncio.to_thread(dialogue.store.remember, user_id, prompt_ids, response)
+        if response_cache.AI_CACHE_ENABLED and response:
+            await asyncio.to_thread(response_cache.cache.put, query, context_hash, response)
+
+    @staticmethod
+    async def _generate(prompt_ids, generate, stream):
+        if stream:
+            async for chunk in inference.worker.stream(prompt_ids, generate):
+                yield chunk
+        elif generate is not None:
+            yield await inference.worker.run(generate, prompt_ids)
+        else:
+            yield await inference.worker.submit(prompt_ids)
+
+    async def index_material(self, material_id, text):
+        """
+        Обновляет чанки материала в векторном индексе. Возвращает число добавленных чанков.
+        """
+        knowledge_cache.cache.invalidate(material_id)
+        if not knowledge_index.KnowledgeIndex.available():
+            return 0
+        await asyncio.to_thread(knowledge_index.index.remove_material, material_id)
+        return await asyncio.to_thread(knowledge_index.index.add_material, material_id, text)
+
+    async def remove_material(self, material_id):
+        knowledge_cache.cache.invalidate(material_id)
+        if knowledge_index.KnowledgeIndex.available():
+            await asyncio.to_thread(knowledge_index.index.remove_material, material_id)
+
+
+service = AIService()
+
+
+def create_app(ai=service):
+    async def handle_status(request):
+        return web.json_response(await ai.status())
+
+    async def handle_has_dialogue(request):
+        return web.json_response({"active": await ai.has_dialogue(int(request.match_info["user_id"]))})
+
+    async def handle_drop_dialogue(request):
+        await ai.drop_dialogue(int(request.match_info["user_id"]))
+        return web.json_response({})
+
+    async def handle_reply(request):
+        payload = await request.json()
+        chunks = ai.reply(int(payload["user_id"]), payload["query"], payload.get("training", ""),
+                          payload.get("nutrition", ""), bool(payload.get("stream")))
+        # Ошибка до первого фрагмента (очередь заполнена, модель не готова) возвращается статусом
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = ""
+        except inference.InferenceQueueFull:
+            return web.Response(status=429, text="AI queue is full")
+        except Exception as e:
+            logger.error(f"Reply for user {payload['user_id']} failed: {str(e)}")
+            return web.Response(status=500, text=str(e))
+        response = web.StreamResponse(headers={"Content-Type": "text/plain; charset=utf-8"})
+        await response.prepare(request)
+        await response.write(first.encode("utf-8"))
+        async for chunk in chunks:
+            await response.write(chunk.encode("utf-8"))
+        await response.write_eof()
+        return response
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.registry.render(), content_type="text/plain", charset="utf-8")
+
+    async def handle_index_material(request):
+        payload = await request.json()
+        chunks = await ai.index_material(int(request.match_info["material_id"]), payload.get("text", ""))
+        return web.json_response({"chunks": chunks})
+
+    async def handle_remove_material(request):
+        await ai.remove_material(int(request.match_info["material_id"]))
+        return web.json_response({})
+
+    async def on_startup(app):
+        await ai.start()
+
+    async def on_cleanup(app):
+        await ai.stop()
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_get("/status", handle_status)
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/dialogue/{user_id}", handle_has_dialogue)
+    app.router.add_delete("/dialogue/{user_id}", handle_drop_dialogue)
+    app.router.add_post("/reply", handle_reply)
+    app.router.add_put("/knowledge/{material_id}", handle_index_material)
+    app.router.add_delete("/knowledge/{material_id}", handle_remove_material)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_replica(host, port):
+    web.run_app(create_app(), host=host, port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=AI_SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=AI_SERVICE_PORT)
+    parser.add_argument("--replicas", type=int, default=AI_SERVICE_REPLICAS)
+    args = parser.parse_args()
+
+    if args.replicas <= 1:
+        run_replica(args.host, args.port)
+        return
+
+    context = multiprocessing.get_context("spawn")
+    processes = []
+    index_dir = knowledge_index.KNOWLEDGE_INDEX_DIR
+    for number in range(args.replicas):
+        # Дочерний процесс получает окружение на момент запуска: у каждой реплики свой каталог
+        # индекса (реплики не пишут в одни файлы), ядра CPU делятся между репликами поровну
+        os.environ["KNOWLEDGE_INDEX_DIR"] = os.path.join(index_dir, f"replica{number}")
+        if not ai_model.AI_NUM_THREADS:
+            os.environ["AI_NUM_THREADS"] = str(max(1, (os.cpu_count() or 1) // args.replicas))
+        process = context.Process(target=run_replica, args=(args.host, args.port + number),
+                                  name=f"ai-replica-{number}")
+        process.start()
+        processes.append(process)
+        logger.info(f"AI replica {number} started on {args.host}:{args.port + number} (pid {process.pid})")
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Сравнение бэкендов инференса (torch, int8, onnx): скорость генерации в токенах/с и пиковая память (RSS).
+
+Каждый бэкенд запускается в отдельном процессе, чтобы пиковая память не смешивалась:
+
+    python benchmarks/bench_backends.py --backends torch int8 onnx --threads 4
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROMPTS = [
+    "How much protein should I eat per day?",
+    "How can I increase my bench press?",
+    "What should I eat before a heavy squat session?",
+    "How many rest days do I need per week?",
+    "Is it safe for a 15 year old to deadlift?",
+]
+
+
+def run_backend(max_new_tokens):
+    sys.path.insert(0, ROOT)
+    import ai_model
+
+    started = time.perf_counter()
+    ai_model.load_model()
+    load_seconds = time.perf_counter() - started
+
+    # Прогрев, чтобы не учитывать первую компиляцию/выделение памяти
+    ai_model.generate_with_cache(ai_model.build_prompt_ids(user_query=PROMPTS[0]), max_new_tokens=8)
+
+    generated = 0
+    started = time.perf_counter()
+    for query in PROMPTS:
+        prompt_ids = ai_model.build_prompt_ids(user_query=query)
+        _, token_ids, _ = ai_model.generate_with_cache(prompt_ids, max_new_tokens=max_new_tokens)
+        generated += len(token_ids) - len(prompt_ids)
+    generate_seconds = time.perf_counter() - started
+
+    return {
+        "backend": ai_model.AI_BACKEND,
+        "load_s": round(load_seconds, 1),
+        "tokens": generated,
+        "tokens_per_s": round(generated / generate_seconds, 2),
+        # ru_maxrss в Linux измеряется в килобайтах
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["torch", "int8", "onnx"])
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_backend(args.max_new_tokens)))
+        return
+
+    results = []
+    for backend in args.backends:
+        env = dict(os.environ, AI_BACKEND=backend, AI_NUM_THREADS=str(args.threads))
+        env.setdefault("DB_PATH", "sqlite:///:memory:")
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--max-new-tokens", str(args.max_new_tokens)],
+            env=env, capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            print(f"{backend}: failed\n{proc.stderr[-2000:]}", file=sys.stderr)
+            continue
+        results.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+
+    print(f"{'backend':<8} {'load, s':>8} {'tokens':>7} {'tok/s':>8} {'peak RSS, MB':>13}")
+    for r in results:
+        print(f"{r['backend']:<8} {r['load_s']:>8} {r['tokens']:>7} {r['tokens_per_s']:>8} {r['peak_rss_mb']:>13}")
+
+
+if __name__ == '__main__':
+    main()
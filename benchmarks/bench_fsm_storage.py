@@ -0,0 +1,83 @@
+"""
+Задержка FSM-хранилищ (memory, sqlite, redis) на типичном апдейте: get_state, get_data,
+update_data и set_state для одного пользователя. Пользователи перебираются по кругу,
+поэтому часть чтений идет из уже сброшенных в базу записей:
+
+    python benchmarks/bench_fsm_storage.py --backends memory sqlite --updates 5000 --users 500
+
+Для redis нужен доступный сервер (REDIS_URL). С --fake-redis вместо сервера используется
+fakeredis в памяти процесса — проверка, что create_storage собирает рабочий RedisStorage:
+
+    python benchmarks/bench_fsm_storage.py --backends redis --fake-redis
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def run_backend(backend, updates, users, fake_redis=False):
+    sys.path.insert(0, ROOT)
+    from aiogram.fsm.storage.base import StorageKey
+    import fsm_storage
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if backend == "sqlite":
+            storage = fsm_storage.SQLiteStorage(path=os.path.join(tmp, "fsm.db"))
+        elif backend == "redis" and fake_redis:
+            from fakeredis.aioredis import FakeRedis
+            storage = fsm_storage.create_storage(backend, redis=FakeRedis())
+        else:
+            storage = fsm_storage.create_storage(backend)
+        latencies = []
+        for number in range(updates):
+            user_id = number % users
+            key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+            started = time.perf_counter()
+            await storage.get_state(key)
+            await storage.get_data(key)
+            await storage.update_data(key, {"step": number, "kb_filters": {"category": "питание"}})
+            await storage.set_state(key, f"Bench:step{number % 3}")
+            latencies.append(time.perf_counter() - started)
+            # Пауза между апдейтами, как в боевом режиме: фоновый сброс успевает отработать
+            if number % 100 == 0:
+                await asyncio.sleep(0)
+        # Хранилище должно отдавать то, что в него записали
+        key = StorageKey(bot_id=1, chat_id=(updates - 1) % users, user_id=(updates - 1) % users)
+        state, data = await storage.get_state(key), await storage.get_data(key)
+        if state != f"Bench:step{(updates - 1) % 3}" or data.get("step") != updates - 1:
+            raise RuntimeError(f"{backend}: read back {state!r}, {data!r}")
+        started = time.perf_counter()
+        await storage.close()
+        close_seconds = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "backend": backend,
+        "mean_us": round(statistics.mean(latencies) * 1e6, 1),
+        "p50_us": round(latencies[len(latencies) // 2] * 1e6, 1),
+        "p95_us": round(latencies[int(len(latencies) * 0.95)] * 1e6, 1),
+        "p99_us": round(latencies[int(len(latencies) * 0.99)] * 1e6, 1),
+        "close_ms": round(close_seconds * 1000, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["memory", "sqlite"])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--fake-redis", action="store_true", help="redis backend on fakeredis, no server needed")
+    args = parser.parse_args()
+
+    for backend in args.backends:
+        print(asyncio.run(run_backend(backend, args.updates, args.users, args.fake_redis)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+"""
+Нагрузочный тест бота: Dispatcher из main.py обрабатывает апдейты синтетических учеников,
+а запросы к Telegram уходят на локальную замену Bot API. Каждый ученик проходит сценарии
+/start, запись питания, загрузку фото прогресса, оплату со скриншотом и вопрос ИИ
+(модель заменена заглушкой с задержкой --ai-delay):
+
+    python benchmarks/loadtest.py --users 300 --rounds 3
+
+Для каждого сценария печатаются p50/p95/p99 времени обработки его апдейтов (без пауз
+«на раздумье» между шагами), в конце — общее число апдейтов в секунду и самые медленные
+обработчики по метрикам бота. База данных и загрузки создаются во временном каталоге.
+"""
+import os
+import sys
+import time
+import random
+import logging
+import asyncio
+import argparse
+import tempfile
+import itertools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOT_TOKEN = "123456:loadtest"
+BOT_ID = 123456
+TRAINER_TELEGRAM_ID = 1
+FIRST_STUDENT_ID = 10000
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+class FakeBotAPI:
+    """
+    Локальная замена api.telegram.org: отвечает на методы Bot API правдоподобными объектами
+    с задержкой api_delay (сетевой RTT до Telegram) и считает вызовы по методам.
+    """
+
+    def __init__(self, api_delay=0.03):
+        self.api_delay = api_delay
+        self.calls = {}
+        self._runner = None
+
+    @staticmethod
+    def _message(chat_id, extra=None):
+        message = {"message_id": next(_message_ids), "date": int(time.time()),
+                   "chat": {"id": int(chat_id), "type": "private"},
+                   "from": {"id": BOT_ID, "is_bot": True, "first_name": "Loadtest"}}
+        message.update(extra or {})
+        return message
+
+    def _result(self, method, params):
+        chat_id = params.get("chat_id") or 0
+        if method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Loadtest", "username": "loadtest_bot"}
+        if method == "getFile":
+            return {"file_id": params["file_id"], "file_unique_id": params["file_id"],
+                    "file_size": 1024, "file_path": f"photos/{params['file_id']}.jpg"}
+        if method == "sendPhoto":
+            file_id = f"sent-{next(_message_ids)}"
+            return self._message(chat_id, {"photo": [{"file_id": file_id, "file_unique_id": file_id,
+                                                      "width": 90, "height": 90}]})
+        if method == "sendDocument":
+            file_id = f"sent-{next(_message_ids)}"
+            return self._message(chat_id, {"document": {"file_id": file_id, "file_unique_id": file_id}})
+        if method.startswith("send") or (method.startswith("edit") and chat_id):
+            return self._message(chat_id, {"text": params.get("text") or params.get("caption") or ""})
+        return True
+
+    async def _handle_method(self, request):
+        from aiohttp import web
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+        return web.json_response({"ok": True, "result": self._result(method, params)})
+
+    async def _handle_file(self, request):
+        from aiohttp import web
+        if self.api_delay:
+            await asyncio.sleep(self.api_delay)
+        return web.Response(body=b"\xff\xd8\xff\xe0" + b"\0" * 1020, content_type="image/jpeg")
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Запускает сервер и возвращает его базовый адрес (порт выбирается свободный).
+        """
+        from aiohttp import web
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/file/bot{token}/{path:.*}", self._handle_file)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        host, port = self._runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class StubAI:
+    """
+    Заглушка ai_client.client: модель всегда готова, ответ приходит несколькими фрагментами
+    в течение delay секунд. Интерфейс тот же, что у ai_service.AIService.
+    """
+
+    def __init__(self, delay=1.0, chunks=8):
+        self.delay = delay
+        self.chunks = chunks
+        self._dialogues = set()
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def status(self, user_id=0):
+        return {"enabled": True, "ready": True, "error": None}
+
+    async def has_dialogue(self, user_id):
+        return user_id in self._dialogues
+
+    async def drop_dialogue(self, user_id):
+        self._dialogues.discard(user_id)
+
+    async def reply(self, user_id, query, training="", nutrition="", stream=False):
+        for number in range(self.chunks):
+            await asyncio.sleep(self.delay / self.chunks)
+            yield f"Совет {number + 1}: держите технику и прогрессируйте постепенно. "
+        self._dialogues.add(user_id)
+
+    async def index_material(self, material_id, text):
+        return 0
+
+    async def remove_material(self, material_id):
+        pass
+
+
+def user_payload(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Student{user_id}", "username": f"student{user_id}"}
+
+
+def message_update(user_id, text=None, photo=False):
+    message = {"message_id": next(_message_ids), "date": int(time.time()),
+               "chat": {"id": user_id, "type": "private"}, "from": user_payload(user_id)}
+    if text is not None:
+        message["text"] = text
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    if photo:
+        file_id = f"photo-{user_id}-{message['message_id']}"
+        message["photo"] = [{"file_id": file_id, "file_unique_id": file_id, "width": 800, "height": 600}]
+    return {"update_id": next(_update_ids), "message": message}
+
+
+def callback_update(user_id, data):
+    return {"update_id": next(_update_ids), "callback_query": {
+        "id": str(next(_update_ids)), "from": user_payload(user_id), "chat_instance": str(user_id),
+        "data": data, "message": FakeBotAPI._message(user_id, {"text": "Выберите действие:"}),
+    }}
+
+
+# Сценарий — последовательность апдейтов одного ученика
+FLOWS = {
+    "start": lambda uid: [message_update(uid, "/start")],
+    "nutrition": lambda uid: [
+        message_update(uid, "Питание"),
+        message_update(uid, "Завтрак: овсянка 80 г, 3 яйца. Обед: рис 150 г, курица 200 г."),
+    ],
+    "progress_photo": lambda uid: [
+        message_update(uid, "Прогресс"),
+        callback_update(uid, "upload_photo"),
+        message_update(uid, photo=True),
+    ],
+    # Повторная оплата при необработанном запросе показывает «на рассмотрении» — тоже реальный путь
+    "payment": lambda uid: [
+        message_update(uid, "Занятия с тренером"),
+        message_update(uid, photo=True),
+        message_update(uid, "8"),
+    ],
+    "ai_question": lambda uid: [
+        message_update(uid, "Прогресс"),
+        callback_update(uid, "ai_review"),
+        message_update(uid, "Как увеличить жим лежа на 10 кг за три месяца?"),
+        callback_update(uid, "back_to_main"),
+    ],
+}
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def simulate_user(dp, bot, user_id, rounds, think, ramp, results):
+    await asyncio.sleep(random.uniform(0, ramp))
+    flows = ["start"] + [name for _ in range(rounds) for name in random.sample(list(FLOWS)[1:], len(FLOWS) - 1)]
+    for name in flows:
+        elapsed = 0.0
+        failed = False
+        for update in FLOWS[name](user_id):
+            started = time.perf_counter()
+            try:
+                await dp.feed_raw_update(bot, update)
+            except Exception:
+                failed = True
+            elapsed += time.perf_counter() - started
+            results["updates"] += 1
+            if think:
+                await asyncio.sleep(random.uniform(0, think))
+        results["flows"].setdefault(name, []).append(elapsed)
+        if failed:
+            results["errors"][name] = results["errors"].get(name, 0) + 1
+
+
+async def run(users, rounds, ai_delay, api_delay, think, ramp, storage_backend, db_url=None):
+    with tempfile.TemporaryDirectory() as tmp:
+        # Настройки читаются при импорте модулей бота, поэтому задаются до него
+        os.environ["DB_PATH"] = db_url or f"sqlite:///{os.path.join(tmp, 'loadtest.db')}"
+        os.environ.pop("ASYNC_DB_PATH", None)
+        os.environ["FSM_STORAGE_PATH"] = os.path.join(tmp, "fsm.db")
+        # Загрузки (uploads/...) сохраняются относительно текущего каталога
+        os.chdir(tmp)
+        sys.path.insert(0, ROOT)
+        from aiogram import Bot
+        from aiogram.client.session.aiohttp import AiohttpSession
+        from aiogram.client.telegram import TelegramAPIServer
+        from aiogram.fsm.storage.memory import MemoryStorage
+        import ai_client
+        import fsm_storage
+        import metrics
+        import main as bot_main
+        from database import AsyncSessionLocal, async_engine, init_db
+        from models import Trainer
+
+        # ai_model включает INFO-логирование при импорте: логи каждого апдейта и запроса к API заслонили бы отчет
+        logging.getLogger().setLevel(logging.WARNING)
+
+        init_db()
+        async with AsyncSessionLocal() as session:
+            session.add(Trainer(telegram_id=str(TRAINER_TELEGRAM_ID), username="trainer", name="Trainer"))
+            await session.commit()
+
+        api = FakeBotAPI(api_delay)
+        base_url = await api.start()
+        bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(base_url)))
+        # Обработчики обращаются к ai_client.client при каждом вызове, хуки старта берутся при создании Dispatcher
+        ai_client.client = StubAI(ai_delay)
+        storage = MemoryStorage() if storage_backend == "memory" else fsm_storage.create_storage(storage_backend)
+        # Рассылки и возобновление обработки материалов в тесте не нужны
+        dp = bot_main.create_dispatcher(storage=storage, primary_worker=False)
+        await dp.emit_startup(bot=bot, **dp.workflow_data)
+
+        results = {"updates": 0, "flows": {}, "errors": {}}
+        started = time.perf_counter()
+        try:
+            await asyncio.gather(*(simulate_user(dp, bot, FIRST_STUDENT_ID + number, rounds, think, ramp, results)
+                                   for number in range(users)))
+        finally:
+            seconds = time.perf_counter() - started
+            await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+            await bot.session.close()
+            await api.stop()
+            await async_engine.dispose()
+            os.chdir(ROOT)
+
+    for name in FLOWS:
+        latencies = sorted(results["flows"].get(name, []))
+        if not latencies:
+            continue
+        print({
+            "flow": name,
+            "runs": len(latencies),
+            "errors": results["errors"].get(name, 0),
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 1),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        })
+    print({
+        "users": users,
+        "updates": results["updates"],
+        "seconds": round(seconds, 2),
+        "updates_per_sec": round(results["updates"] / seconds, 1),
+        "api_calls": sum(api.calls.values()),
+    })
+    for line in metrics.summary(limit=5):
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=2, help="сколько раз ученик проходит каждый сценарий")
+    parser.add_argument("--ai-delay", type=float, default=1.0, help="время ответа заглушки модели, с")
+    parser.add_argument("--api-delay", type=float, default=0.03, help="задержка ответа Bot API, с")
+    parser.add_argument("--think", type=float, default=0.5, help="максимальная пауза между шагами, с")
+    parser.add_argument("--ramp", type=float, default=2.0, help="за сколько секунд подключаются все ученики")
+    parser.add_argument("--storage", default="memory", choices=["memory", "sqlite", "redis"])
+    parser.add_argument("--db-url", help="база данных вместо временной SQLite (будет изменена)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    asyncio.run(run(args.users, args.rounds, args.ai_delay, args.api_delay, args.think, args.ramp,
+                    args.storage, args.db_url))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import os
+import asyncio
+import logging
+import datetime
+from dotenv import load_dotenv
+from sqlalchemy import select, func
+from aiogram.exceptions import (TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+                                TelegramNotFound)
+from database import AsyncSessionLocal
+from models import Broadcast, BroadcastDelivery, GroupStudent, Student
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Лимиты Telegram: около 30 сообщений в секунду на бота и не чаще раза в секунду в один чат
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_CHAT_INTERVAL = float(os.getenv("BROADCAST_CHAT_INTERVAL", "1.0"))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", "50"))
+BROADCAST_MAX_ATTEMPTS = int(os.getenv("BROADCAST_MAX_ATTEMPTS", "5"))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "3"))
+# Рассылки могут ставиться в outbox другими процессами бота (webhook-воркеры), которые не могут
+# разбудить отправщик, поэтому пустой outbox все равно перепроверяется с этим интервалом
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", "5"))
+
+
+async def enqueue(session, bot, group_id, trainer_chat_id, text=None, file_id=None):
+    """
+    Сохраняет рассылку по ученикам группы в outbox, отправляет тренеру сообщение с прогрессом
+    и будит отправщик. Возвращает Broadcast или None, если в группе нет учеников.
+    """
+    chat_ids = (await session.scalars(
+        select(Student.telegram_id).join(GroupStudent, GroupStudent.student_id == Student.id)
+        .filter(GroupStudent.group_id == int(group_id)))).all()
+    if not chat_ids:
+        return None
+    broadcast = Broadcast(group_id=int(group_id), trainer_chat_id=str(trainer_chat_id), text=text,
+                          file_id=file_id, status='pending', total=len(chat_ids), sent=0, failed=0)
+    progress_message = await bot.send_message(trainer_chat_id, progress_text(broadcast))
+    broadcast.progress_message_id = progress_message.message_id
+    session.add(broadcast)
+    await session.flush()
+    session.add_all([BroadcastDelivery(broadcast_id=broadcast.id, chat_id=chat_id) for chat_id in chat_ids])
+    await session.commit()
+    sender.wake()
+    return broadcast
+
+
+def progress_text(broadcast):
+    text = f"Рассылка: доставлено {broadcast.sent} из {broadcast.total}"
+    if broadcast.failed:
+        text += f", не доставлено {broadcast.failed}"
+    if broadcast.status == 'done':
+        text += ". Завершено."
+    return text
+
+
+class BroadcastSender:
+    """
+    Отправляет сообщения из outbox с общим ограничением скорости и интервалом между сообщениями
+    в один чат. При TelegramRetryAfter (429) приостанавливает всю отправку на указанное время,
+    сетевые ошибки повторяет с экспоненциальной задержкой. Неотправленные записи остаются
+    в БД, поэтому после перезапуска рассылка продолжается с того же места.
+    """
+
+    def __init__(self, rate=BROADCAST_RATE, chat_interval=BROADCAST_CHAT_INTERVAL,
+                 batch_size=BROADCAST_BATCH_SIZE, max_attempts=BROADCAST_MAX_ATTEMPTS,
+                 progress_interval=BROADCAST_PROGRESS_INTERVAL, poll_interval=BROADCAST_POLL_INTERVAL):
+        self.interval = 1 / rate
+        self.chat_interval = chat_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.poll_interval = poll_interval
+        self._bot = None
+        self._task = None
+        self._wakeup = None
+        self._next_send = 0.0
+        self._chat_next_send = {}
+        self._reported_at = {}
+
+    async def start(self, bot, primary_worker=True):
+        # Outbox разбирает один процесс, иначе сообщения отправлялись бы дважды
+        if self._task is None and primary_worker:
+            self._bot = bot
+            self._wakeup = asyncio.Event()
+            self._wakeup.set()  # продолжить рассылки, оставшиеся с прошлого запуска
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Broadcast sender started: {1 / self.interval:.0f} msg/s")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            try:
+                delay = await self._send_due()
+            except Exception as e:
+                logger.error(f"Broadcast sending failed: {str(e)}")
+                delay = 5.0
+            if delay is None:
+                delay = self.poll_interval
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+                self._wakeup.clear()
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send_due(self):
+        """
+        Отправляет одну порцию готовых к отправке сообщений. Возвращает, через сколько секунд
+        появятся следующие, или None, если outbox пуст.
+        """
+        loop = asyncio.get_running_loop()
+        now = datetime.datetime.now()
+        self._chat_next_send = {chat_id: ready for chat_id, ready in self._chat_next_send.items()
+                                if ready > loop.time()}
+        async with AsyncSessionLocal() as session:
+            deliveries = (await session.scalars(
+                select(BroadcastDelivery)
+                .filter(BroadcastDelivery.status == 'pending', BroadcastDelivery.next_attempt_at <= now)
+                .order_by(BroadcastDelivery.id)
+                .limit(self.batch_size))).all()
+            if not deliveries:
+                next_at = await session.scalar(select(func.min(BroadcastDelivery.next_attempt_at))
+                                               .filter(BroadcastDelivery.status == 'pending'))
+                return None if next_at is None else max(0.1, (next_at - now).total_seconds())
+            broadcasts = {b.id: b for b in (await session.scalars(select(Broadcast).filter(
+                Broadcast.id.in_({d.broadcast_id for d in deliveries})))).all()}
+            tasks = []
+            for delivery in deliveries:
+                # Не больше одного сообщения в чат за порцию; остальные уйдут в следующей
+                if self._chat_next_send.get(delivery.chat_id, 0.0) > loop.time():
+                    continue
+                self._chat_next_send[delivery.chat_id] = loop.time() + self.chat_interval
+                await self._throttle()
+                tasks.append(asyncio.create_task(self._deliver(delivery, broadcasts[delivery.broadcast_id])))
+            if tasks:
+                await asyncio.gather(*tasks)
+            await session.commit()
+            await self._report(session, broadcasts.values())
+        if not tasks:
+            return min(self._chat_next_send.values()) - loop.time()
+        return 0
+
+    async def _throttle(self):
+        loop = asyncio.get_running_loop()
+        delay = self._next_send - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._next_send = max(self._next_send, loop.time()) + self.interval
+
+    async def _deliver(self, delivery, broadcast):
+        delivery.attempts = (delivery.attempts or 0) + 1
+        try:
+            if broadcast.file_id:
+                await self._bot.send_document(delivery.chat_id, broadcast.file_id, caption=broadcast.text)
+            else:
+                await self._bot.send_message(delivery.chat_id, broadcast.text)
+        except TelegramRetryAfter as e:
+            logger.warning(f"Telegram flood limit hit, pausing broadcasts for {e.retry_after}s")
+            delivery.attempts -= 1
+            loop = asyncio.get_running_loop()
+            self._next_send = max(self._next_send, loop.time() + e.retry_after)
+            delivery.next_attempt_at = datetime.datetime.now() + datetime.timedelta(seconds=e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound) as e:
+            # Бот заблокирован или чат не существует — повтор не поможет
+            delivery.status = 'failed'
+            delivery.error = str(e)
+        except Exception as e:
+            delivery.error = str(e)
+            if delivery.attempts >= self.max_attempts:
+                delivery.status = 'failed'
+            else:
+                delivery.next_attempt_at = datetime.datetime.now() + datetime.timedelta(seconds=2 ** delivery.attempts)
+        else:
+            delivery.status = 'sent'
+            delivery.sent_at = datetime.datetime.now()
+
+    async def _report(self, session, broadcasts):
+        """
+        Обновляет счетчики рассылок и сообщение с прогрессом у тренера (не чаще progress_interval).
+        """
+        loop = asyncio.get_running_loop()
+        ids = [broadcast.id for broadcast in broadcasts]
+        counts = (await session.execute(
+            select(BroadcastDelivery.broadcast_id, BroadcastDelivery.status, func.count())
+            .filter(BroadcastDelivery.broadcast_id.in_(ids))
+            .group_by(BroadcastDelivery.broadcast_id, BroadcastDelivery.status))).all()
+        by_status = {}
+        for broadcast_id, status, count in counts:
+            by_status.setdefault(broadcast_id, {})[status] = count
+        for broadcast in broadcasts:
+            statuses = by_status.get(broadcast.id, {})
+            broadcast.sent = statuses.get('sent', 0)
+            broadcast.failed = statuses.get('failed', 0)
+            finished = not statuses.get('pending')
+            if finished:
+                broadcast.status = 'done'
+                broadcast.finished_at = datetime.datetime.now()
+                self._reported_at.pop(broadcast.id, None)
+            elif loop.time() - self._reported_at.get(broadcast.id, 0.0) < self.progress_interval:
+                continue
+            else:
+                self._reported_at[broadcast.id] = loop.time()
+            await self._show_progress(broadcast)
+        await session.commit()
+
+    async def _show_progress(self, broadcast):
+        try:
+            if broadcast.progress_message_id:
+                await self._bot.edit_message_text(progress_text(broadcast), chat_id=broadcast.trainer_chat_id,
+                                                  message_id=broadcast.progress_message_id)
+            else:
+                message = await self._bot.send_message(broadcast.trainer_chat_id, progress_text(broadcast))
+                broadcast.progress_message_id = message.message_id
+        except TelegramBadRequest:
+            pass  # текст не изменился
+        except Exception as e:
+            logger.warning(f"Failed to report broadcast {broadcast.id} progress: {str(e)}")
+
+
+sender = BroadcastSender()
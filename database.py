@@ -1,15 +1,71 @@
 import os
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from dotenv import load_dotenv
 
 load_dotenv()
 DB_PATH = os.getenv("DB_PATH")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Сколько секунд ждать снятия блокировки SQLite / выполнения запроса в PostgreSQL
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "15"))
 
+
+def to_async_url(url):
+    """
+    Подбирает асинхронный драйвер для URL базы данных: aiosqlite для SQLite, asyncpg для PostgreSQL.
+    """
+    if url.startswith("sqlite://"):
+        return url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    if url.startswith("postgresql://"):
+        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    return url
+
+
+def async_engine_options(url):
+    if url.startswith("sqlite"):
+        options = {"connect_args": {"timeout": DB_QUERY_TIMEOUT}}
+        if ":memory:" in url:
+            return options
+    elif "asyncpg" in url:
+        options = {"connect_args": {"command_timeout": DB_QUERY_TIMEOUT}}
+    else:
+        options = {}
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+
+ASYNC_DB_PATH = os.getenv("ASYNC_DB_PATH") or to_async_url(DB_PATH)
+
+# Синхронный движок — для init_db и фоновых потоков (кэши, индекс базы знаний)
 engine = create_engine(DB_PATH, echo=False)
 Session = sessionmaker(bind=engine)
+# Асинхронный движок — для обработчиков; сессия передается через DbSessionMiddleware
+async_engine = create_async_engine(ASYNC_DB_PATH, echo=False, **async_engine_options(ASYNC_DB_PATH))
+AsyncSessionLocal = async_sessionmaker(async_engine, expire_on_commit=False)
 Base = declarative_base()
 
+def add_missing_columns(connection, table_names=None):
+    """
+    Добавляет в существующие таблицы колонки, объявленные в моделях, но отсутствующие в БД
+    (create_all создает только отсутствующие таблицы). Новые колонки должны допускать NULL.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        if table_names is not None and table.name not in table_names:
+            continue
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+
 def init_db():
-    Base.metadata.create_all(engine, checkfirst=True)
\ No newline at end of file
+    import migrations
+    migrations.migrate()
@@ -0,0 +1,145 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from dotenv import load_dotenv
+import ai_model
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+AI_DIALOGUE_ENABLED = os.getenv("AI_DIALOGUE", "1").lower() not in ("0", "false", "no")
+AI_DIALOGUE_MAX_SESSIONS = int(os.getenv("AI_DIALOGUE_MAX_SESSIONS", "100"))
+AI_DIALOGUE_MAX_MB = int(os.getenv("AI_DIALOGUE_MAX_MB", "512"))
+AI_DIALOGUE_IDLE_SECONDS = int(os.getenv("AI_DIALOGUE_IDLE_SECONDS", "900"))
+AI_DIALOGUE_MAX_TOKENS = int(os.getenv("AI_DIALOGUE_MAX_TOKENS", "2048"))
+
+
+def cache_nbytes(past_key_values):
+    """
+    Оценивает объем памяти KV-кэша модели.
+    """
+    total = 0
+    try:
+        for layer in past_key_values:
+            for tensor in layer:
+                total += tensor.element_size() * tensor.nelement()
+    except TypeError:
+        return 0
+    return total
+
+
+class DialogueExpired(Exception):
+    """
+    Продолжать нечего: диалог вытеснен или превысил AI_DIALOGUE_MAX_TOKENS. Вызывающий собирает
+    полный промпт (инструкция и контекст) и начинает диалог заново.
+    """
+
+
+class DialogueSession:
+    def __init__(self, token_ids, past_key_values):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.nbytes = cache_nbytes(past_key_values)
+        self.last_used = time.monotonic()
+
+
+class DialogueStore:
+    """
+    Диалоги с ИИ по пользователям: токены всей беседы и KV-кэш модели для них.
+
+    Следующий ход диалога добавляет к беседе только новый запрос, поэтому модель обрабатывает
+    лишь новые токены. Неактивные диалоги вытесняются по времени простоя, по количеству
+    и по суммарному объему KV-кэша.
+    """
+
+    def __init__(self, max_sessions=AI_DIALOGUE_MAX_SESSIONS, max_bytes=AI_DIALOGUE_MAX_MB * 1024 * 1024,
+                 idle_seconds=AI_DIALOGUE_IDLE_SECONDS, max_tokens=AI_DIALOGUE_MAX_TOKENS):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_seconds = idle_seconds
+        self.max_tokens = max_tokens
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def has(self, user_id):
+        with self._lock:
+            self._evict_idle()
+            return user_id in self._sessions
+
+    def drop(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(session.nbytes for session in self._sessions.values())
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @staticmethod
+    def turn_ids(user_query):
+        """
+        Токены очередного хода диалога: только новый запрос и подсказка ответа.
+        """
+        return (list(ai_model.encode_static("\nUser query: "))
+                + ai_model.tokenizer.encode(user_query, add_special_tokens=False)
+                + list(ai_model.encode_static("\n\nAssistant:")))
+
+    def generate_turn(self, user_id, prompt_ids, on_text=None, continuation=False):
+        """
+        Генерирует ответ в рамках диалога пользователя. Блокирующий вызов, выполняется в потоке воркера.
+
+        prompt_ids — полный промпт для первого хода или turn_ids() для продолжения (continuation=True).
+        Если продолжать нечего, до генерации выбрасывается DialogueExpired: одни токены хода
+        без инструкции и контекста модели не передаются.
+        """
+        with self._lock:
+            session = self._sessions.pop(user_id, None)
+        if continuation:
+            if session is None:
+                raise DialogueExpired(f"Dialogue of user {user_id} is no longer cached")
+            if len(session.token_ids) + len(prompt_ids) > self.max_tokens:
+                logger.info(f"Dialogue of user {user_id} exceeded {self.max_tokens} tokens, starting over")
+                raise DialogueExpired(f"Dialogue of user {user_id} exceeded {self.max_tokens} tokens")
+            input_ids = session.token_ids + list(prompt_ids)
+            past_key_values = session.past_key_values if ai_model.SUPPORTS_KV_REUSE else None
+        else:
+            input_ids = list(prompt_ids)
+            past_key_values = None
+        response, token_ids, past_key_values = ai_model.generate_with_cache(input_ids, past_key_values, on_text)
+        logger.info(f"Dialogue turn for user {user_id}: {len(input_ids)} tokens in context")
+        with self._lock:
+            self._sessions[user_id] = DialogueSession(
+                token_ids, past_key_values if ai_model.SUPPORTS_KV_REUSE else None)
+            self._evict()
+        return response
+
+    def remember(self, user_id, prompt_ids, response):
+        """
+        Начинает диалог с ответа, сгенерированного без KV-кэша (пакетом в InferenceWorker.submit).
+        Кэш не сохраняется: следующий ход один раз перекодирует беседу и дальше продолжает с кэшем.
+        """
+        token_ids = list(prompt_ids) + ai_model.tokenizer.encode(response, add_special_tokens=False)
+        with self._lock:
+            self._sessions.pop(user_id, None)
+            self._sessions[user_id] = DialogueSession(token_ids, None)
+            self._evict()
+
+    def _evict_idle(self):
+        deadline = time.monotonic() - self.idle_seconds
+        for user_id in [uid for uid, session in self._sessions.items() if session.last_used < deadline]:
+            del self._sessions[user_id]
+
+    def _evict(self):
+        self._evict_idle()
+        total = sum(session.nbytes for session in self._sessions.values())
+        while self._sessions and (len(self._sessions) > self.max_sessions or total > self.max_bytes):
+            user_id, session = self._sessions.popitem(last=False)
+            total -= session.nbytes
+            logger.info(f"Evicted dialogue of user {user_id} ({session.nbytes / 2 ** 20:.1f} MB)")
+
+
+store = DialogueStore()
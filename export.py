@@ -0,0 +1,153 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import zipfile
+from collections import namedtuple
+from dotenv import load_dotenv
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+EXPORT_DIR = os.getenv("EXPORT_DIR", os.path.join("uploads", "exports"))
+# Telegram принимает от бота документы до 50 МБ, поэтому большие истории делятся на части
+EXPORT_MAX_ARCHIVE_MB = int(os.getenv("EXPORT_MAX_ARCHIVE_MB", "45"))
+EXPORT_CACHE_MAX_FILES = int(os.getenv("EXPORT_CACHE_MAX_FILES", "200"))
+
+ExportEntry = namedtuple("ExportEntry", ["id", "date", "content", "file_path"])
+
+
+def entry_size(entry):
+    if entry.content:
+        return len(entry.content.encode("utf-8"))
+    if entry.file_path and os.path.exists(entry.file_path):
+        return os.path.getsize(entry.file_path)
+    return 0
+
+
+class HistoryExporter:
+    """
+    Собирает ZIP-архивы истории прогресса в потоке. Архив строится пофайлово (zipfile читает
+    файлы блоками), поэтому память не зависит от размера истории. Готовые архивы хранятся
+    в EXPORT_DIR под именем из хэша содержимого: повторный запрос неизменной истории
+    отдает готовый файл, а после первой отправки — file_id Telegram без повторной загрузки.
+    """
+
+    def __init__(self, export_dir=EXPORT_DIR, max_archive_bytes=EXPORT_MAX_ARCHIVE_MB * 1024 * 1024,
+                 max_files=EXPORT_CACHE_MAX_FILES):
+        self.export_dir = export_dir
+        self.max_archive_bytes = max_archive_bytes
+        self.max_files = max_files
+        self._file_ids = {}
+
+    @staticmethod
+    def fingerprint(kind, entries):
+        """
+        Хэш содержимого архива: записи, их текст и размер/время изменения файлов.
+        """
+        digest = hashlib.sha256(kind.encode("utf-8"))
+        for entry in entries:
+            digest.update(f"{entry.id}\0{entry.date}\0".encode("utf-8"))
+            if entry.content:
+                digest.update(entry.content.encode("utf-8"))
+            elif entry.file_path and os.path.exists(entry.file_path):
+                stat = os.stat(entry.file_path)
+                digest.update(f"{entry.file_path}\0{stat.st_mtime_ns}\0{stat.st_size}".encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def split_parts(self, entries):
+        """
+        Делит записи на части, каждая из которых помещается в один архив.
+        """
+        parts, current, current_size = [], [], 0
+        for entry in entries:
+            size = entry_size(entry)
+            if current and current_size + size > self.max_archive_bytes:
+                parts.append(current)
+                current, current_size = [], 0
+            current.append(entry)
+            current_size += size
+        if current:
+            parts.append(current)
+        return parts
+
+    @staticmethod
+    def build(kind, entries, path):
+        """
+        Пишет архив во временный файл рядом с path и атомарно переименовывает его.
+        """
+        fd, tmp_path = tempfile.mkstemp(suffix=".zip.tmp", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            with zipfile.ZipFile(tmp_path, 'w', compression=zipfile.ZIP_DEFLATED) as zipf:
+                index_content = ""
+                for entry in entries:
+                    if entry.content:
+                        fname = f"{kind}_{entry.id}.txt"
+                        zipf.writestr(fname, entry.content)
+                    elif entry.file_path and os.path.exists(entry.file_path):
+                        fname = f"{kind}_{entry.id}_{os.path.basename(entry.file_path)}"
+                        # Фото и PDF уже сжаты, повторное сжатие только тратит CPU
+                        zipf.write(entry.file_path, fname, compress_type=zipfile.ZIP_STORED)
+                    else:
+                        continue
+                    index_content += (
+                        f"Entry ID: {entry.id}\n"
+                        f"Date: {entry.date}\n"
+                        f"File: {fname}\n\n"
+                    )
+                zipf.writestr("index.txt", index_content)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _archive(self, student_id, kind, entries):
+        os.makedirs(self.export_dir, exist_ok=True)
+        path = os.path.join(self.export_dir, f"{student_id}_{kind}_{self.fingerprint(kind, entries)}.zip")
+        if os.path.exists(path):
+            os.utime(path)
+            logger.info(f"Export cache hit: {path}")
+        else:
+            started = time.perf_counter()
+            self.build(kind, entries, path)
+            logger.info(f"Built export {path} ({len(entries)} entries) in {time.perf_counter() - started:.2f}s")
+        return path
+
+    def _archives(self, student_id, kind, entries):
+        paths = [self._archive(student_id, kind, part) for part in self.split_parts(entries)]
+        self._evict()
+        return paths
+
+    async def get_archives(self, student_id, kind, entries):
+        """
+        Возвращает пути к архивам (по одному на часть) для записей истории. Сборка идет в потоке.
+        """
+        return await asyncio.to_thread(self._archives, student_id, kind, list(entries))
+
+    def file_id(self, path):
+        return self._file_ids.get(os.path.basename(path))
+
+    def remember_file_id(self, path, file_id):
+        self._file_ids[os.path.basename(path)] = file_id
+
+    def _evict(self):
+        try:
+            names = [name for name in os.listdir(self.export_dir) if name.endswith(".zip")]
+        except FileNotFoundError:
+            return
+        if len(names) <= self.max_files:
+            return
+        paths = sorted((os.path.join(self.export_dir, name) for name in names), key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_files]:
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._file_ids.pop(os.path.basename(path), None)
+
+
+exporter = HistoryExporter()
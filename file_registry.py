@@ -0,0 +1,87 @@
+import os
+import logging
+import datetime
+from aiogram.types import FSInputFile
+from aiogram.exceptions import TelegramBadRequest
+from models import TelegramFile
+
+logger = logging.getLogger(__name__)
+
+
+def sent_file_id(message):
+    if message.document:
+        return message.document.file_id
+    if message.photo:
+        return message.photo[-1].file_id
+    return None
+
+
+def local_size(file_path):
+    try:
+        return os.path.getsize(file_path)
+    except OSError:
+        return None
+
+
+class FileRegistry:
+    """
+    file_id Telegram для локальных файлов (материалы базы знаний, программы групп).
+    Файл загружается в Telegram один раз, дальше отправляется по file_id; если Telegram
+    отклоняет file_id, файл загружается заново и запись обновляется.
+    """
+
+    def __init__(self):
+        self._file_ids = {}
+
+    async def get(self, session, file_path):
+        size = local_size(file_path)
+        cached = self._file_ids.get(file_path)
+        if cached is None:
+            entry = await session.get(TelegramFile, file_path)
+            if entry is None:
+                return None
+            cached = self._file_ids[file_path] = (entry.file_id, entry.file_size)
+        file_id, file_size = cached
+        # Файл перезаписан (например, новая программа группы под тем же именем)
+        if size is not None and file_size is not None and size != file_size:
+            return None
+        return file_id
+
+    async def remember(self, session, file_path, file_id):
+        size = local_size(file_path)
+        entry = await session.get(TelegramFile, file_path)
+        if entry is None:
+            entry = TelegramFile(file_path=file_path)
+            session.add(entry)
+        entry.file_id = file_id
+        entry.file_size = size
+        entry.updated_at = datetime.datetime.now()
+        await session.commit()
+        self._file_ids[file_path] = (file_id, size)
+
+    async def forget(self, session, file_path):
+        self._file_ids.pop(file_path, None)
+        entry = await session.get(TelegramFile, file_path)
+        if entry is not None:
+            await session.delete(entry)
+            await session.commit()
+
+    async def send(self, session, send, file_path, **kwargs):
+        """
+        Отправляет файл через send (например, message.answer_document) по file_id,
+        а при его отсутствии или отказе Telegram — загружает файл с диска.
+        """
+        file_id = await self.get(session, file_path)
+        if file_id is not None:
+            try:
+                return await send(file_id, **kwargs)
+            except TelegramBadRequest as e:
+                logger.warning(f"Stale file_id for {file_path}, uploading again: {str(e)}")
+        message = await send(FSInputFile(file_path), **kwargs)
+        file_id = sent_file_id(message)
+        if file_id is not None:
+            await self.remember(session, file_path, file_id)
+        return message
+
+
+registry = FileRegistry()
@@ -1,7 +1,7 @@
 from aiogram.filters import BaseFilter
-from handlers.admin import is_admin
 from aiogram import types
+from identity import Identity
 
 class IsAdmin(BaseFilter):
-    async def __call__(self, message: types.Message) -> bool:
-        return is_admin(message.from_user.id)
\ No newline at end of file
+    async def __call__(self, message: types.Message, identity: Identity = None) -> bool:
+        return identity is not None and identity.is_trainer
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import sqlite3
+import threading
+from dotenv import load_dotenv
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.fsm.storage.memory import MemoryStorage
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# memory | sqlite | redis
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()
+FSM_STORAGE_PATH = os.getenv("FSM_STORAGE_PATH", "fsm.db")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Состояния, не менявшиеся дольше этого срока, считаются брошенными и удаляются
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+FSM_FLUSH_INTERVAL_MS = int(os.getenv("FSM_FLUSH_INTERVAL_MS", "50"))
+FSM_CLEANUP_INTERVAL = int(os.getenv("FSM_CLEANUP_INTERVAL", "3600"))
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS fsm_states (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT NOT NULL DEFAULT '{}',
+        updated_at REAL NOT NULL
+    )
+"""
+UPDATED_AT_INDEX = "CREATE INDEX IF NOT EXISTS ix_fsm_states_updated_at ON fsm_states (updated_at)"
+UPSERT_STATE = """
+    INSERT INTO fsm_states (key, state, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(key) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at
+"""
+UPSERT_DATA = """
+    INSERT INTO fsm_states (key, data, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(key) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+"""
+# Пустые записи (состояние сброшено, данных нет) не хранятся
+DELETE_EMPTY = "DELETE FROM fsm_states WHERE key = ? AND state IS NULL AND data = '{}'"
+DELETE_EXPIRED = "DELETE FROM fsm_states WHERE updated_at < ?"
+
+
+def storage_key(key):
+    """
+    Строковый ключ записи из StorageKey aiogram (бот, чат, пользователь, тема, destiny).
+    """
+    parts = [key.bot_id, key.chat_id, key.user_id, key.thread_id,
+             getattr(key, "business_connection_id", None), key.destiny]
+    return ":".join("" if part is None else str(part) for part in parts)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в SQLite (режим WAL). Записи копятся в памяти и сбрасываются в базу одной
+    транзакцией раз в FSM_FLUSH_INTERVAL_MS, поэтому серия update_data в одном апдейте дает одну
+    запись на диск. Чтение сначала смотрит несброшенные записи, затем пакет, который пишется
+    в базу прямо сейчас, и только потом базу. Все обращения к sqlite3 выполняются в потоке,
+    цикл событий не блокируется.
+    """
+
+    def __init__(self, path=FSM_STORAGE_PATH, state_ttl=FSM_STATE_TTL,
+                 flush_interval=FSM_FLUSH_INTERVAL_MS / 1000, cleanup_interval=FSM_CLEANUP_INTERVAL):
+        self.path = path
+        self.state_ttl = state_ttl
+        self.flush_interval = flush_interval
+        self.cleanup_interval = cleanup_interval
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # В WAL synchronous=NORMAL не теряет целостность, только последние транзакции при сбое питания
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("PRAGMA busy_timeout=5000")
+        self._connection.execute(SCHEMA)
+        self._connection.execute(UPDATED_AT_INDEX)
+        # key -> {"state": ..., "data": ...}: изменения, еще не записанные в базу
+        self._pending = {}
+        # Пакет, который сейчас записывается: до коммита чтение берет значения из него
+        self._flushing = {}
+        self._flush_lock = asyncio.Lock()
+        self._flusher = None
+        self._last_cleanup = 0.0
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchone()
+
+    def _schedule_flush(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.get_running_loop().create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(self._write, self._flushing)
+            except Exception as e:
+                logger.error(f"FSM storage flush failed: {str(e)}")
+                # Вернуть несохраненные изменения, не затирая более новые
+                for key, changes in self._flushing.items():
+                    self._pending[key] = {**changes, **self._pending.get(key, {})}
+                self._schedule_flush()
+            finally:
+                self._flushing = {}
+
+    def _write(self, pending):
+        now = time.time()
+        with self._lock:
+            with self._connection:
+                self._connection.execute("BEGIN IMMEDIATE")
+                for key, changes in pending.items():
+                    if "state" in changes:
+                        self._connection.execute(UPSERT_STATE, (key, changes["state"], now))
+                    if "data" in changes:
+                        self._connection.execute(UPSERT_DATA, (key, changes["data"], now))
+                    self._connection.execute(DELETE_EMPTY, (key,))
+                if now - self._last_cleanup >= self.cleanup_interval:
+                    expired = self._connection.execute(DELETE_EXPIRED, (now - self.state_ttl,)).rowcount
+                    self._last_cleanup = now
+                    if expired:
+                        logger.info(f"Removed {expired} abandoned FSM states")
+
+    def _set(self, key, field, value):
+        self._pending.setdefault(storage_key(key), {})[field] = value
+        self._schedule_flush()
+
+    async def _get(self, key, field):
+        for batch in (self._pending, self._flushing):
+            changes = batch.get(storage_key(key), {})
+            if field in changes:
+                return changes[field]
+        row = await asyncio.to_thread(self._execute, f"SELECT {field} FROM fsm_states WHERE key = ?",
+                                      (storage_key(key),))
+        return row[0] if row else None
+
+    async def set_state(self, key, state=None):
+        self._set(key, "state", state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key):
+        return await self._get(key, "state")
+
+    async def set_data(self, key, data):
+        # Сериализуется сразу: изменения словаря обработчиком после записи не попадают в хранилище
+        self._set(key, "data", json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key):
+        data = await self._get(key, "data")
+        return json.loads(data) if data else {}
+
+    async def close(self):
+        if self._flusher is not None and not self._flusher.done():
+            self._flusher.cancel()
+        await self.flush()
+        with self._lock:
+            self._connection.close()
+
+
+def create_storage(backend=FSM_STORAGE, redis=None):
+    """
+    FSM-хранилище для Dispatcher по FSM_STORAGE. Для redis можно передать готовый клиент
+    (например, локальную замену Redis в проверках); иначе подключение идет по REDIS_URL.
+    """
+    if backend == "memory":
+        return MemoryStorage()
+    if backend == "sqlite":
+        return SQLiteStorage()
+    if backend == "redis":
+        from aiogram.fsm.storage.redis import RedisStorage
+        # TTL задается самому Redis: брошенные состояния удаляются без отдельной очистки
+        if redis is None:
+            return RedisStorage.from_url(REDIS_URL, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+        return RedisStorage(redis=redis, state_ttl=FSM_STATE_TTL, data_ttl=FSM_STATE_TTL)
+    raise ValueError(f"Unknown FSM_STORAGE: {backend}")
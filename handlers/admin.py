@@ -1,12 +1,25 @@
 import os
-import PyPDF2
 from aiogram import Router, types, F
+from aiogram.filters import Command
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from database import Session
-from models import Student, Trainer, Group, Schedule, GroupCreation, GroupStudent, KnowledgeBase
+from sqlalchemy import select, func
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Student, Group, Schedule, GroupCreation, GroupStudent, KnowledgeBase
 import time
+import asyncio
+import knowledge_cache
+import ai_client
+import broadcast
+import file_registry
+import ingestion
+import metrics
+import loop_monitor
+from identity import Identity
+from telegram_text import chunk_lines, truncate_lines
+from handlers.knowledge import render_page, material_category, MODE_DELETE
 
 router = Router()
 
@@ -23,31 +36,39 @@ class AddKnowledge(StatesGroup):
     waiting_for_material = State()
 
 
-def extract_text_from_file(file_path):
-    try:
-        if file_path.endswith('.txt'):
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return f.read()
-        elif file_path.endswith('.pdf'):
-            with open(file_path, 'rb') as f:
-                reader = PyPDF2.PdfReader(f)
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() or ""
-                return text
-        return ""
-    except Exception:
-        return ""
-
-
-# Check if user is admin (trainer)
-def is_admin(telegram_id):
-    session = Session()
-    try:
-        trainer = session.query(Trainer).filter_by(telegram_id=str(telegram_id)).first()
-        return trainer is not None
-    finally:
-        session.close()
+class GroupBroadcast(StatesGroup):
+    waiting_for_text = State()
+
+
+async def get_group(session: AsyncSession, group_id, with_students=False):
+    query = select(Group).filter_by(id=int(group_id))
+    if with_students:
+        query = query.options(selectinload(Group.students))
+    return await session.scalar(query)
+
+
+async def get_student_profiles(session: AsyncSession):
+    # Two queries regardless of the number of students: the students and, via selectinload, all their groups
+    return (await session.scalars(
+        select(Student).options(selectinload(Student.groups)).order_by(Student.id))).all()
+
+
+async def get_trainer_groups(session: AsyncSession, trainer_id):
+    # Groups with member counts in one aggregated query instead of loading group.students per group
+    members = (select(GroupStudent.group_id, func.count().label("members"))
+               .group_by(GroupStudent.group_id).subquery())
+    rows = await session.execute(
+        select(Group, func.coalesce(members.c.members, 0))
+        .outerjoin(members, members.c.group_id == Group.id)
+        .filter(Group.trainer_id == trainer_id).order_by(Group.id))
+    return rows.all()
+
+
+def groups_keyboard(groups):
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{g.name} ({members})", callback_data=f"edit_group_{g.id}")]
+        for g, members in groups
+    ])
 
 
 # Admin menu for trainers
@@ -77,8 +98,8 @@ async def handle_knowledge_base_admin(message: types.Message):
 
 
 @router.callback_query(F.data == "add_knowledge")
-async def handle_add_knowledge(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+async def handle_add_knowledge(callback: types.CallbackQuery, state: FSMContext, identity: Identity):
+    if not identity.is_trainer:
         await callback.answer("У вас нет прав для этого действия.")
         return
     await callback.message.edit_text(
@@ -92,38 +113,60 @@ async def handle_add_knowledge(callback: types.CallbackQuery, state: FSMContext)
 
 
 @router.message(AddKnowledge.waiting_for_material, F.text | F.document | F.photo)
-async def handle_knowledge_material(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def handle_knowledge_material(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await message.answer("У вас нет прав для этого действия.")
         return
-    session = Session()
     try:
-        knowledge = KnowledgeBase()
+        knowledge = KnowledgeBase(category=material_category(message.text or message.caption),
+                                  uploaded_by=str(message.from_user.id), status=ingestion.STATUS_READY)
         if message.text:
             knowledge.type = 'text'
             knowledge.content = message.text
-        elif message.document:
-            knowledge.type = 'file'
-            file_id = message.document.file_id
-            file = await message.bot.get_file(file_id)
-            file_name = f"{int(time.time())}_{message.document.file_name}"
-            file_path = os.path.join("uploads", "knowledge", file_name)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            await message.bot.download_file(file.file_path, file_path)
-            knowledge.file_path = file_path
-            knowledge.text_content = extract_text_from_file(file_path)
-        elif message.photo:
-            knowledge.type = 'image'
-            file_id = message.photo[-1].file_id
+            knowledge.title = message.text.strip().split("\n")[0][:60]
+            knowledge.content_hash = ingestion.text_hash(message.text)
+        else:
+            if message.document:
+                knowledge.type = 'file'
+                knowledge.title = (message.caption or message.document.file_name or "").strip().split("\n")[0][:60] or None
+                file_id = message.document.file_id
+                file_name = f"{int(time.time())}_{message.document.file_name}"
+            else:
+                knowledge.type = 'image'
+                knowledge.title = (message.caption or "").strip().split("\n")[0][:60] or None
+                file_id = message.photo[-1].file_id
+                file_name = f"{int(time.time())}_image.jpg"
             file = await message.bot.get_file(file_id)
-            file_name = f"{int(time.time())}_image.jpg"
             file_path = os.path.join("uploads", "knowledge", file_name)
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
             await message.bot.download_file(file.file_path, file_path)
             knowledge.file_path = file_path
+            knowledge.content_hash = await asyncio.to_thread(ingestion.file_hash, file_path)
+        duplicate = await ingestion.find_duplicate(session, knowledge.content_hash)
+        if duplicate:
+            if knowledge.file_path:
+                os.remove(knowledge.file_path)
+            await message.answer(
+                f"Такой материал уже есть в базе знаний (ID: {duplicate.id}).", reply_markup=get_admin_menu())
+            await state.clear()
+            return
+        # Text extraction and indexing of files happen in the ingestion pipeline
+        if knowledge.type == 'file':
+            knowledge.status = ingestion.STATUS_PROCESSING
         session.add(knowledge)
-        session.commit()
-        await message.answer("Материал добавлен в базу знаний.", reply_markup=get_admin_menu())
+        await session.commit()
+        if knowledge.file_path:
+            # The uploaded file is already on Telegram servers, students will get it by this file_id
+            await file_registry.registry.remember(session, knowledge.file_path, file_id)
+        knowledge_cache.cache.invalidate()
+        if knowledge.type == 'file':
+            ingestion.pipeline.submit(knowledge.id)
+            await message.answer("Файл загружен и обрабатывается. Сообщу, когда он будет добавлен в поиск.",
+                                 reply_markup=get_admin_menu())
+        else:
+            if knowledge.type == 'text':
+                await ai_client.client.index_material(knowledge.id, knowledge.content)
+            await message.answer("Материал добавлен в базу знаний.", reply_markup=get_admin_menu())
         await state.clear()
     except Exception as e:
         await message.answer(
@@ -133,53 +176,36 @@ async def handle_knowledge_material(message: types.Message, state: FSMContext):
             ])
         )
         await state.clear()
-    finally:
-        session.close()
 
 
 @router.callback_query(F.data == "delete_knowledge")
-async def handle_delete_knowledge(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+async def handle_delete_knowledge(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await callback.answer("У вас нет прав для этого действия.")
         return
-    session = Session()
-    try:
-        materials = session.query(KnowledgeBase).all()
-        if not materials:
-            await callback.message.edit_text("База знаний пуста.")
-            return
-        buttons = []
-        for m in materials:
-            preview = ""
-            if m.type == 'text':
-                preview = m.content[:20] + ("..." if len(m.content) > 20 else "")
-            elif m.type in ('file', 'image'):
-                preview = os.path.basename(m.file_path)[:20] + (
-                    "..." if len(os.path.basename(m.file_path)) > 20 else "")
-            buttons.append([InlineKeyboardButton(text=f"ID: {m.id} - {m.type} - {preview}",
-                                                 callback_data=f"delete_material_{m.id}")])
-        buttons.append([InlineKeyboardButton(text="Назад", callback_data="back_to_knowledge_menu")])
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите материал для удаления:", reply_markup=inline_keyboard)
-    finally:
-        session.close()
+    await state.update_data(kb_filters={})
+    text, keyboard = await render_page(session, state, MODE_DELETE)
+    await callback.message.edit_text(text, reply_markup=keyboard)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("delete_material_"))
-async def handle_delete_material(callback: types.CallbackQuery):
+async def handle_delete_material(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
+        await callback.answer("У вас нет прав для этого действия.")
+        return
     material_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        material = session.query(KnowledgeBase).filter_by(id=material_id).first()
-        if not material:
-            await callback.answer("Материал не найден.")
-            return
-        session.delete(material)
-        session.commit()
-        await callback.message.edit_text("Материал удален.")
-    finally:
-        session.close()
+    material = await session.get(KnowledgeBase, int(material_id))
+    if not material:
+        await callback.answer("Материал не найден.")
+        return
+    await session.delete(material)
+    await session.commit()
+    if material.file_path:
+        await file_registry.registry.forget(session, material.file_path)
+    knowledge_cache.cache.invalidate(int(material_id))
+    await ai_client.client.remove_material(int(material_id))
+    await callback.message.edit_text("Материал удален.")
     await callback.answer()
 
 
@@ -194,8 +220,8 @@ async def handle_back_to_knowledge_menu(callback: types.CallbackQuery):
 
 
 @router.message(F.text == "Создать группу")
-async def create_group(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def create_group(message: types.Message, state: FSMContext, identity: Identity):
+    if not identity.is_trainer:
         await message.answer("Эта функция доступна только тренерам.")
         return
     await message.answer(
@@ -207,31 +233,26 @@ async def create_group(message: types.Message, state: FSMContext):
     await state.set_state(GroupCreation.waiting_for_name)
 
 @router.message(GroupCreation.waiting_for_name)
-async def handle_group_name(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def handle_group_name(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         return
     group_name = message.text.strip()
-    session = Session()
-    try:
-        trainer = session.query(Trainer).filter_by(telegram_id=str(message.from_user.id)).first()
-        group = Group(name=group_name, trainer_id=trainer.id)
-        session.add(group)
-        session.commit()
-        await state.update_data(group_id=group.id)
-        await message.answer(
-            f"Группа '{group_name}' создана. Введите расписание в свободной форме:",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Отмена", callback_data="back_to_admin")]
-            ])
-        )
-        await state.set_state(GroupCreation.waiting_for_schedule)
-    finally:
-        session.close()
+    group = Group(name=group_name, trainer_id=identity.trainer_id)
+    session.add(group)
+    await session.commit()
+    await state.update_data(group_id=group.id)
+    await message.answer(
+        f"Группа '{group_name}' создана. Введите расписание в свободной форме:",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Отмена", callback_data="back_to_admin")]
+        ])
+    )
+    await state.set_state(GroupCreation.waiting_for_schedule)
 
 
 @router.message(GroupCreation.waiting_for_schedule)
-async def handle_group_schedule(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def handle_group_schedule(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         return
     schedule_content = message.text.strip()
     if not schedule_content:
@@ -242,501 +263,519 @@ async def handle_group_schedule(message: types.Message, state: FSMContext):
             ])
         )
         return
-    session = Session()
-    try:
-        data = await state.get_data()
-        group_id = data.get("group_id")
-        schedule = Schedule(group_id=group_id, content=schedule_content)
-        session.add(schedule)
-        session.commit()
-        await message.answer(
-            "Расписание сохранено. Теперь загрузите файл с программой тренировок (например, PDF или документ):",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Отмена", callback_data="back_to_admin")]
-            ])
-        )
-        await state.set_state(GroupCreation.waiting_for_program_file)
-    finally:
-        session.close()
+    data = await state.get_data()
+    group_id = data.get("group_id")
+    schedule = Schedule(group_id=group_id, content=schedule_content)
+    session.add(schedule)
+    await session.commit()
+    await message.answer(
+        "Расписание сохранено. Теперь загрузите файл с программой тренировок (например, PDF или документ):",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Отмена", callback_data="back_to_admin")]
+        ])
+    )
+    await state.set_state(GroupCreation.waiting_for_program_file)
 
 
 
 @router.message(GroupCreation.waiting_for_program_file, F.document)
-async def handle_program_file(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def handle_program_file(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         return
     document = message.document
-    session = Session()
-    try:
-        data = await state.get_data()
-        group_id = data.get("group_id")
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await message.answer("Ошибка: группа не найдена.")
-            await state.clear()
-            return
-        upload_dir = "uploads"
-        if not os.path.exists(upload_dir):
-            os.makedirs(upload_dir)
-        file_extension = document.file_name.split('.')[-1] if '.' in document.file_name else 'file'
-        file_path = os.path.join(upload_dir, f"group_{group_id}_program.{file_extension}")
-        file = await message.bot.get_file(document.file_id)
-        await message.bot.download_file(file.file_path, file_path)
-        group.program_file = file_path
-        session.commit()
-        students = session.query(Student).all()
-        if not students:
-            await message.answer("Нет зарегистрированных учеников.", reply_markup=get_admin_menu())
-            await state.clear()
-            return
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=f"{s.name or 'N/A'} (@{s.username or 'N/A'})",
-                                  callback_data=f"add_student_{s.telegram_id}")]
-            for s in students
-        ] + [[InlineKeyboardButton(text="Отмена", callback_data="back_to_admin")]])
-        await message.answer("Файл программы тренировок сохранен. Выберите учеников для добавления:",
-                             reply_markup=keyboard)
-        await state.set_state(GroupCreation.waiting_for_students)
-    finally:
-        session.close()
+    data = await state.get_data()
+    group_id = data.get("group_id")
+    group = await get_group(session, group_id)
+    if not group:
+        await message.answer("Ошибка: группа не найдена.")
+        await state.clear()
+        return
+    upload_dir = "uploads"
+    if not os.path.exists(upload_dir):
+        os.makedirs(upload_dir)
+    file_extension = document.file_name.split('.')[-1] if '.' in document.file_name else 'file'
+    file_path = os.path.join(upload_dir, f"group_{group_id}_program.{file_extension}")
+    file = await message.bot.get_file(document.file_id)
+    await message.bot.download_file(file.file_path, file_path)
+    group.program_file = file_path
+    await session.commit()
+    await file_registry.registry.remember(session, file_path, document.file_id)
+    students = (await session.scalars(select(Student))).all()
+    if not students:
+        await message.answer("Нет зарегистрированных учеников.", reply_markup=get_admin_menu())
+        await state.clear()
+        return
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{s.name or 'N/A'} (@{s.username or 'N/A'})",
+                              callback_data=f"add_student_{s.telegram_id}")]
+        for s in students
+    ] + [[InlineKeyboardButton(text="Отмена", callback_data="back_to_admin")]])
+    await message.answer("Файл программы тренировок сохранен. Выберите учеников для добавления:",
+                         reply_markup=keyboard)
+    await state.set_state(GroupCreation.waiting_for_students)
 
 
 @router.callback_query(F.data.startswith("add_student_"))
-async def add_student_to_group(callback: types.CallbackQuery, state: FSMContext):
-    if not is_admin(callback.from_user.id):
+async def add_student_to_group(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await callback.answer("Эта функция доступна только тренерам.")
         return
     telegram_id = callback.data.replace("add_student_", "")
-    session = Session()
-    try:
-        data = await state.get_data()
-        group_id = data.get("group_id")
-        group = session.query(Group).filter_by(id=group_id).first()
-        student = session.query(Student).filter_by(telegram_id=telegram_id).first()
-        if student and group:
-            if student not in group.students:
-                group.students.append(student)
-                session.commit()
-                await callback.answer(f"Ученик {student.name or 'N/A'} добавлен в группу '{group.name}'.")
-            else:
-                await callback.answer(f"Ученик {student.name or 'N/A'} уже в группе.")
+    data = await state.get_data()
+    group_id = data.get("group_id")
+    group = await get_group(session, group_id, with_students=True)
+    student = await session.scalar(select(Student).filter_by(telegram_id=telegram_id))
+    if student and group:
+        if student not in group.students:
+            group.students.append(student)
+            await session.commit()
+            await callback.answer(f"Ученик {student.name or 'N/A'} добавлен в группу '{group.name}'.")
         else:
-            await callback.answer("Ошибка: группа или ученик не найдены.")
-    finally:
-        session.close()
-    students = session.query(Student).all()
+            await callback.answer(f"Ученик {student.name or 'N/A'} уже в группе.")
+    else:
+        await callback.answer("Ошибка: группа или ученик не найдены.")
+        return
+    students = (await session.scalars(select(Student))).all()
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text=f"{s.name or 'N/A'} (@{s.username or 'N/A'})",
                               callback_data=f"add_student_{s.telegram_id}")]
-        for s in students if s not in session.query(Group).filter_by(id=group_id).first().students
+        for s in students if s not in group.students
     ])
     keyboard.inline_keyboard.append([InlineKeyboardButton(text="Завершить выбор", callback_data="finish_selection")])
     await callback.message.edit_reply_markup(reply_markup=keyboard)
 
 
 @router.callback_query(F.data == "finish_selection")
-async def finish_selection(callback: types.CallbackQuery, state: FSMContext):
+async def finish_selection(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     data = await state.get_data()
     group_id = data.get("group_id")
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        await callback.message.edit_text(
-            f"Группа '{group.name}' успешно сформирована с {len(group.students)} {'учеником' if len(group.students) == 1 else 'учениками'}.")
-        await state.clear()
-    finally:
-        session.close()
+    group = await get_group(session, group_id, with_students=True)
+    await callback.message.edit_text(
+        f"Группа '{group.name}' успешно сформирована с {len(group.students)} {'учеником' if len(group.students) == 1 else 'учениками'}.")
+    await state.clear()
 
 
 @router.message(F.text == "Формировать расписание")
-async def create_schedule(message: types.Message):
-    if not is_admin(message.from_user.id):
+async def create_schedule(message: types.Message, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await message.answer("Эта функция доступна только тренерам.")
         return
-    session = Session()
-    try:
-        groups = session.query(Group).filter_by(
-            trainer_id=session.query(Trainer).filter_by(telegram_id=str(message.from_user.id)).first().id).all()
-        if not groups:
-            await message.answer("У вас нет групп. Создайте группу сначала.")
-            return
-        group_names = "\n".join([f"{g.id}: {g.name}" for g in groups])
-        await message.answer(
-            f"Выберите группу (введите ID):\n{group_names}\nФормат: ID группы, расписание (в свободной форме)")
-    finally:
-        session.close()
+    groups = (await session.scalars(select(Group).filter_by(trainer_id=identity.trainer_id))).all()
+    if not groups:
+        await message.answer("У вас нет групп. Создайте группу сначала.")
+        return
+    group_names = "\n".join([f"{g.id}: {g.name}" for g in groups])
+    await message.answer(
+        f"Выберите группу (введите ID):\n{group_names}\nФормат: ID группы, расписание (в свободной форме)")
 
 
 @router.message(F.text == "Просмотреть профили учеников")
-async def view_student_profiles(message: types.Message):
-    if not is_admin(message.from_user.id):
+async def view_student_profiles(message: types.Message, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await message.answer("Эта функция доступна только тренерам.")
         return
-    session = Session()
-    try:
-        students = session.query(Student).all()
-        if not students:
-            await message.answer("Нет зарегистрированных учеников.")
-            return
-        profiles = []
-        for student in students:
-            group_ids = session.query(GroupStudent.group_id).filter_by(student_id=student.id).all()
-            group_ids = [gid[0] for gid in group_ids]
-            group_names = ", ".join([g.name for g in session.query(Group).filter(
-                Group.id.in_(group_ids)).all()]) if group_ids else "Нет групп"
-            profiles.append(
-                f"ID: {student.telegram_id}, Username: @{student.username or 'N/A'}, Name: {student.name or 'N/A'}, Groups: {group_names}")
-        profiles_text = "\n".join(profiles)
-        await message.answer(f"Профили учеников:\n{profiles_text}")
-    finally:
-        session.close()
+    students = await get_student_profiles(session)
+    if not students:
+        await message.answer("Нет зарегистрированных учеников.")
+        return
+    profiles = [
+        f"ID: {student.telegram_id}, Username: @{student.username or 'N/A'}, Name: {student.name or 'N/A'}, "
+        f"Groups: {', '.join(g.name for g in student.groups) or 'Нет групп'}"
+        for student in students
+    ]
+    for chunk in chunk_lines(profiles, header="Профили учеников:"):
+        await message.answer(chunk)
+
+
+@router.message(Command("stats"))
+async def handle_stats(message: types.Message, identity: Identity):
+    if not identity.is_trainer:
+        await message.answer("Эта функция доступна только тренерам.")
+        return
+    lines = metrics.summary()
+    if not lines:
+        await message.answer("Статистика пока не собрана.")
+        return
+    if ai_client.AI_SERVICE_URLS:
+        lines.append("Метрики модели собираются в сервисе инференса (/metrics реплик).")
+    # With several webhook workers every process keeps its own statistics
+    for chunk in chunk_lines(lines, header=f"Обработчики с запуска (процесс {os.getpid()}), по убыванию p95:"):
+        await message.answer(chunk)
+
+
+@router.message(Command("lag"))
+async def handle_lag(message: types.Message, identity: Identity):
+    if not identity.is_trainer:
+        await message.answer("Эта функция доступна только тренерам.")
+        return
+    monitor = loop_monitor.monitor
+    if not monitor.running:
+        await message.answer("Мониторинг event loop выключен (LOOP_MONITOR=1 в .env).")
+        return
+    header = (f"Блокировки event loop дольше {monitor.threshold * 1000:.0f} мс (процесс {os.getpid()}), "
+              f"максимальная задержка {monitor.max_lag * 1000:.0f} мс:")
+    lines = monitor.summary()
+    if not lines:
+        await message.answer(f"{header}\nблокировок не было.")
+        return
+    for chunk in chunk_lines(lines, header=header):
+        await message.answer(chunk)
 
 
 @router.message(F.text == "Просмотреть список групп")
-async def view_groups(message: types.Message):
-    if not is_admin(message.from_user.id):
+async def view_groups(message: types.Message, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await message.answer("Эта функция доступна только тренерам.")
         return
-    session = Session()
-    try:
-        trainer = session.query(Trainer).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not trainer:
-            await message.answer("Вы не зарегистрированы как тренер.")
-            return
-        groups = session.query(Group).filter_by(trainer_id=trainer.id).all()
-        if not groups:
-            await message.answer("У вас нет созданных групп.")
-            return
-        buttons = [
-            [InlineKeyboardButton(text=g.name, callback_data=f"edit_group_{g.id}")]
-            for g in groups
-        ]
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await message.answer("Выберите группу:", reply_markup=inline_keyboard)
-    finally:
-        session.close()
+    groups = await get_trainer_groups(session, identity.trainer_id)
+    if not groups:
+        await message.answer("У вас нет созданных групп.")
+        return
+    await message.answer("Выберите группу:", reply_markup=groups_keyboard(groups))
 
 
 @router.callback_query(F.data.startswith("edit_group_"))
-async def handle_edit_group(callback: types.CallbackQuery):
+async def handle_edit_group(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if group.trainer_id != trainer.id:
-            await callback.answer("У вас нет доступа к этой группе.")
-            return
-        student_usernames = "\n".join([f"@{s.username or 'N/A'}" for s in group.students])
-        buttons = [
-            [InlineKeyboardButton(text="Изменить расписание", callback_data=f"change_schedule_{group_id}")],
-            [InlineKeyboardButton(text="Изменить программу", callback_data=f"change_program_{group_id}")],
-            [InlineKeyboardButton(text="Добавить учеников", callback_data=f"add_students_{group_id}")],
-            [InlineKeyboardButton(text="Удалить учеников из группы", callback_data=f"remove_students_{group_id}")],
-            [InlineKeyboardButton(text="Удалить группу", callback_data=f"delete_group_{group_id}")],
-            [InlineKeyboardButton(text="Назад к списку групп", callback_data="back_to_groups")]
-        ]
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text(f"Редактирование группы '{group.name}':\nУченики:\n{student_usernames}",
-                                         reply_markup=inline_keyboard)
-    finally:
-        session.close()
+    group = await get_group(session, group_id, with_students=True)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    buttons = [
+        [InlineKeyboardButton(text="Изменить расписание", callback_data=f"change_schedule_{group_id}")],
+        [InlineKeyboardButton(text="Изменить программу", callback_data=f"change_program_{group_id}")],
+        [InlineKeyboardButton(text="Добавить учеников", callback_data=f"add_students_{group_id}")],
+        [InlineKeyboardButton(text="Удалить учеников из группы", callback_data=f"remove_students_{group_id}")],
+        [InlineKeyboardButton(text="Написать группе", callback_data=f"broadcast_group_{group_id}")],
+        [InlineKeyboardButton(text="Удалить группу", callback_data=f"delete_group_{group_id}")],
+        [InlineKeyboardButton(text="Назад к списку групп", callback_data="back_to_groups")]
+    ]
+    inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    # A large group does not fit into one message, the tail of the list is replaced with a count
+    text = truncate_lines([f"@{s.username or 'N/A'}" for s in group.students],
+                          header=f"Редактирование группы '{group.name}':\nУченики:")
+    await callback.message.edit_text(text, reply_markup=inline_keyboard)
     await callback.answer()
 
 
 @router.callback_query(F.data == "back_to_groups")
-async def handle_back_to_groups(callback: types.CallbackQuery):
-    session = Session()
-    try:
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if not trainer:
-            await callback.message.edit_text("Вы не зарегистрированы как тренер.")
-            return
-        groups = session.query(Group).filter_by(trainer_id=trainer.id).all()
-        if not groups:
-            await callback.message.edit_text("У вас нет созданных групп.")
-            return
-        buttons = [
-            [InlineKeyboardButton(text=g.name, callback_data=f"edit_group_{g.id}")]
-            for g in groups
-        ]
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите группу для редактирования:", reply_markup=inline_keyboard)
-    finally:
-        session.close()
+async def handle_back_to_groups(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
+        await callback.message.edit_text("Вы не зарегистрированы как тренер.")
+        return
+    groups = await get_trainer_groups(session, identity.trainer_id)
+    if not groups:
+        await callback.message.edit_text("У вас нет созданных групп.")
+        return
+    await callback.message.edit_text("Выберите группу для редактирования:", reply_markup=groups_keyboard(groups))
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("delete_group_"))
-async def handle_delete_group(callback: types.CallbackQuery):
+async def handle_delete_group(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if group.trainer_id != trainer.id:
-            await callback.answer("У вас нет доступа к этой группе.")
-            return
-        buttons = [
-            [InlineKeyboardButton(text="Да", callback_data=f"confirm_delete_{group_id}"),
-             InlineKeyboardButton(text="Нет", callback_data=f"edit_group_{group_id}")]
-        ]
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text(f"Вы уверены, что хотите удалить группу '{group.name}'?",
-                                         reply_markup=inline_keyboard)
-    finally:
-        session.close()
+    group = await get_group(session, group_id)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    buttons = [
+        [InlineKeyboardButton(text="Да", callback_data=f"confirm_delete_{group_id}"),
+         InlineKeyboardButton(text="Нет", callback_data=f"edit_group_{group_id}")]
+    ]
+    inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await callback.message.edit_text(f"Вы уверены, что хотите удалить группу '{group.name}'?",
+                                     reply_markup=inline_keyboard)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("confirm_delete_"))
-async def handle_confirm_delete(callback: types.CallbackQuery):
+async def handle_confirm_delete(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if group.trainer_id != trainer.id:
-            await callback.answer("У вас нет доступа к этой группе.")
-            return
-        session.delete(group)
-        session.commit()
-        buttons = [
-            [InlineKeyboardButton(text="Назад к списку групп", callback_data="back_to_groups")]
-        ]
-        inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text(f"Группа '{group.name}' удалена.", reply_markup=inline_keyboard)
-    finally:
-        session.close()
+    # Students are loaded so that the group_students rows are removed together with the group
+    group = await get_group(session, group_id, with_students=True)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    await session.delete(group)
+    await session.commit()
+    buttons = [
+        [InlineKeyboardButton(text="Назад к списку групп", callback_data="back_to_groups")]
+    ]
+    inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await callback.message.edit_text(f"Группа '{group.name}' удалена.", reply_markup=inline_keyboard)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("change_program_"))
-async def handle_change_program(callback: types.CallbackQuery, state: FSMContext):
+async def handle_change_program(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession, identity: Identity):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if group.trainer_id != trainer.id:
-            await callback.answer("У вас нет доступа к этой группе.")
-            return
-        await callback.message.edit_text(
-            f"Загрузите новый файл программы тренировок для группы '{group.name}' (например, PDF или документ):",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Отмена", callback_data=f"edit_group_{group_id}")]
-            ])
-        )
-        await state.set_state(ChangeProgram.waiting_for_program_file)
-        await state.update_data(group_id=group_id)
-    finally:
-        session.close()
+    group = await get_group(session, group_id)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    await callback.message.edit_text(
+        f"Загрузите новый файл программы тренировок для группы '{group.name}' (например, PDF или документ):",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Отмена", callback_data=f"edit_group_{group_id}")]
+        ])
+    )
+    await state.set_state(ChangeProgram.waiting_for_program_file)
+    await state.update_data(group_id=group_id)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("add_students_"))
-async def handle_add_students(callback: types.CallbackQuery):
+async def handle_add_students(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if group.trainer_id != trainer.id:
-            await callback.answer("У вас нет доступа к этой группе.")
-            return
-        students_not_in_group = session.query(Student).filter(~Student.groups.any(Group.id == group_id)).all()
-        if not students_not_in_group:
-            buttons = [
-                [InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")]
-            ]
-            inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-            await callback.message.edit_text("Нет учеников для добавления.", reply_markup=inline_keyboard)
-            return
+    group = await get_group(session, group_id)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    students_not_in_group = (await session.scalars(select(Student).filter(
+        ~Student.id.in_(select(GroupStudent.student_id).filter_by(group_id=group.id))))).all()
+    if not students_not_in_group:
         buttons = [
-            [InlineKeyboardButton(text=f"{s.name or 'N/A'} (@{s.username or 'N/A'})",
-                                  callback_data=f"add_student_to_group_{group_id}_{s.telegram_id}")]
-            for s in students_not_in_group
+            [InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")]
         ]
-        buttons.append([InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")])
         inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите ученика для добавления в группу:", reply_markup=inline_keyboard)
-    finally:
-        session.close()
+        await callback.message.edit_text("Нет учеников для добавления.", reply_markup=inline_keyboard)
+        return
+    buttons = [
+        [InlineKeyboardButton(text=f"{s.name or 'N/A'} (@{s.username or 'N/A'})",
+                              callback_data=f"add_student_to_group_{group_id}_{s.telegram_id}")]
+        for s in students_not_in_group
+    ]
+    buttons.append([InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")])
+    inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await callback.message.edit_text("Выберите ученика для добавления в группу:", reply_markup=inline_keyboard)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("add_student_to_group_"))
-async def handle_add_student_to_group(callback: types.CallbackQuery):
+async def handle_add_student_to_group(callback: types.CallbackQuery, session: AsyncSession):
     parts = callback.data.split("_")
     group_id = parts[4]
     student_telegram_id = parts[5]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        student = session.query(Student).filter_by(telegram_id=student_telegram_id).first()
-        if not group or not student:
-            await callback.answer("Группа или ученик не найдены.")
-            return
-        if student in group.students:
-            await callback.answer("Ученик уже в группе.")
-            return
-        group.students.append(student)
-        session.commit()
-        await callback.message.edit_text(
-            f"Ученик {student.name or 'N/A'} добавлен в группу.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Назад к редактированию группы", callback_data=f"edit_group_{group_id}")]
-            ])
-        )
-    finally:
-        session.close()
+    group = await get_group(session, group_id, with_students=True)
+    student = await session.scalar(select(Student).filter_by(telegram_id=student_telegram_id))
+    if not group or not student:
+        await callback.answer("Группа или ученик не найдены.")
+        return
+    if student in group.students:
+        await callback.answer("Ученик уже в группе.")
+        return
+    group.students.append(student)
+    await session.commit()
+    await callback.message.edit_text(
+        f"Ученик {student.name or 'N/A'} добавлен в группу.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Назад к редактированию группы", callback_data=f"edit_group_{group_id}")]
+        ])
+    )
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("remove_students_"))
-async def handle_remove_students(callback: types.CallbackQuery):
+async def handle_remove_students(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if group.trainer_id != trainer.id:
-            await callback.answer("У вас нет доступа к этой группе.")
-            return
-        students_in_group = group.students
-        if not students_in_group:
-            buttons = [
-                [InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")]
-            ]
-            inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-            await callback.message.edit_text("В группе нет учеников.", reply_markup=inline_keyboard)
-            return
+    group = await get_group(session, group_id, with_students=True)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    students_in_group = group.students
+    if not students_in_group:
         buttons = [
-            [InlineKeyboardButton(text=f"{s.name or 'N/A'} (@{s.username or 'N/A'})",
-                                  callback_data=f"remove_student_from_group_{group_id}_{s.telegram_id}")]
-            for s in students_in_group
+            [InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")]
         ]
-        buttons.append([InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")])
         inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-        await callback.message.edit_text("Выберите ученика для удаления из группы:", reply_markup=inline_keyboard)
-    finally:
-        session.close()
+        await callback.message.edit_text("В группе нет учеников.", reply_markup=inline_keyboard)
+        return
+    buttons = [
+        [InlineKeyboardButton(text=f"{s.name or 'N/A'} (@{s.username or 'N/A'})",
+                              callback_data=f"remove_student_from_group_{group_id}_{s.telegram_id}")]
+        for s in students_in_group
+    ]
+    buttons.append([InlineKeyboardButton(text="Назад", callback_data=f"edit_group_{group_id}")])
+    inline_keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
+    await callback.message.edit_text("Выберите ученика для удаления из группы:", reply_markup=inline_keyboard)
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("remove_student_from_group_"))
-async def handle_remove_student_from_group(callback: types.CallbackQuery):
+async def handle_remove_student_from_group(callback: types.CallbackQuery, session: AsyncSession):
     parts = callback.data.split("_")
     group_id = parts[4]
     student_telegram_id = parts[5]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        student = session.query(Student).filter_by(telegram_id=student_telegram_id).first()
-        if not group or not student:
-            await callback.answer("Группа или ученик не найдены.")
-            return
-        if student not in group.students:
-            await callback.answer("Ученик не в группе.")
-            return
-        group.students.remove(student)
-        session.commit()
-        await callback.message.edit_text(
-            f"Ученик {student.name or 'N/A'} удален из группы.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Назад к редактированию группы", callback_data=f"edit_group_{group_id}")]
-            ])
-        )
-    finally:
-        session.close()
+    group = await get_group(session, group_id, with_students=True)
+    student = await session.scalar(select(Student).filter_by(telegram_id=student_telegram_id))
+    if not group or not student:
+        await callback.answer("Группа или ученик не найдены.")
+        return
+    if student not in group.students:
+        await callback.answer("Ученик не в группе.")
+        return
+    group.students.remove(student)
+    await session.commit()
+    await callback.message.edit_text(
+        f"Ученик {student.name or 'N/A'} удален из группы.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Назад к редактированию группы", callback_data=f"edit_group_{group_id}")]
+        ])
+    )
     await callback.answer()
 
 
 @router.callback_query(F.data.startswith("change_schedule_"))
-async def handle_change_schedule(callback: types.CallbackQuery, state: FSMContext):
+async def handle_change_schedule(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession, identity: Identity):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        trainer = session.query(Trainer).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if group.trainer_id != trainer.id:
-            await callback.answer("У вас нет доступа к этой группе.")
-            return
-        schedule = session.query(Schedule).filter_by(group_id=group_id).first()
-        current_schedule = schedule.content if schedule else "Нет расписания"
-        await callback.message.edit_text(
-            f"Введите новое расписание для группы '{group.name}' в свободной форме:\nТекущее расписание: {current_schedule}",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Отмена", callback_data=f"edit_group_{group_id}")]
-            ])
-        )
-        await state.set_state(ChangeSchedule.waiting_for_schedule)
-        await state.update_data(group_id=group_id)
-    finally:
-        session.close()
+    group = await get_group(session, group_id)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    schedule = await session.scalar(select(Schedule).filter_by(group_id=group.id))
+    current_schedule = schedule.content if schedule else "Нет расписания"
+    await callback.message.edit_text(
+        f"Введите новое расписание для группы '{group.name}' в свободной форме:\nТекущее расписание: {current_schedule}",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Отмена", callback_data=f"edit_group_{group_id}")]
+        ])
+    )
+    await state.set_state(ChangeSchedule.waiting_for_schedule)
+    await state.update_data(group_id=group_id)
     await callback.answer()
 
 
 @router.message(ChangeSchedule.waiting_for_schedule)
-async def handle_new_schedule(message: types.Message, state: FSMContext):
-    if not is_admin(message.from_user.id):
+async def handle_new_schedule(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await message.answer("Эта функция доступна только тренерам.")
         return
+    data = await state.get_data()
+    group_id = data.get("group_id")
     schedule_content = message.text.strip()
     if not schedule_content:
         await message.answer(
             "Расписание не может быть пустым. Пожалуйста, введите расписание:",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Отмена", callback_data=f"edit_group_{state.get_data().get('group_id')}")]
+                [InlineKeyboardButton(text="Отмена", callback_data=f"edit_group_{group_id}")]
             ])
         )
         return
-    session = Session()
-    try:
-        data = await state.get_data()
-        group_id = data.get("group_id")
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await message.answer("Ошибка: группа не найдена.")
-            await state.clear()
-            return
-        schedule = session.query(Schedule).filter_by(group_id=group_id).first()
-        if schedule:
-            schedule.content = schedule_content
-        else:
-            schedule = Schedule(group_id=group_id, content=schedule_content)
-            session.add(schedule)
-        session.commit()
-        await message.answer(
-            f"Расписание для группы '{group.name}' обновлено.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Назад к редактированию группы", callback_data=f"edit_group_{group_id}")]
-            ])
-        )
+    group = await get_group(session, group_id)
+    if not group:
+        await message.answer("Ошибка: группа не найдена.")
+        await state.clear()
+        return
+    schedule = await session.scalar(select(Schedule).filter_by(group_id=group.id))
+    if schedule:
+        schedule.content = schedule_content
+    else:
+        schedule = Schedule(group_id=group.id, content=schedule_content)
+        session.add(schedule)
+    await session.commit()
+    await message.answer(
+        f"Расписание для группы '{group.name}' обновлено.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Назад к редактированию группы", callback_data=f"edit_group_{group_id}")]
+        ])
+    )
+    await broadcast.enqueue(session, message.bot, group.id, message.chat.id,
+                            text=f"Расписание группы '{group.name}' изменено:\n{schedule_content}")
+    await state.clear()
+
+
+@router.message(ChangeProgram.waiting_for_program_file, F.document)
+async def handle_new_program_file(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
+        await message.answer("Эта функция доступна только тренерам.")
+        return
+    data = await state.get_data()
+    group_id = data.get("group_id")
+    group = await get_group(session, group_id)
+    if not group:
+        await message.answer("Ошибка: группа не найдена.")
         await state.clear()
-    finally:
-        session.close()
+        return
+    document = message.document
+    os.makedirs("uploads", exist_ok=True)
+    file_extension = document.file_name.split('.')[-1] if '.' in document.file_name else 'file'
+    file_path = os.path.join("uploads", f"group_{group_id}_program.{file_extension}")
+    file = await message.bot.get_file(document.file_id)
+    await message.bot.download_file(file.file_path, file_path)
+    group.program_file = file_path
+    await session.commit()
+    await file_registry.registry.remember(session, file_path, document.file_id)
+    await message.answer(
+        f"Программа тренировок для группы '{group.name}' обновлена.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Назад к редактированию группы", callback_data=f"edit_group_{group_id}")]
+        ])
+    )
+    # The trainer's upload is already on Telegram servers, students get it by file_id
+    await broadcast.enqueue(session, message.bot, group.id, message.chat.id,
+                            text=f"Программа тренировок группы '{group.name}' обновлена",
+                            file_id=document.file_id)
+    await state.clear()
+
+
+@router.callback_query(F.data.startswith("broadcast_group_"))
+async def handle_broadcast_group(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession, identity: Identity):
+    group_id = callback.data.split("_")[-1]
+    group = await get_group(session, group_id)
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if group.trainer_id != identity.trainer_id:
+        await callback.answer("У вас нет доступа к этой группе.")
+        return
+    await callback.message.edit_text(
+        f"Введите сообщение для учеников группы '{group.name}':",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Отмена", callback_data=f"edit_group_{group_id}")]
+        ])
+    )
+    await state.set_state(GroupBroadcast.waiting_for_text)
+    await state.update_data(group_id=group_id)
+    await callback.answer()
+
+
+@router.message(GroupBroadcast.waiting_for_text, F.text)
+async def handle_broadcast_text(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
+        await message.answer("Эта функция доступна только тренерам.")
+        return
+    data = await state.get_data()
+    group = await get_group(session, data.get("group_id"))
+    if not group:
+        await message.answer("Ошибка: группа не найдена.")
+        await state.clear()
+        return
+    await state.clear()
+    queued = await broadcast.enqueue(session, message.bot, group.id, message.chat.id,
+                                     text=f"Сообщение от тренера для группы '{group.name}':\n{message.text}")
+    if queued is None:
+        await message.answer("В группе нет учеников.")
 
 @router.callback_query(F.data == "back_to_admin")
 async def handle_back_to_admin(callback: types.CallbackQuery, state: FSMContext):
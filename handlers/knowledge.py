@@ -0,0 +1,313 @@
+import os
+import re
+import datetime
+from aiogram import Router, types, F
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import (InlineQueryResultArticle, InlineQueryResultCachedDocument,
+                           InlineQueryResultCachedPhoto, InputTextMessageContent)
+from aiogram.filters import Command, CommandObject
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from sqlalchemy import select, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from models import KnowledgeBase
+from identity import Identity
+import file_registry
+import knowledge_search
+
+router = Router()
+load_dotenv()
+
+KNOWLEDGE_PAGE_SIZE = int(os.getenv("KNOWLEDGE_PAGE_SIZE", "8"))
+# Режимы просмотра: v — ученик открывает материалы, d — тренер выбирает материал для удаления
+MODE_VIEW = "v"
+MODE_DELETE = "d"
+TYPE_LABELS = {"all": "Все", "text": "Тексты", "file": "Файлы", "image": "Фото"}
+ITEM_LABELS = {"text": "Текст", "file": "Файл", "image": "Фото"}
+# Кнопки тем переносятся по строкам, чтобы все темы оставались доступны
+CATEGORY_ROW_SIZE = 3
+
+
+class KnowledgeSearch(StatesGroup):
+    waiting_for_query = State()
+
+
+def material_category(text):
+    """
+    Категория материала — первый хэштег в тексте или подписи (#питание -> питание).
+    """
+    match = re.search(r"#(\w+)", text or "")
+    return match.group(1).lower()[:32] if match else None
+
+
+def material_title(material):
+    if material.title:
+        return material.title
+    if material.type == 'text' and material.content:
+        return material.content.strip().split("\n")[0][:60]
+    if material.file_path:
+        return os.path.basename(material.file_path)[:60]
+    return f"Материал {material.id}"
+
+
+def encode_cursor(material):
+    return f"{int(material.created_at.timestamp() * 1_000_000)}_{material.id}"
+
+
+def decode_cursor(created_us, material_id):
+    return datetime.datetime.fromtimestamp(int(created_us) / 1_000_000), int(material_id)
+
+
+async def get_knowledge_page(session, filters, cursor=None, direction="n", page_size=KNOWLEDGE_PAGE_SIZE):
+    """
+    Одна страница материалов, новые первыми. Keyset-пагинация по (created_at, id):
+    каждая страница — один запрос по индексу без OFFSET. Возвращает (materials, has_prev, has_next).
+    """
+    query = select(KnowledgeBase)
+    if filters.get("type", "all") != "all":
+        query = query.filter(KnowledgeBase.type == filters["type"])
+    if filters.get("category"):
+        query = query.filter(KnowledgeBase.category == filters["category"])
+    if filters.get("query") and knowledge_search.available():
+        # В запросе нет ни одного слова (например, "?!"): пустой MATCH — синтаксическая ошибка FTS5
+        if not knowledge_search.to_match_query(filters["query"]):
+            return [], False, False
+        query = query.filter(KnowledgeBase.id.in_(knowledge_search.match_ids(filters["query"])))
+    elif filters.get("query"):
+        pattern = f"%{filters['query']}%"
+        query = query.filter(or_(KnowledgeBase.title.ilike(pattern), KnowledgeBase.content.ilike(pattern),
+                                 KnowledgeBase.text_content.ilike(pattern)))
+    if cursor is not None:
+        created_at, material_id = cursor
+        if direction == "n":
+            query = query.filter(or_(KnowledgeBase.created_at < created_at,
+                                     and_(KnowledgeBase.created_at == created_at, KnowledgeBase.id < material_id)))
+        else:
+            query = query.filter(or_(KnowledgeBase.created_at > created_at,
+                                     and_(KnowledgeBase.created_at == created_at, KnowledgeBase.id > material_id)))
+    if direction == "n":
+        query = query.order_by(KnowledgeBase.created_at.desc(), KnowledgeBase.id.desc())
+    else:
+        query = query.order_by(KnowledgeBase.created_at.asc(), KnowledgeBase.id.asc())
+    materials = list((await session.scalars(query.limit(page_size + 1))).all())
+    has_more = len(materials) > page_size
+    materials = materials[:page_size]
+    if direction == "n":
+        return materials, cursor is not None, has_more
+    materials.reverse()
+    return materials, has_more, True
+
+
+async def get_categories(session):
+    return [category for (category,) in (await session.execute(
+        select(KnowledgeBase.category).filter(KnowledgeBase.category.isnot(None))
+        .distinct().order_by(KnowledgeBase.category))).all()]
+
+
+def build_page_keyboard(mode, materials, has_prev, has_next, filters, categories):
+    item_callback = "kbo_{}" if mode == MODE_VIEW else "delete_material_{}"
+    buttons = [
+        [InlineKeyboardButton(text=f"{ITEM_LABELS.get(m.type, m.type)}: {material_title(m)}",
+                              callback_data=item_callback.format(m.id))]
+        for m in materials
+    ]
+    navigation = []
+    if not materials:
+        has_prev = has_next = False
+    if has_prev:
+        navigation.append(InlineKeyboardButton(text="◀", callback_data=f"kbp_{mode}_p_{encode_cursor(materials[0])}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton(text="▶", callback_data=f"kbp_{mode}_n_{encode_cursor(materials[-1])}"))
+    if navigation:
+        buttons.append(navigation)
+    current_type = filters.get("type", "all")
+    buttons.append([
+        InlineKeyboardButton(text=("• " if key == current_type else "") + label, callback_data=f"kbt_{mode}_{key}")
+        for key, label in TYPE_LABELS.items()
+    ])
+    if categories:
+        category_buttons = [
+            InlineKeyboardButton(text=("• " if category == filters.get("category") else "") + f"#{category}",
+                                 callback_data=f"kbc_{mode}_{index}")
+            for index, category in enumerate(categories)
+        ] + [InlineKeyboardButton(text="Все темы", callback_data=f"kbc_{mode}_all")]
+        buttons += [category_buttons[start:start + CATEGORY_ROW_SIZE]
+                    for start in range(0, len(category_buttons), CATEGORY_ROW_SIZE)]
+    buttons.append([InlineKeyboardButton(text="Поиск", callback_data=f"kbs_{mode}")])
+    if mode == MODE_DELETE:
+        buttons.append([InlineKeyboardButton(text="Назад", callback_data="back_to_knowledge_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
+
+def page_title(mode, filters, empty):
+    title = "Выберите материал для удаления" if mode == MODE_DELETE else "База знаний"
+    if filters.get("query"):
+        title += f" — поиск: «{filters['query']}»"
+    if filters.get("category"):
+        title += f" — #{filters['category']}"
+    return title + (": ничего не найдено." if empty else ":")
+
+
+async def render_page(session, state, mode, cursor=None, direction="n"):
+    """
+    Возвращает текст и клавиатуру страницы. Фильтры хранятся в данных FSM пользователя.
+    """
+    data = await state.get_data()
+    filters = data.get("kb_filters", {})
+    categories = await get_categories(session)
+    await state.update_data(kb_categories=categories)
+    materials, has_prev, has_next = await get_knowledge_page(session, filters, cursor, direction)
+    return (page_title(mode, filters, not materials),
+            build_page_keyboard(mode, materials, has_prev, has_next, filters, categories))
+
+
+async def show_knowledge_page(message, session, state, mode):
+    """
+    Первая страница базы знаний без фильтров — одно сообщение.
+    """
+    await state.update_data(kb_filters={})
+    text, keyboard = await render_page(session, state, mode)
+    await message.answer(text, reply_markup=keyboard)
+
+
+async def check_mode(callback, mode, identity):
+    if mode == MODE_DELETE and not identity.is_trainer:
+        await callback.answer("У вас нет прав для этого действия.")
+        return False
+    return True
+
+
+@router.callback_query(F.data.startswith("kbp_"))
+async def handle_knowledge_page(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession,
+                                identity: Identity):
+    _, mode, direction, created_us, material_id = callback.data.split("_")
+    if not await check_mode(callback, mode, identity):
+        return
+    text, keyboard = await render_page(session, state, mode, decode_cursor(created_us, material_id), direction)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+async def apply_filter(callback, state, session, mode, **changes):
+    data = await state.get_data()
+    filters = dict(data.get("kb_filters", {}))
+    filters.update(changes)
+    await state.update_data(kb_filters=filters)
+    text, keyboard = await render_page(session, state, mode)
+    await callback.message.edit_text(text, reply_markup=keyboard)
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("kbt_"))
+async def handle_knowledge_type_filter(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession,
+                                       identity: Identity):
+    _, mode, material_type = callback.data.split("_")
+    if not await check_mode(callback, mode, identity):
+        return
+    await apply_filter(callback, state, session, mode, type=material_type)
+
+
+@router.callback_query(F.data.startswith("kbc_"))
+async def handle_knowledge_category_filter(callback: types.CallbackQuery, state: FSMContext,
+                                           session: AsyncSession, identity: Identity):
+    _, mode, index = callback.data.split("_")
+    if not await check_mode(callback, mode, identity):
+        return
+    categories = (await state.get_data()).get("kb_categories", [])
+    category = categories[int(index)] if index != "all" and int(index) < len(categories) else None
+    await apply_filter(callback, state, session, mode, category=category)
+
+
+@router.callback_query(F.data.startswith("kbs_"))
+async def handle_knowledge_search(callback: types.CallbackQuery, state: FSMContext, identity: Identity):
+    mode = callback.data.split("_")[1]
+    if not await check_mode(callback, mode, identity):
+        return
+    await state.set_state(KnowledgeSearch.waiting_for_query)
+    await state.update_data(kb_mode=mode)
+    await callback.message.edit_text("Введите слово или фразу для поиска по базе знаний:")
+    await callback.answer()
+
+
+@router.message(KnowledgeSearch.waiting_for_query, F.text)
+async def handle_knowledge_search_query(message: types.Message, state: FSMContext, session: AsyncSession):
+    data = await state.get_data()
+    await state.set_state(None)
+    filters = dict(data.get("kb_filters", {}))
+    filters["query"] = message.text.strip()[:100]
+    await state.update_data(kb_filters=filters)
+    text, keyboard = await render_page(session, state, data.get("kb_mode", MODE_VIEW))
+    await message.answer(text, reply_markup=keyboard)
+
+
+@router.callback_query(F.data.startswith("kbo_"))
+async def handle_open_material(callback: types.CallbackQuery, session: AsyncSession):
+    material = await session.get(KnowledgeBase, int(callback.data.split("_")[1]))
+    if not material:
+        await callback.answer("Материал не найден.")
+        return
+    if material.type == 'text':
+        await callback.message.answer(material.content)
+    elif material.type == 'file':
+        await file_registry.registry.send(session, callback.message.answer_document, material.file_path)
+    elif material.type == 'image':
+        await file_registry.registry.send(session, callback.message.answer_photo, material.file_path)
+    await callback.answer()
+
+
+async def search_materials(session, query, limit=10):
+    """
+    Материалы по запросу в порядке BM25 вместе с фрагментами текста.
+    """
+    if not knowledge_search.available():
+        materials, _, _ = await get_knowledge_page(session, {"query": query}, page_size=limit)
+        return [(material, "") for material in materials]
+    results = await knowledge_search.search(session, query, limit=limit)
+    materials = {m.id: m for m in (await session.scalars(
+        select(KnowledgeBase).filter(KnowledgeBase.id.in_([material_id for material_id, _ in results])))).all()}
+    return [(materials[material_id], snippet) for material_id, snippet in results if material_id in materials]
+
+
+@router.message(Command("search"))
+async def handle_search_command(message: types.Message, command: CommandObject, session: AsyncSession,
+                                identity: Identity):
+    if identity.role is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
+        return
+    if not command.args:
+        await message.answer("Использование: /search <слова для поиска>")
+        return
+    results = await search_materials(session, command.args)
+    if not results:
+        await message.answer("В базе знаний ничего не найдено.")
+        return
+    lines = [f"{number}. {material_title(material)}" + (f"\n   {snippet}" if snippet else "")
+             for number, (material, snippet) in enumerate(results, 1)]
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=f"{number}. {material_title(material)}", callback_data=f"kbo_{material.id}")]
+        for number, (material, _) in enumerate(results, 1)
+    ])
+    await message.answer("Результаты поиска:\n\n" + "\n".join(lines), reply_markup=keyboard)
+
+
+@router.inline_query()
+async def handle_inline_search(inline_query: types.InlineQuery, session: AsyncSession, identity: Identity):
+    if identity.role is None or not inline_query.query.strip():
+        await inline_query.answer([], cache_time=5, is_personal=True)
+        return
+    results = []
+    for material, snippet in await search_materials(session, inline_query.query, limit=20):
+        title = material_title(material)
+        file_id = (await file_registry.registry.get(session, material.file_path)) if material.file_path else None
+        if material.type == 'file' and file_id:
+            results.append(InlineQueryResultCachedDocument(id=str(material.id), title=title,
+                                                           document_file_id=file_id, description=snippet))
+        elif material.type == 'image' and file_id:
+            results.append(InlineQueryResultCachedPhoto(id=str(material.id), title=title, photo_file_id=file_id))
+        else:
+            body = material.content if material.type == 'text' else f"{title}\n\n{snippet}"
+            results.append(InlineQueryResultArticle(
+                id=str(material.id), title=title, description=snippet or None,
+                input_message_content=InputTextMessageContent(message_text=(body or title)[:4096])))
+    await inline_query.answer(results, cache_time=30, is_personal=True)
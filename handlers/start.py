@@ -7,21 +7,33 @@ from aiogram import Router, types, F
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton
 from aiogram.types import FSInputFile
 from aiogram.filters import Command
-from database import Session
-from models import Student, GroupStudent, PaymentRequest, Trainer, Group, Schedule, Progress, KnowledgeBase
-from handlers.admin import is_admin, get_admin_menu
-import ai_model
-import asyncio
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Student, GroupStudent, PaymentRequest, Trainer, Group, Schedule, Progress
+from handlers.admin import get_admin_menu
+from identity import Identity, cache as identity_cache
+import ai_client
+from ai_model import clean_response
+import export
+import file_registry
+from telegram_text import chunk_lines
 from filters import IsAdmin
+from handlers.knowledge import show_knowledge_page, MODE_VIEW
 import os
 import time
-import zipfile
-import tempfile
 from dotenv import load_dotenv
 
 router = Router()
 load_dotenv()
 
+# Потоковый вывод ответа ИИ; выключен по умолчанию: поток генерируется вне пакета и снижает пропускную способность.
+# Интервал между редактированиями сообщения — ограничение Telegram
+AI_STREAMING = os.getenv("AI_STREAMING", "0").lower() not in ("0", "false", "no")
+AI_STREAM_EDIT_INTERVAL = float(os.getenv("AI_STREAM_EDIT_INTERVAL", "1.5"))
+AI_DIALOGUE_HINT = "Вы можете продолжить диалог, отправив еще один запрос, или вернуться в меню."
+AI_UNAVAILABLE_TEXT = "ИИ-модель сейчас недоступна. Пожалуйста, попробуйте позже."
+
 
 class NutritionStates(StatesGroup):
     waiting_for_nutrition_data = State()
@@ -95,61 +107,55 @@ def get_progress_menu():
 
 
 @router.message(Command("start"))
-async def start_command(message: types.Message):
-    session = Session()
-    try:
-        if is_admin(str(message.from_user.id)):
-            await message.reply(f"Привет, {message.from_user.first_name}! Выбери команду",
-                                reply_markup=get_admin_menu())
-            return
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            student = Student(
-                telegram_id=str(message.from_user.id),
-                username=message.from_user.username,
-                name=message.from_user.first_name
-            )
-            session.add(student)
-            session.commit()
-        await message.reply(f"Привет, {student.name}! Я телеграм-бот Руслана Сидорова для"
-                            f" персональных тренировок. Выбери команду",
-                            reply_markup=get_main_menu())
-    finally:
-        session.close()
+async def start_command(message: types.Message, session: AsyncSession, identity: Identity):
+    if identity.is_trainer:
+        await message.reply(f"Привет, {message.from_user.first_name}! Выбери команду",
+                            reply_markup=get_admin_menu())
+        return
+    if identity.student_id is None:
+        student = Student(
+            telegram_id=str(message.from_user.id),
+            username=message.from_user.username,
+            name=message.from_user.first_name
+        )
+        session.add(student)
+        await session.commit()
+        identity_cache.add_student(student.telegram_id, student.id)
+    else:
+        student = await session.get(Student, identity.student_id)
+    await message.reply(f"Привет, {student.name}! Я телеграм-бот Руслана Сидорова для"
+                        f" персональных тренировок. Выбери команду",
+                        reply_markup=get_main_menu())
 
 
 @router.message(F.text == "Занятия с тренером")
-async def handle_trainer_sessions(message: types.Message, state: FSMContext):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
-            return
+async def handle_trainer_sessions(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    if identity.student_id is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
+        return
+    student = await session.get(Student, identity.student_id)
+    await message.answer(
+        f"У вас осталось {student.remaining_sessions} оплаченных занятий.",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Отмена", callback_data="back_to_main")]
+        ])
+    )
+    pending_request = await session.scalar(select(PaymentRequest).filter_by(student_id=student.id, status='pending'))
+    if pending_request:
         await message.answer(
-            f"У вас осталось {student.remaining_sessions} оплаченных занятий.",
+            f"Ваш запрос на {pending_request.sessions_requested} занятий находится на рассмотрении.",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="Отмена", callback_data="back_to_main")]
             ])
         )
-        pending_request = session.query(PaymentRequest).filter_by(student_id=student.id, status='pending').first()
-        if pending_request:
-            await message.answer(
-                f"Ваш запрос на {pending_request.sessions_requested} занятий находится на рассмотрении.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="Отмена", callback_data="back_to_main")]
-                ])
-            )
-        else:
-            await message.answer(
-                "Отправьте файл (например, скриншот или документ) с подтверждением оплаты.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [InlineKeyboardButton(text="Отмена", callback_data="back_to_main")]
-                ])
-            )
-            await state.set_state(PaymentStates.waiting_for_screenshot)
-    finally:
-        session.close()
+    else:
+        await message.answer(
+            "Отправьте файл (например, скриншот или документ) с подтверждением оплаты.",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="Отмена", callback_data="back_to_main")]
+            ])
+        )
+        await state.set_state(PaymentStates.waiting_for_screenshot)
 
 
 # Added cancel button to return to main menu
@@ -175,7 +181,7 @@ async def handle_screenshot(message: types.Message, state: FSMContext):
 
 # Added cancel button to return to main menu
 @router.message(F.text, PaymentStates.waiting_for_sessions)
-async def handle_sessions(message: types.Message, state: FSMContext):
+async def handle_sessions(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
     try:
         sessions = int(message.text)
         if sessions <= 0:
@@ -191,169 +197,152 @@ async def handle_sessions(message: types.Message, state: FSMContext):
     data = await state.get_data()
     screenshot_file_id = data.get('screenshot_file_id')
     file_type = data.get('file_type')
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        payment_request = PaymentRequest(
-            student_id=student.id,
-            sessions_requested=sessions,
-            status='pending',
-            screenshot_file_id=screenshot_file_id,
-            created_at=datetime.datetime.now(),
-            updated_at=datetime.datetime.now()
-        )
-        session.add(payment_request)
-        session.commit()
-        trainer = session.query(Trainer).first()
-        if trainer:
-            keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Подтвердить", callback_data=f"approve_{payment_request.id}"),
-                 InlineKeyboardButton(text="Отклонить", callback_data=f"reject_{payment_request.id}")]
-            ])
-            if file_type == 'photo':
-                await message.bot.send_photo(
-                    chat_id=trainer.telegram_id,
-                    photo=screenshot_file_id,
-                    caption=f"Ученик @{student.username} оплатил {sessions} занятий.",
-                    reply_markup=keyboard
-                )
-            else:
-                await message.bot.send_document(
-                    chat_id=trainer.telegram_id,
-                    document=screenshot_file_id,
-                    caption=f"Ученик @{student.username} оплатил {sessions} занятий.",
-                    reply_markup=keyboard
-                )
-        await message.answer("Ваш запрос отправлен тренеру на рассмотрение.", reply_markup=get_main_menu())
-        await state.clear()
-    finally:
-        session.close()
+    student = await session.get(Student, identity.student_id)
+    payment_request = PaymentRequest(
+        student_id=student.id,
+        sessions_requested=sessions,
+        status='pending',
+        screenshot_file_id=screenshot_file_id,
+        created_at=datetime.datetime.now(),
+        updated_at=datetime.datetime.now()
+    )
+    session.add(payment_request)
+    await session.commit()
+    trainer = await session.scalar(select(Trainer))
+    if trainer:
+        keyboard = InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="Подтвердить", callback_data=f"approve_{payment_request.id}"),
+             InlineKeyboardButton(text="Отклонить", callback_data=f"reject_{payment_request.id}")]
+        ])
+        if file_type == 'photo':
+            await message.bot.send_photo(
+                chat_id=trainer.telegram_id,
+                photo=screenshot_file_id,
+                caption=f"Ученик @{student.username} оплатил {sessions} занятий.",
+                reply_markup=keyboard
+            )
+        else:
+            await message.bot.send_document(
+                chat_id=trainer.telegram_id,
+                document=screenshot_file_id,
+                caption=f"Ученик @{student.username} оплатил {sessions} занятий.",
+                reply_markup=keyboard
+            )
+    await message.answer("Ваш запрос отправлен тренеру на рассмотрение.", reply_markup=get_main_menu())
+    await state.clear()
 
 
 @router.callback_query(F.data.startswith("approve_"))
-async def handle_approve(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+async def handle_approve(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await callback.answer("У вас нет прав для этого действия.")
         return
     request_id = callback.data.split("_")[1]
-    session = Session()
-    try:
-        payment_request = session.query(PaymentRequest).filter_by(id=request_id).first()
-        if not payment_request or payment_request.status != 'pending':
-            await callback.answer("Этот запрос уже обработан.")
-            return
-        student = session.query(Student).filter_by(id=payment_request.student_id).first()
-        student.remaining_sessions += payment_request.sessions_requested
-        payment_request.status = 'approved'
-        payment_request.updated_at = datetime.datetime.now()
-        session.commit()
-        await callback.message.edit_caption(
-            caption="Платеж одобрен.",
-            reply_markup=None
-        )
-        await callback.bot.send_message(
-            chat_id=student.telegram_id,
-            text="Ваш платеж одобрен. Количество оплаченных занятий обновлено."
-        )
-        await callback.answer("Подтверждение выполнено!")
-    finally:
-        session.close()
+    payment_request = await session.get(PaymentRequest, int(request_id))
+    if not payment_request or payment_request.status != 'pending':
+        await callback.answer("Этот запрос уже обработан.")
+        return
+    student = await session.get(Student, payment_request.student_id)
+    student.remaining_sessions += payment_request.sessions_requested
+    payment_request.status = 'approved'
+    payment_request.updated_at = datetime.datetime.now()
+    await session.commit()
+    await callback.message.edit_caption(
+        caption="Платеж одобрен.",
+        reply_markup=None
+    )
+    await callback.bot.send_message(
+        chat_id=student.telegram_id,
+        text="Ваш платеж одобрен. Количество оплаченных занятий обновлено."
+    )
+    await callback.answer("Подтверждение выполнено!")
 
 
 @router.callback_query(F.data.startswith("reject_"))
-async def handle_reject(callback: types.CallbackQuery):
-    if not is_admin(callback.from_user.id):
+async def handle_reject(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
+    if not identity.is_trainer:
         await callback.answer("У вас нет прав для этого действия.")
         return
     request_id = callback.data.split("_")[1]
-    session = Session()
-    try:
-        payment_request = session.query(PaymentRequest).filter_by(id=request_id).first()
-        if not payment_request or payment_request.status != 'pending':
-            await callback.answer("Этот запрос уже обработан.")
-            return
-        payment_request.status = 'rejected'
-        payment_request.updated_at = datetime.datetime.now()
-        session.commit()
-        await callback.message.edit_caption(
-            caption="Платеж отклонен.",
-            reply_markup=None
-        )
-        await callback.bot.send_message(
-            chat_id=payment_request.student.telegram_id,
-            text="Ваш платеж отклонен."
-        )
-        await callback.answer("Отклонение выполнено!")
-    finally:
-        session.close()
+    payment_request = await session.scalar(
+        select(PaymentRequest).filter_by(id=int(request_id)).options(selectinload(PaymentRequest.student)))
+    if not payment_request or payment_request.status != 'pending':
+        await callback.answer("Этот запрос уже обработан.")
+        return
+    payment_request.status = 'rejected'
+    payment_request.updated_at = datetime.datetime.now()
+    await session.commit()
+    await callback.message.edit_caption(
+        caption="Платеж отклонен.",
+        reply_markup=None
+    )
+    await callback.bot.send_message(
+        chat_id=payment_request.student.telegram_id,
+        text="Ваш платеж отклонен."
+    )
+    await callback.answer("Отклонение выполнено!")
 
 
 @router.message(F.text == "График тренировок")
-async def handle_training_schedule(message: types.Message):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
-            return
-        groups = session.query(Group).join(GroupStudent).filter(GroupStudent.student_id == student.id).all()
-        if not groups:
-            await message.answer("Вы не состоите ни в одной группе.")
-            return
-        schedules = []
-        for group in groups:
-            schedule = session.query(Schedule).filter_by(group_id=group.id).first()
-            schedules.append(f"Группа '{group.name}': {schedule.content if schedule else 'Расписание не задано'}")
-        schedules_text = "\n\n".join(schedules)
-        await message.answer(f"Ваши группы и расписания:\n\n{schedules_text}")
-    finally:
-        session.close()
+async def handle_training_schedule(message: types.Message, session: AsyncSession, identity: Identity):
+    student_id = identity.student_id
+    if student_id is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
+        return
+    # Groups and their schedules in one query instead of one schedule query per group
+    rows = (await session.execute(
+        select(Group.id, Group.name, Schedule.content)
+        .join(GroupStudent, GroupStudent.group_id == Group.id)
+        .outerjoin(Schedule, Schedule.group_id == Group.id)
+        .filter(GroupStudent.student_id == student_id)
+        .order_by(Group.id, Schedule.id))).all()
+    if not rows:
+        await message.answer("Вы не состоите ни в одной группе.")
+        return
+    schedules = {}
+    for group_id, name, content in rows:
+        schedules.setdefault(group_id, f"Группа '{name}': {content or 'Расписание не задано'}")
+    for chunk in chunk_lines(schedules.values(), header="Ваши группы и расписания:", separator="\n\n"):
+        await message.answer(chunk)
 
 
 @router.message(F.text == "Программа тренировок")
-async def handle_training_program(message: types.Message, state: FSMContext):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
-            return
-        groups = session.query(Group).join(GroupStudent).filter(GroupStudent.student_id == student.id).all()
-        if not groups:
-            await message.answer("Вы не состоите ни в одной группе.")
-            return
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-                                                            [InlineKeyboardButton(text=g.name,
-                                                                                  callback_data=f"select_program_{g.id}")]
-                                                            for g in groups
-                                                        ] + [[InlineKeyboardButton(text="Отмена",
-                                                                                   callback_data="back_to_main")]])
-        await message.answer("Выберите группу, чтобы получить программу тренировок:", reply_markup=keyboard)
-        await state.set_state(ProgramSelection.waiting_for_group)
-    finally:
-        session.close()
+async def handle_training_program(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    student_id = identity.student_id
+    if student_id is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
+        return
+    groups = (await session.scalars(
+        select(Group).join(GroupStudent).filter(GroupStudent.student_id == student_id))).all()
+    if not groups:
+        await message.answer("Вы не состоите ни в одной группе.")
+        return
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+                                                        [InlineKeyboardButton(text=g.name,
+                                                                              callback_data=f"select_program_{g.id}")]
+                                                        for g in groups
+                                                    ] + [[InlineKeyboardButton(text="Отмена",
+                                                                               callback_data="back_to_main")]])
+    await message.answer("Выберите группу, чтобы получить программу тренировок:", reply_markup=keyboard)
+    await state.set_state(ProgramSelection.waiting_for_group)
 
 
 @router.callback_query(F.data.startswith("select_program_"))
-async def handle_program_selection(callback: types.CallbackQuery, state: FSMContext):
+async def handle_program_selection(callback: types.CallbackQuery, state: FSMContext, session: AsyncSession):
     group_id = callback.data.split("_")[-1]
-    session = Session()
-    try:
-        group = session.query(Group).filter_by(id=group_id).first()
-        if not group:
-            await callback.answer("Группа не найдена.")
-            return
-        if not group.program_file:
-            await callback.answer("Для этой группы не загружена программа тренировок.")
-            return
-        await callback.message.delete()
-        await callback.message.answer_document(
-            document=types.FSInputFile(path=group.program_file),
-            caption=f"Программа тренировок для группы '{group.name}'"
-        )
-        await state.clear()
-    finally:
-        session.close()
+    group = await session.get(Group, int(group_id))
+    if not group:
+        await callback.answer("Группа не найдена.")
+        return
+    if not group.program_file:
+        await callback.answer("Для этой группы не загружена программа тренировок.")
+        return
+    await callback.message.delete()
+    await file_registry.registry.send(
+        session, callback.message.answer_document, group.program_file,
+        caption=f"Программа тренировок для группы '{group.name}'"
+    )
+    await state.clear()
     await callback.answer()
 
 
@@ -369,52 +358,44 @@ async def handle_nutrition(message: types.Message, state: FSMContext):
 
 
 @router.message(NutritionStates.waiting_for_nutrition_data, F.text | F.photo | F.document)
-async def handle_nutrition_data(message: types.Message, state: FSMContext):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
-            await state.clear()
-            return
-        progress = Progress(student_id=student.id, type='nutrition', date=datetime.datetime.now())
-        if message.text:
-            progress.content = message.text
-        elif message.photo:
-            file_id = message.photo[-1].file_id
-            file = await message.bot.get_file(file_id)
-            file_name = f"{int(time.time())}_nutrition_photo.jpg"
-            file_path = os.path.join("uploads", "nutrition", str(student.id), file_name)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            await message.bot.download_file(file.file_path, file_path)
-            progress.file_path = file_path
-        elif message.document:
-            file_id = message.document.file_id
-            file = await message.bot.get_file(file_id)
-            file_name = f"{int(time.time())}_{message.document.file_name}"
-            file_path = os.path.join("uploads", "nutrition", str(student.id), file_name)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            await message.bot.download_file(file.file_path, file_path)
-            progress.file_path = file_path
-        session.add(progress)
-        session.commit()
-        await message.answer("Информация о питании сохранена.", reply_markup=get_main_menu())
+async def handle_nutrition_data(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    student_id = identity.student_id
+    if student_id is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
         await state.clear()
-    finally:
-        session.close()
+        return
+    progress = Progress(student_id=student_id, type='nutrition', date=datetime.datetime.now())
+    if message.text:
+        progress.content = message.text
+    elif message.photo:
+        file_id = message.photo[-1].file_id
+        file = await message.bot.get_file(file_id)
+        file_name = f"{int(time.time())}_nutrition_photo.jpg"
+        file_path = os.path.join("uploads", "nutrition", str(student_id), file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        await message.bot.download_file(file.file_path, file_path)
+        progress.file_path = file_path
+    elif message.document:
+        file_id = message.document.file_id
+        file = await message.bot.get_file(file_id)
+        file_name = f"{int(time.time())}_{message.document.file_name}"
+        file_path = os.path.join("uploads", "nutrition", str(student_id), file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        await message.bot.download_file(file.file_path, file_path)
+        progress.file_path = file_path
+    session.add(progress)
+    await session.commit()
+    await message.answer("Информация о питании сохранена.", reply_markup=get_main_menu())
+    await state.clear()
 
 
 @router.message(F.text == "Прогресс")
-async def handle_progress(message: types.Message):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
-            return
-        await message.answer("Выберите действие:", reply_markup=get_progress_menu())
-    finally:
-        session.close()
+async def handle_progress(message: types.Message, identity: Identity):
+    student_id = identity.student_id
+    if student_id is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
+        return
+    await message.answer("Выберите действие:", reply_markup=get_progress_menu())
 
 
 @router.callback_query(F.data == "upload_training")
@@ -442,6 +423,7 @@ async def handle_upload_photo(callback: types.CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "back_to_progress")
 async def handle_back_to_progress(callback: types.CallbackQuery, state: FSMContext):
+    await ai_client.client.drop_dialogue(callback.from_user.id)
     await callback.message.delete()
     await callback.message.answer("Выберите действие:", reply_markup=get_progress_menu())
     await state.clear()
@@ -449,172 +431,143 @@ async def handle_back_to_progress(callback: types.CallbackQuery, state: FSMConte
 
 @router.callback_query(F.data == "back_to_main")
 async def handle_back_to_main(callback: types.CallbackQuery):
+    await ai_client.client.drop_dialogue(callback.from_user.id)
     await callback.message.delete()
     await callback.message.answer("Возвращаемся в главное меню:", reply_markup=get_main_menu())
     await callback.answer()
 
 
 @router.message(ProgressStates.waiting_for_training_data, F.document | F.text)
-async def handle_training_data(message: types.Message, state: FSMContext):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
-            await state.clear()
-            return
-        progress = Progress(student_id=student.id, type='training', date=datetime.datetime.now())
-        if message.document:
-            file_id = message.document.file_id
-            file = await message.bot.get_file(file_id)
-            file_name = f"{int(time.time())}_{message.document.file_name}"
-            file_path = os.path.join("uploads", "progress", str(student.id), file_name)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            await message.bot.download_file(file.file_path, file_path)
-            progress.file_path = file_path
-        elif message.text:
-            progress.content = message.text
-        session.add(progress)
-        session.commit()
-        await message.answer("Ваша тренировка сохранена.")
+async def handle_training_data(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    student_id = identity.student_id
+    if student_id is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
         await state.clear()
-    finally:
-        session.close()
+        return
+    progress = Progress(student_id=student_id, type='training', date=datetime.datetime.now())
+    if message.document:
+        file_id = message.document.file_id
+        file = await message.bot.get_file(file_id)
+        file_name = f"{int(time.time())}_{message.document.file_name}"
+        file_path = os.path.join("uploads", "progress", str(student_id), file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        await message.bot.download_file(file.file_path, file_path)
+        progress.file_path = file_path
+    elif message.text:
+        progress.content = message.text
+    session.add(progress)
+    await session.commit()
+    await message.answer("Ваша тренировка сохранена.")
+    await state.clear()
 
 
 @router.message(ProgressStates.waiting_for_photo, F.photo | F.document)
-async def handle_photo(message: types.Message, state: FSMContext):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
-            await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
-            await state.clear()
-            return
-        progress = Progress(student_id=student.id, type='photo', date=datetime.datetime.now())
-        if message.photo:
-            file_id = message.photo[-1].file_id
+async def handle_photo(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    student_id = identity.student_id
+    if student_id is None:
+        await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
+        await state.clear()
+        return
+    progress = Progress(student_id=student_id, type='photo', date=datetime.datetime.now())
+    if message.photo:
+        file_id = message.photo[-1].file_id
+        file = await message.bot.get_file(file_id)
+        file_name = f"{int(time.time())}_photo.jpg"
+        file_path = os.path.join("uploads", "progress", str(student_id), file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        await message.bot.download_file(file.file_path, file_path)
+        progress.file_path = file_path
+    elif message.document:
+        if message.document.mime_type.startswith('image/'):
+            file_id = message.document.file_id
             file = await message.bot.get_file(file_id)
-            file_name = f"{int(time.time())}_photo.jpg"
-            file_path = os.path.join("uploads", "progress", str(student.id), file_name)
+            file_name = f"{int(time.time())}_{message.document.file_name}"
+            file_path = os.path.join("uploads", "progress", str(student_id), file_name)
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
             await message.bot.download_file(file.file_path, file_path)
             progress.file_path = file_path
-        elif message.document:
-            if message.document.mime_type.startswith('image/'):
-                file_id = message.document.file_id
-                file = await message.bot.get_file(file_id)
-                file_name = f"{int(time.time())}_{message.document.file_name}"
-                file_path = os.path.join("uploads", "progress", str(student.id), file_name)
-                os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                await message.bot.download_file(file.file_path, file_path)
-                progress.file_path = file_path
-            else:
-                await message.answer("Пожалуйста, отправьте изображение.")
-                return
-        session.add(progress)
-        session.commit()
-        await message.answer("Ваше фото сохранено.")
-        await state.clear()
-    finally:
-        session.close()
+        else:
+            await message.answer("Пожалуйста, отправьте изображение.")
+            return
+    session.add(progress)
+    await session.commit()
+    await message.answer("Ваше фото сохранено.")
+    await state.clear()
 
 
-@router.callback_query(F.data == "view_training_history")
-async def handle_view_training_history(callback: types.CallbackQuery):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if not student:
-            await callback.answer("Вы не зарегистрированы.", show_alert=True)
-            return
-        entries = (
-            session.query(Progress)
-            .filter_by(student_id=student.id, type='training')
-            .order_by(Progress.date.desc())
-            .limit(20)
-            .all()
-        )
-        if not entries:
-            await callback.message.edit_text("У вас нет записей о тренировках.")
-            return
-        with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
-            zip_path = tmp.name
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            index_content = ""
-            for entry in entries:
-                if entry.content:
-                    fname = f"training_{entry.id}.txt"
-                    zipf.writestr(fname, entry.content)
-                elif entry.file_path:
-                    base = os.path.basename(entry.file_path)
-                    fname = f"training_{entry.id}_{base}"
-                    zipf.write(entry.file_path, fname)
-                index_content += (
-                    f"Entry ID: {entry.id}\n"
-                    f"Date: {entry.date}\n"
-                    f"File: {fname}\n\n"
-                )
-            zipf.writestr("index.txt", index_content)
-        await callback.message.delete()
-        await callback.bot.send_document(
-            chat_id=callback.from_user.id,
-            document=FSInputFile(zip_path, filename="training_history.zip"),
-            caption="Ваша история тренировок"
-        )
-        os.remove(zip_path)
-    finally:
-        session.close()
+EXPORT_KINDS = {
+    "training": ("Ваша история тренировок", "У вас нет записей о тренировках"),
+    "photo": ("Ваша история фото", "У вас нет загруженных фото"),
+}
+
+
+@router.callback_query(F.data.in_({"view_training_history", "view_photo_history"}))
+async def handle_view_history(callback: types.CallbackQuery):
+    kind = callback.data.split("_")[1]
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="За 30 дней", callback_data=f"export_{kind}_30"),
+         InlineKeyboardButton(text="За 90 дней", callback_data=f"export_{kind}_90")],
+        [InlineKeyboardButton(text="Вся история", callback_data=f"export_{kind}_all")],
+        [InlineKeyboardButton(text="Отмена", callback_data="back_to_progress")]
+    ])
+    await callback.message.edit_text("За какой период выгрузить историю?", reply_markup=keyboard)
     await callback.answer()
 
 
-@router.callback_query(F.data == "view_photo_history")
-async def handle_view_photo_history(callback: types.CallbackQuery):
-    session = Session()
-    try:
-        student = session.query(Student).filter_by(telegram_id=str(callback.from_user.id)).first()
-        if not student:
-            await callback.answer("Вы не зарегистрированы.", show_alert=True)
-            return
-        entries = (
-            session.query(Progress)
-            .filter_by(student_id=student.id, type='photo')
-            .order_by(Progress.date.desc())
-            .limit(20)
-            .all()
-        )
-        if not entries:
-            await callback.message.edit_text("У вас нет загруженных фото.")
-            return
-        with tempfile.NamedTemporaryFile(suffix=".zip", delete=False) as tmp:
-            zip_path = tmp.name
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            index_content = ""
-            for entry in entries:
-                if entry.file_path:
-                    base = os.path.basename(entry.file_path)
-                    fname = f"photo_{entry.id}_{base}"
-                    zipf.write(entry.file_path, fname)
-                    index_content += (
-                        f"Entry ID: {entry.id}\n"
-                        f"Date: {entry.date}\n"
-                        f"File: {fname}\n\n"
-                    )
-            zipf.writestr("index.txt", index_content)
-        await callback.message.delete()
-        await callback.bot.send_document(
+@router.callback_query(F.data.startswith("export_"))
+async def handle_export_history(callback: types.CallbackQuery, session: AsyncSession, identity: Identity):
+    _, kind, period = callback.data.split("_")
+    student_id = identity.student_id
+    if student_id is None:
+        await callback.answer("Вы не зарегистрированы.", show_alert=True)
+        return
+    caption, empty_text = EXPORT_KINDS[kind]
+    query = (
+        select(Progress.id, Progress.date, Progress.content, Progress.file_path)
+        .filter(Progress.student_id == student_id, Progress.type == kind)
+        .order_by(Progress.date)
+    )
+    if period != "all":
+        query = query.filter(Progress.date >= datetime.datetime.now() - datetime.timedelta(days=int(period)))
+    entries = [export.ExportEntry(*row) for row in (await session.execute(query)).all()]
+    if not entries:
+        await callback.message.edit_text(f"{empty_text} за выбранный период.")
+        await callback.answer()
+        return
+    await callback.message.edit_text("Готовим архив...")
+    await callback.answer()
+    archives = await export.exporter.get_archives(student_id, kind, entries)
+    await callback.message.delete()
+    for number, archive in enumerate(archives, 1):
+        filename = f"{kind}_history.zip" if len(archives) == 1 else f"{kind}_history_part{number}.zip"
+        sent = await callback.bot.send_document(
             chat_id=callback.from_user.id,
-            document=FSInputFile(zip_path, filename="photo_history.zip"),
-            caption="Ваша история фото"
+            document=export.exporter.file_id(archive) or FSInputFile(archive, filename=filename),
+            caption=caption if len(archives) == 1 else f"{caption} (часть {number} из {len(archives)})"
         )
-        os.remove(zip_path)
-    finally:
-        session.close()
-    await callback.answer()
+        export.exporter.remember_file_id(archive, sent.document.file_id)
+
+
+async def get_ai_unavailable_text(user_id):
+    status = await ai_client.client.status(user_id)
+    if not status["enabled"]:
+        return "ИИ-обзор отключен на этом сервере."
+    if status["ready"]:
+        return None
+    # The model failed to load or the AI service is unreachable: waiting for the warm-up will not help
+    if status.get("error"):
+        return AI_UNAVAILABLE_TEXT
+    return "ИИ-модель еще загружается (прогрев). Пожалуйста, попробуйте через пару минут."
 
 
 @router.callback_query(F.data == "ai_review")
 async def handle_ai_review(callback: types.CallbackQuery, state: FSMContext):
+    unavailable_text = await get_ai_unavailable_text(callback.from_user.id)
+    if unavailable_text:
+        await callback.answer(unavailable_text, show_alert=True)
+        return
+    # A new review always starts a fresh dialogue with up-to-date context
+    await ai_client.client.drop_dialogue(callback.from_user.id)
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Отмена", callback_data="back_to_progress")]
     ])
@@ -628,28 +581,80 @@ async def handle_ai_review(callback: types.CallbackQuery, state: FSMContext):
 
 @router.callback_query(F.data == "exit_ai_dialogue")
 async def handle_exit_ai_dialogue(callback: types.CallbackQuery, state: FSMContext):
+    await ai_client.client.drop_dialogue(callback.from_user.id)
     await callback.message.delete()
     await callback.message.answer("Вы вышли из диалога с ИИ.", reply_markup=get_main_menu())
     await state.clear()
     await callback.answer()
 
 
+async def stream_ai_reply(message, chunks, keyboard):
+    """
+    Отправляет ответ ИИ по мере генерации, редактируя одно сообщение не чаще AI_STREAM_EDIT_INTERVAL секунд.
+    Возвращает сгенерированный текст (пустой, если модель ничего не вернула).
+    """
+    reply = None
+    text = ""
+    shown_text = ""
+    last_edit = 0.0
+    async for chunk in chunks:
+        text += chunk
+        preview = clean_response(text)
+        if not preview or preview == shown_text or time.monotonic() - last_edit < AI_STREAM_EDIT_INTERVAL:
+            continue
+        if reply is None:
+            reply = await message.answer(preview + " ...")
+        else:
+            await reply.edit_text(preview + " ...")
+        shown_text = preview
+        last_edit = time.monotonic()
+    response = clean_response(text)
+    final_text = f"{response or 'Не удалось сформировать ответ.'}\n\n{AI_DIALOGUE_HINT}"
+    if reply is None:
+        await message.answer(final_text, reply_markup=keyboard)
+    else:
+        await reply.edit_text(final_text, reply_markup=keyboard)
+    return response
+
+
+async def generate_ai_reply(message, keyboard, training_history="", nutrition_history=""):
+    """
+    Генерирует и отправляет ответ ИИ. Продолжение диалога сервис выполняет с KV-кэшем пользователя.
+    """
+    chunks = ai_client.client.reply(message.from_user.id, message.text, training_history, nutrition_history,
+                                    stream=AI_STREAMING)
+    if AI_STREAMING:
+        return await stream_ai_reply(message, chunks, keyboard)
+    response = "".join([chunk async for chunk in chunks])
+    await message.answer(f"{response}\n\n{AI_DIALOGUE_HINT}", reply_markup=keyboard)
+    return response
+
+
 # Modified to support continuous AI dialogue without "Continue Dialogue" button
 @router.message(AIReviewStates.waiting_for_query, F.text)
-async def handle_ai_review_query(message: types.Message, state: FSMContext):
-    session = Session()
+async def handle_ai_review_query(message: types.Message, state: FSMContext, session: AsyncSession, identity: Identity):
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="Назад в прогресс", callback_data="back_to_progress")],
+        [InlineKeyboardButton(text="Назад в главное меню", callback_data="back_to_main")]
+    ])
+    unavailable_text = await get_ai_unavailable_text(message.from_user.id)
+    if unavailable_text:
+        await message.answer(unavailable_text, reply_markup=keyboard)
+        return
     try:
-        student = session.query(Student).filter_by(telegram_id=str(message.from_user.id)).first()
-        if not student:
+        student_id = identity.student_id
+        if student_id is None:
             await message.answer("Вы не зарегистрированы. Используйте /start для регистрации.")
             await state.clear()
             return
 
-        training_entry = session.query(Progress).filter_by(student_id=student.id, type='training').order_by(
-            Progress.date.desc()).first()
+        # The context is loaded for follow-up turns too: if the dialogue session has expired,
+        # the AI service rebuilds the full prompt from it
+        training_entry = await session.scalar(select(Progress).filter_by(
+            student_id=student_id, type='training').order_by(Progress.date.desc()))
         # Fetch only the most recent nutrition entry
-        nutrition_entry = session.query(Progress).filter_by(student_id=student.id, type='nutrition').order_by(
-            Progress.date.desc()).first()
+        nutrition_entry = await session.scalar(select(Progress).filter_by(
+            student_id=student_id, type='nutrition').order_by(Progress.date.desc()))
 
         training_history = (
             f"Training: {truncate_text(training_entry.content or extract_text_from_file(training_entry.file_path))}"
@@ -659,33 +664,25 @@ async def handle_ai_review_query(message: types.Message, state: FSMContext):
             f"Food: {truncate_text(nutrition_entry.content or extract_text_from_file(nutrition_entry.file_path))}"
             if nutrition_entry else "No data."
         )
-
-        knowledge_base_summary = ai_model.get_knowledge_base_summary(word_limit=1000)
-
-        loop = asyncio.get_running_loop()
-        response = await loop.run_in_executor(None, ai_model.generate_response, str(training_history), str(nutrition_history), str(knowledge_base_summary), str(message.text), 2**13)
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="Назад в прогресс", callback_data="back_to_progress")],
-            [InlineKeyboardButton(text="Назад в главное меню", callback_data="back_to_main")]
-        ])
-        await message.answer(
-            f"{response}\n\nВы можете продолжить диалог, отправив еще один запрос, или вернуться в меню.",
-            reply_markup=keyboard
-        )
+        # Knowledge base retrieval, the response cache, the dialogue KV cache and generation happen in the AI service
+        try:
+            await generate_ai_reply(message, keyboard, training_history, nutrition_history)
+        except ai_client.InferenceQueueFull:
+            await message.answer("Сейчас слишком много запросов к ИИ. Пожалуйста, попробуйте через минуту.")
+            return
+        except ai_client.AIServiceUnavailable:
+            # No replica is reachable: the dialogue state is kept, the user can retry later
+            await message.answer(AI_UNAVAILABLE_TEXT, reply_markup=keyboard)
+            return
         # State is not cleared to allow further queries
 
     except Exception as e:
         await message.answer(
             f"Произошла ошибка при обработке запроса: {str(e)}. Пожалуйста, попробуйте снова позже.",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                [InlineKeyboardButton(text="Назад в прогресс", callback_data="back_to_progress")],
-                [InlineKeyboardButton(text="Назад в главное меню", callback_data="back_to_main")]
-            ])
+            reply_markup=keyboard
         )
+        await ai_client.client.drop_dialogue(message.from_user.id)
         await state.clear()
-    finally:
-        session.close()
 
 # Added handler for continuing AI dialogue
 @router.callback_query(F.data == "continue_ai_dialogue")
@@ -704,19 +701,5 @@ async def handle_continue_ai_dialogue(callback: types.CallbackQuery, state: FSMC
 
 
 @router.message(~IsAdmin(), F.text == "База знаний")
-async def handle_knowledge_base(message: types.Message):
-    session = Session()
-    try:
-        materials = session.query(KnowledgeBase).all()
-        if not materials:
-            await message.answer("База знаний пуста.")
-            return
-        for material in materials:
-            if material.type == 'text':
-                await message.answer(material.content)
-            elif material.type == 'file':
-                await message.answer_document(FSInputFile(material.file_path))
-            elif material.type == 'image':
-                await message.answer_photo(FSInputFile(material.file_path))
-    finally:
-        session.close()
+async def handle_knowledge_base(message: types.Message, state: FSMContext, session: AsyncSession):
+    await show_knowledge_page(message, session, state, MODE_VIEW)
@@ -0,0 +1,87 @@
+import os
+import time
+import asyncio
+import logging
+from dotenv import load_dotenv
+from sqlalchemy import select
+from database import AsyncSessionLocal
+from models import Student, Trainer
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Через сколько секунд перечитывать тренеров и учеников из БД (изменения, внесенные в обход бота)
+IDENTITY_CACHE_TTL = int(os.getenv("IDENTITY_CACHE_TTL", "300"))
+
+ROLE_TRAINER = "trainer"
+ROLE_STUDENT = "student"
+
+
+class Identity:
+    """
+    Роль пользователя и первичный ключ его записи (Trainer.id или Student.id).
+    """
+
+    __slots__ = ("telegram_id", "role", "trainer_id", "student_id")
+
+    def __init__(self, telegram_id, trainer_id=None, student_id=None):
+        self.telegram_id = str(telegram_id)
+        self.trainer_id = trainer_id
+        self.student_id = student_id
+        if trainer_id is not None:
+            self.role = ROLE_TRAINER
+        elif student_id is not None:
+            self.role = ROLE_STUDENT
+        else:
+            self.role = None
+
+    @property
+    def is_trainer(self):
+        return self.role == ROLE_TRAINER
+
+    def __repr__(self):
+        return f"Identity({self.telegram_id}, role={self.role})"
+
+
+class IdentityCache:
+    """
+    Telegram ID тренеров и учеников с их первичными ключами. Загружается из БД один раз
+    и перечитывается после invalidate() или по истечении IDENTITY_CACHE_TTL, поэтому
+    определение роли для апдейта не обращается к БД.
+    """
+
+    def __init__(self, ttl=IDENTITY_CACHE_TTL):
+        self.ttl = ttl
+        self._trainers = {}
+        self._students = {}
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def _load(self):
+        async with AsyncSessionLocal() as session:
+            trainers = (await session.execute(select(Trainer.telegram_id, Trainer.id))).all()
+            students = (await session.execute(select(Student.telegram_id, Student.id))).all()
+        self._trainers = {str(telegram_id): pk for telegram_id, pk in trainers}
+        self._students = {str(telegram_id): pk for telegram_id, pk in students}
+        self._loaded_at = time.monotonic()
+        logger.info(f"Identity cache loaded: {len(self._trainers)} trainers, {len(self._students)} students")
+
+    async def resolve(self, telegram_id):
+        if not self._is_fresh():
+            async with self._lock:
+                if not self._is_fresh():
+                    await self._load()
+        telegram_id = str(telegram_id)
+        return Identity(telegram_id, self._trainers.get(telegram_id), self._students.get(telegram_id))
+
+    def add_student(self, telegram_id, student_id):
+        self._students[str(telegram_id)] = student_id
+
+    def invalidate(self):
+        self._loaded_at = None
+
+
+cache = IdentityCache()
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import ai_model
+import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+AI_QUEUE_MAXSIZE = int(os.getenv("AI_QUEUE_MAXSIZE", "64"))
+AI_BATCH_SIZE = int(os.getenv("AI_BATCH_SIZE", "8"))
+AI_BATCH_WAIT_MS = int(os.getenv("AI_BATCH_WAIT_MS", "50"))
+
+
+class InferenceQueueFull(Exception):
+    pass
+
+
+def count_tokens(text):
+    if not text or not isinstance(text, str) or not ai_model.is_ready():
+        return 0
+    return ai_model.get_token_count(text)
+
+
+class InferenceStats:
+    """
+    Хранит задержки последних запросов: ожидание в очереди, время генерации и полное время ответа.
+    """
+
+    def __init__(self, window=500):
+        self.queue_wait = deque(maxlen=window)
+        self.inference = deque(maxlen=window)
+        self.total = deque(maxlen=window)
+        self.first_token = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.rejected = 0
+
+    def record(self, queue_wait, inference, total, tokens=0):
+        self.requests += 1
+        self.queue_wait.append(queue_wait)
+        self.inference.append(inference)
+        self.total.append(total)
+        metrics.record_generation(queue_wait, inference, tokens)
+
+    @staticmethod
+    def _percentile(values, q):
+        if not values:
+            return 0.0
+        ordered = sorted(values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self):
+        return {
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "avg_batch_size": sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0.0,
+            "queue_wait_p50": self._percentile(self.queue_wait, 0.5),
+            "queue_wait_p95": self._percentile(self.queue_wait, 0.95),
+            "latency_p50": self._percentile(self.total, 0.5),
+            "latency_p95": self._percentile(self.total, 0.95),
+            "first_token_p50": self._percentile(self.first_token, 0.5),
+            "first_token_p95": self._percentile(self.first_token, 0.95),
+        }
+
+
+class InferenceWorker:
+    """
+    Очередь запросов к модели: собирает одновременные промпты в течение короткого окна,
+    генерирует ответы одним пакетным вызовом и возвращает каждый результат своему обработчику.
+    """
+
+    def __init__(self, max_queue=AI_QUEUE_MAXSIZE, max_batch_size=AI_BATCH_SIZE, max_wait_ms=AI_BATCH_WAIT_MS):
+        self.max_queue = max_queue
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = InferenceStats()
+        self._queue = None
+        self._task = None
+        self._streams = 0
+        # Один поток, чтобы вызовы model.generate не конкурировали за CPU
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="inference")
+
+    async def start(self):
+        if self._task is None:
+            self._queue = asyncio.Queue(maxsize=self.max_queue)
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"Inference worker started: batch={self.max_batch_size}, "
+                        f"wait={self.max_wait * 1000:.0f}ms, queue={self.max_queue}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._executor.shutdown(wait=False)
+
+    async def submit(self, prompt_ids):
+        """
+        Ставит токены промпта (см. ai_model.build_prompt_ids) в очередь и ждет ответ модели.
+        """
+        if self._task is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((prompt_ids, future, time.perf_counter()))
+        except asyncio.QueueFull:
+            self.stats.rejected += 1
+            raise InferenceQueueFull("AI queue is full")
+        return await future
+
+    def _reserve_exclusive(self):
+        if self._streams + self._queue.qsize() >= self.max_queue:
+            self.stats.rejected += 1
+            raise InferenceQueueFull("AI queue is full")
+
+    async def run(self, func, *args):
+        """
+        Выполняет отдельную генерацию (например, ход диалога с KV-кэшем) вне пакетов,
+        в том же потоке, что и пакетная генерация.
+        """
+        if self._task is None:
+            await self.start()
+        self._reserve_exclusive()
+        loop = asyncio.get_running_loop()
+        enqueued = time.perf_counter()
+        timings = {}
+
+        def call():
+            timings["started"] = time.perf_counter()
+            return func(*args)
+
+        self._streams += 1
+        try:
+            result = await loop.run_in_executor(self._executor, call)
+        finally:
+            self._streams -= 1
+        finished = time.perf_counter()
+        started = timings.get("started", enqueued)
+        self.stats.record(started - enqueued, finished - started, finished - enqueued, count_tokens(result))
+        return result
+
+    async def stream(self, prompt_ids, generate=None):
+        """
+        Асинхронно отдает фрагменты ответа по мере генерации. Потоковые запросы не объединяются в пакеты,
+        но выполняются в том же потоке, что и пакетная генерация, и учитываются в лимите очереди.
+
+        generate(prompt_ids, on_text) — функция генерации, по умолчанию ai_model.generate_stream.
+        """
+        if self._task is None:
+            await self.start()
+        self._reserve_exclusive()
+        generate = generate or ai_model.generate_stream
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue()
+        enqueued = time.perf_counter()
+        timings = {}
+
+        def on_text(text):
+            loop.call_soon_threadsafe(chunks.put_nowait, text)
+
+        def call():
+            timings["started"] = time.perf_counter()
+            generate(prompt_ids, on_text)
+
+        self._streams += 1
+        future = loop.run_in_executor(self._executor, call)
+        future.add_done_callback(lambda _: chunks.put_nowait(None))
+        first_token = None
+        streamed = []
+        try:
+            while True:
+                text = await chunks.get()
+                if text is None:
+                    break
+                if first_token is None:
+                    first_token = time.perf_counter() - enqueued
+                    self.stats.first_token.append(first_token)
+                streamed.append(text)
+                yield text
+            await future
+        finally:
+            self._streams -= 1
+        finished = time.perf_counter()
+        started = timings.get("started", enqueued)
+        self.stats.record(started - enqueued, finished - started, finished - enqueued,
+                          count_tokens("".join(streamed)))
+        logger.info(f"AI stream served: queue_wait={started - enqueued:.3f}s, "
+                    f"first_token={first_token or 0:.3f}s, total={finished - enqueued:.3f}s")
+
+    async def _collect_batch(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # Пропускаем запросы, обработчики которых уже отменены
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            prompts = [prompt for prompt, _, _ in batch]
+            started = time.perf_counter()
+            try:
+                responses = await loop.run_in_executor(self._executor, ai_model.generate_batch, prompts)
+            except Exception as e:
+                logger.error(f"Batch generation failed: {str(e)}")
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+            self.stats.batch_sizes.append(len(batch))
+            for (_, future, enqueued), response in zip(batch, responses):
+                self.stats.record(started - enqueued, finished - started, finished - enqueued,
+                                  count_tokens(response))
+                logger.info(f"AI request served: queue_wait={started - enqueued:.3f}s, "
+                            f"inference={finished - started:.3f}s, batch={len(batch)}")
+                if not future.done():
+                    future.set_result(response)
+
+
+worker = InferenceWorker()
@@ -0,0 +1,158 @@
+import os
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from dotenv import load_dotenv
+from sqlalchemy import select
+from database import AsyncSessionLocal
+from models import KnowledgeBase
+import knowledge_cache
+import ai_client
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+
+STATUS_PROCESSING = "processing"
+STATUS_READY = "ready"
+STATUS_FAILED = "failed"
+
+
+def file_hash(file_path):
+    """
+    sha256 содержимого файла, читается блоками.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def text_hash(text):
+    return hashlib.sha256(" ".join(text.split()).encode("utf-8")).hexdigest()
+
+
+def extract_pages(file_path):
+    """
+    Извлекает текст постранично. Выполняется в отдельном процессе, поэтому разбор большого PDF
+    не занимает ни цикл событий, ни GIL основного процесса. Возвращает (текст, число страниц).
+    """
+    if file_path.endswith('.pdf'):
+        import PyPDF2
+        pages = []
+        with open(file_path, 'rb') as f:
+            reader = PyPDF2.PdfReader(f)
+            for page in reader.pages:
+                pages.append(page.extract_text() or "")
+        return "\n".join(pages), len(pages)
+    if file_path.endswith('.txt'):
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+            return f.read(), 1
+    return "", 0
+
+
+async def find_duplicate(session, content_hash):
+    return await session.scalar(select(KnowledgeBase).filter_by(content_hash=content_hash))
+
+
+class IngestionPipeline:
+    """
+    Фоновая обработка загруженных материалов базы знаний: извлечение текста в пуле процессов,
+    разбиение на чанки и эмбеддинги в потоке, затем обновление строки (status=ready) и сообщение
+    тренеру. Материалы, оставшиеся в статусе processing после перезапуска, обрабатываются заново.
+    """
+
+    def __init__(self, workers=INGEST_WORKERS):
+        self.workers = workers
+        self._bot = None
+        self._queue = None
+        self._tasks = []
+        self._executor = None
+
+    async def start(self, bot, primary_worker=True):
+        if self._tasks:
+            return
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        # spawn: к моменту запуска в процессе уже есть потоки (загрузка модели), fork с ними небезопасен
+        self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                             mp_context=multiprocessing.get_context("spawn"))
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        # Незавершенные материалы возобновляет один процесс, чтобы они не обрабатывались дважды
+        pending = []
+        if primary_worker:
+            async with AsyncSessionLocal() as session:
+                pending = (await session.scalars(
+                    select(KnowledgeBase.id).filter_by(status=STATUS_PROCESSING))).all()
+        for material_id in pending:
+            self._queue.put_nowait(material_id)
+        logger.info(f"Ingestion pipeline started: {self.workers} workers, {len(pending)} materials resumed")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def submit(self, material_id):
+        self._queue.put_nowait(material_id)
+
+    async def _run(self):
+        while True:
+            material_id = await self._queue.get()
+            try:
+                await self._process(material_id)
+            except Exception as e:
+                logger.error(f"Ingestion of material {material_id} failed: {str(e)}")
+                await self._finish(material_id, STATUS_FAILED,
+                                   f"Не удалось обработать материал: {str(e)}")
+
+    async def _process(self, material_id):
+        loop = asyncio.get_running_loop()
+        async with AsyncSessionLocal() as session:
+            material = await session.get(KnowledgeBase, material_id)
+            if material is None or material.status != STATUS_PROCESSING:
+                return
+            file_path = material.file_path
+        text, pages = await loop.run_in_executor(self._executor, extract_pages, file_path)
+        # Векторный индекс принадлежит процессу с моделью (бот или сервис инференса)
+        chunks = await ai_client.client.index_material(material_id, text)
+        async with AsyncSessionLocal() as session:
+            material = await session.get(KnowledgeBase, material_id)
+            if material is None:
+                return
+            material.text_content = text
+            await session.commit()
+        knowledge_cache.cache.invalidate(material_id)
+        summary = f"страниц: {pages}" + (f", фрагментов в поиске: {chunks}" if chunks else "")
+        await self._finish(material_id, STATUS_READY, f"Материал обработан и добавлен в базу знаний ({summary}).")
+
+    async def _finish(self, material_id, status, text):
+        async with AsyncSessionLocal() as session:
+            material = await session.get(KnowledgeBase, material_id)
+            if material is None:
+                return
+            material.status = status
+            await session.commit()
+            chat_id = material.uploaded_by
+            title = material.title or os.path.basename(material.file_path or "")
+        logger.info(f"Material {material_id} ingestion finished: {status}")
+        if chat_id and self._bot is not None:
+            try:
+                await self._bot.send_message(chat_id, f"«{title}»: {text}")
+            except Exception as e:
+                logger.warning(f"Failed to notify about material {material_id}: {str(e)}")
+
+
+pipeline = IngestionPipeline()
@@ -0,0 +1,138 @@
+import os
+import logging
+import threading
+from collections import OrderedDict
+import PyPDF2
+from sqlalchemy import func
+from dotenv import load_dotenv
+from database import Session
+from models import KnowledgeBase
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+KNOWLEDGE_CACHE_SIZE = int(os.getenv("KNOWLEDGE_CACHE_SIZE", "256"))
+
+
+def extract_text(file_path):
+    """
+    Извлекает текст из PDF или TXT файла. Изображения и прочие файлы игнорируются.
+    """
+    if file_path.endswith('.pdf'):
+        with open(file_path, 'rb') as f:
+            reader = PyPDF2.PdfReader(f)
+            return "\n".join(page.extract_text() or "" for page in reader.pages)
+    elif file_path.endswith('.txt'):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return f.read()
+    return ""
+
+
+def file_fingerprint(file_path):
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+class KnowledgeTextCache:
+    """
+    LRU-кэш извлеченного текста материалов базы знаний и готовой сводки.
+
+    Текст материала берется из колонки text_content (заполняется при загрузке), а если ее нет —
+    извлекается из файла один раз и сохраняется обратно в БД. В памяти ключ — (id материала,
+    mtime и размер файла), поэтому замененный файл будет прочитан заново.
+    Сводка пересобирается только после добавления или удаления материалов.
+    """
+
+    def __init__(self, max_size=KNOWLEDGE_CACHE_SIZE):
+        self.max_size = max_size
+        self._texts = OrderedDict()
+        self._lock = threading.Lock()
+        self._summaries = {}
+        self._summary_signature = None
+
+    def _get_cached(self, key):
+        with self._lock:
+            if key in self._texts:
+                self._texts.move_to_end(key)
+                return self._texts[key]
+        return None
+
+    def _put(self, key, text):
+        with self._lock:
+            self._texts[key] = text
+            self._texts.move_to_end(key)
+            while len(self._texts) > self.max_size:
+                self._texts.popitem(last=False)
+
+    def get_material_text(self, material, session=None):
+        """
+        Возвращает текст материала, не перечитывая файл, если он уже был извлечен.
+        """
+        if material.type == 'text':
+            return material.content or ""
+        if material.type != 'file' or not material.file_path:
+            return ""
+        try:
+            key = (material.id,) + file_fingerprint(material.file_path)
+        except OSError:
+            # Файл удален с диска — используем сохраненный текст, если он есть
+            return material.text_content or ""
+        text = self._get_cached(key)
+        if text is not None:
+            return text
+        text = material.text_content
+        if text is None:
+            try:
+                text = extract_text(material.file_path)
+            except Exception as e:
+                logger.warning(f"Failed to read {material.file_path}: {str(e)}")
+                text = ""
+            if session is not None:
+                material.text_content = text
+                session.commit()
+        self._put(key, text)
+        return text
+
+    def invalidate(self, material_id=None):
+        """
+        Сбрасывает сводку (и текст материала, если передан его id). Вызывается при изменении базы знаний.
+        """
+        with self._lock:
+            if material_id is not None:
+                for key in [k for k in self._texts if k[0] == material_id]:
+                    del self._texts[key]
+            self._summaries = {}
+            self._summary_signature = None
+
+    @staticmethod
+    def _signature(session):
+        # Дешевая проверка вместо загрузки всех материалов: изменилось ли количество или максимальный id
+        return session.query(func.count(KnowledgeBase.id), func.max(KnowledgeBase.id)).one()
+
+    def get_summary(self, word_limit=1000):
+        session = Session()
+        try:
+            signature = self._signature(session)
+            if signature != self._summary_signature:
+                with self._lock:
+                    self._summaries = {}
+                    self._summary_signature = signature
+            if word_limit in self._summaries:
+                return self._summaries[word_limit]
+            materials = session.query(KnowledgeBase).order_by(KnowledgeBase.id).all()
+            summary = ""
+            for material in materials:
+                text = self.get_material_text(material, session)
+                if text:
+                    summary += text + "\n"
+            words = summary.split()
+            if len(words) > word_limit:
+                summary = " ".join(words[:word_limit]) + "..."
+            logger.info(f"Rebuilt knowledge base summary with {len(words)} words")
+            self._summaries[word_limit] = summary
+            return summary
+        finally:
+            session.close()
+
+
+cache = KnowledgeTextCache()
@@ -0,0 +1,176 @@
+import os
+import json
+import logging
+import threading
+from dotenv import load_dotenv
+from database import Session
+from models import KnowledgeBase
+import knowledge_cache
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+KNOWLEDGE_INDEX_DIR = os.getenv("KNOWLEDGE_INDEX_DIR", os.path.join("uploads", "index"))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2")
+CHUNK_WORDS = int(os.getenv("KNOWLEDGE_CHUNK_WORDS", "120"))
+CHUNK_OVERLAP = int(os.getenv("KNOWLEDGE_CHUNK_OVERLAP", "20"))
+
+# id чанка = id материала * MAX_CHUNKS + номер чанка, чтобы удалять материал диапазоном id
+MAX_CHUNKS = 100000
+
+
+def split_into_chunks(text, chunk_words=CHUNK_WORDS, overlap=CHUNK_OVERLAP):
+    """
+    Делит текст на чанки по chunk_words слов с перекрытием overlap слов.
+    """
+    words = text.split()
+    if not words:
+        return []
+    step = max(1, chunk_words - overlap)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + chunk_words]))
+        if start + chunk_words >= len(words):
+            break
+    return chunks[:MAX_CHUNKS]
+
+
+class KnowledgeIndex:
+    """
+    Векторный индекс FAISS по чанкам материалов базы знаний, сохраняемый на диск.
+    Обновляется инкрементально при добавлении и удалении материалов.
+    """
+
+    def __init__(self, index_dir=KNOWLEDGE_INDEX_DIR, model_name=EMBEDDING_MODEL):
+        self.index_dir = index_dir
+        self.model_name = model_name
+        self.index_path = os.path.join(index_dir, "knowledge.faiss")
+        self.chunks_path = os.path.join(index_dir, "chunks.json")
+        self._lock = threading.RLock()
+        self._embedder = None
+        self._index = None
+        self._chunks = {}
+
+    @staticmethod
+    def available():
+        try:
+            import faiss  # noqa: F401
+            import sentence_transformers  # noqa: F401
+            return True
+        except ImportError:
+            return False
+
+    def _get_embedder(self):
+        if self._embedder is None:
+            from sentence_transformers import SentenceTransformer
+            self._embedder = SentenceTransformer(self.model_name)
+            logger.info(f"Loaded embedding model: {self.model_name}")
+        return self._embedder
+
+    def embed(self, texts):
+        import numpy as np
+        vectors = self._get_embedder().encode(texts, normalize_embeddings=True, show_progress_bar=False)
+        return np.asarray(vectors, dtype="float32")
+
+    def _new_index(self):
+        import faiss
+        dim = self._get_embedder().get_sentence_embedding_dimension()
+        return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+    def _save(self):
+        import faiss
+        os.makedirs(self.index_dir, exist_ok=True)
+        faiss.write_index(self._index, self.index_path)
+        with open(self.chunks_path, 'w', encoding='utf-8') as f:
+            json.dump(self._chunks, f, ensure_ascii=False)
+
+    def load(self):
+        """
+        Загружает индекс с диска и синхронизирует его с таблицей knowledge_base.
+        """
+        import faiss
+        with self._lock:
+            if self._index is not None:
+                return
+            if os.path.exists(self.index_path) and os.path.exists(self.chunks_path):
+                self._index = faiss.read_index(self.index_path)
+                with open(self.chunks_path, 'r', encoding='utf-8') as f:
+                    self._chunks = json.load(f)
+            else:
+                self._index = self._new_index()
+                self._chunks = {}
+            self.sync()
+
+    def sync(self):
+        """
+        Добавляет в индекс отсутствующие материалы и удаляет чанки удаленных.
+        """
+        session = Session()
+        try:
+            materials = session.query(KnowledgeBase).all()
+            indexed_ids = {chunk["material_id"] for chunk in self._chunks.values()}
+            current_ids = {m.id for m in materials}
+            for material_id in indexed_ids - current_ids:
+                self.remove_material(material_id, save=False)
+            for material in materials:
+                if material.id not in indexed_ids:
+                    text = knowledge_cache.cache.get_material_text(material, session)
+                    self.add_material(material.id, text, save=False)
+            self._save()
+        finally:
+            session.close()
+
+    def add_material(self, material_id, text, save=True):
+        import numpy as np
+        with self._lock:
+            if self._index is None:
+                self.load()
+            chunks = split_into_chunks(text or "")
+            if not chunks:
+                return 0
+            ids = np.array([material_id * MAX_CHUNKS + i for i in range(len(chunks))], dtype="int64")
+            self._index.add_with_ids(self.embed(chunks), ids)
+            for chunk_id, chunk in zip(ids.tolist(), chunks):
+                self._chunks[str(chunk_id)] = {"material_id": material_id, "text": chunk}
+            if save:
+                self._save()
+            logger.info(f"Indexed material {material_id}: {len(chunks)} chunks")
+            return len(chunks)
+
+    def remove_material(self, material_id, save=True):
+        import faiss
+        with self._lock:
+            if self._index is None:
+                self.load()
+            selector = faiss.IDSelectorRange(material_id * MAX_CHUNKS, (material_id + 1) * MAX_CHUNKS)
+            self._index.remove_ids(selector)
+            self._chunks = {k: v for k, v in self._chunks.items() if v["material_id"] != material_id}
+            if save:
+                self._save()
+
+    def search(self, query, top_k=4, token_budget=400, count_tokens=None):
+        """
+        Возвращает до top_k наиболее близких к запросу чанков, суммарно не превышающих token_budget.
+        """
+        count_tokens = count_tokens or (lambda text: len(text.split()))
+        with self._lock:
+            if self._index is None:
+                self.load()
+            if self._index.ntotal == 0:
+                return []
+            scores, ids = self._index.search(self.embed([query]), top_k)
+            results = []
+            used = 0
+            for chunk_id in ids[0].tolist():
+                chunk = self._chunks.get(str(chunk_id))
+                if chunk is None:
+                    continue
+                tokens = count_tokens(chunk["text"])
+                if used + tokens > token_budget:
+                    continue
+                used += tokens
+                results.append(chunk["text"])
+            return results
+
+
+index = KnowledgeIndex()
@@ -0,0 +1,114 @@
+import re
+import logging
+from sqlalchemy import text, column, Integer
+from database import engine, Session
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = "knowledge_fts"
+BODY = "coalesce({row}.content, '') || ' ' || coalesce({row}.text_content, '')"
+
+FTS_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(title, body, tokenize='unicode61 remove_diacritics 2')",
+    f"""CREATE TRIGGER IF NOT EXISTS knowledge_fts_insert AFTER INSERT ON knowledge_base BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, title, body) VALUES (new.id, coalesce(new.title, ''), {BODY.format(row='new')});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS knowledge_fts_delete AFTER DELETE ON knowledge_base BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS knowledge_fts_update AFTER UPDATE ON knowledge_base BEGIN
+        DELETE FROM {FTS_TABLE} WHERE rowid = old.id;
+        INSERT INTO {FTS_TABLE}(rowid, title, body) VALUES (new.id, coalesce(new.title, ''), {BODY.format(row='new')});
+    END""",
+]
+
+# Материалы, добавленные до появления индекса
+FTS_BACKFILL = f"""
+    INSERT INTO {FTS_TABLE}(rowid, title, body)
+    SELECT kb.id, coalesce(kb.title, ''), {BODY.format(row='kb')} FROM knowledge_base AS kb
+    WHERE kb.id NOT IN (SELECT rowid FROM {FTS_TABLE})
+"""
+
+# bm25 с весами колонок: совпадение в названии важнее совпадения в тексте
+SEARCH_SQL = f"""
+    SELECT rowid, snippet({FTS_TABLE}, 1, '', '', ' … ', :snippet_tokens) AS snippet
+    FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query
+    ORDER BY bm25({FTS_TABLE}, 5.0, 1.0) LIMIT :limit
+"""
+
+
+def available():
+    return engine.dialect.name == "sqlite"
+
+
+def create_index(connection):
+    """
+    Создает FTS5-индекс по названиям и тексту материалов и триггеры, поддерживающие его
+    при вставке, изменении и удалении строк knowledge_base. Вызывается из миграции.
+    """
+    if not available():
+        logger.info("Full-text search requires SQLite FTS5, knowledge search will use LIKE")
+        return
+    for statement in FTS_DDL:
+        connection.execute(text(statement))
+    connection.execute(text(FTS_BACKFILL))
+
+
+def to_match_query(query):
+    """
+    Превращает пользовательский ввод в безопасное выражение FTS5: слова в кавычках
+    с поиском по префиксу, объединенные через OR (ранжирование выполняет bm25).
+    """
+    words = re.findall(r"\w+", query.lower())[:10]
+    return " OR ".join(f'"{word}"*' for word in words)
+
+
+def match_ids(query):
+    """
+    Подзапрос id материалов, совпадающих с запросом, — для фильтра в SQLAlchemy-запросах.
+    """
+    return text(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :query").bindparams(
+        query=to_match_query(query)).columns(column("rowid", Integer))
+
+
+async def search(session, query, limit=10, snippet_tokens=24):
+    """
+    Материалы, ранжированные по BM25: список пар (id, фрагмент текста с совпадением).
+    """
+    match = to_match_query(query)
+    if not match:
+        return []
+    rows = await session.execute(text(SEARCH_SQL), {"query": match, "limit": limit,
+                                                    "snippet_tokens": snippet_tokens})
+    return [(material_id, snippet) for material_id, snippet in rows.all()]
+
+
+def search_sync(query, limit=4, snippet_tokens=48):
+    """
+    Синхронный вариант search() для фоновых потоков (сборка контекста для ИИ).
+    """
+    match = to_match_query(query)
+    if not match or not available():
+        return []
+    session = Session()
+    try:
+        rows = session.execute(text(SEARCH_SQL), {"query": match, "limit": limit,
+                                                  "snippet_tokens": snippet_tokens})
+        return [(material_id, snippet) for material_id, snippet in rows.all()]
+    finally:
+        session.close()
+
+
+def lexical_context(query, top_k=4, token_budget=400, count_tokens=None):
+    """
+    Лексический ретривер для ИИ: фрагменты лучших по BM25 материалов в пределах token_budget.
+    """
+    count_tokens = count_tokens or (lambda fragment: len(fragment.split()))
+    results, used = [], 0
+    for _, snippet in search_sync(query, limit=top_k):
+        tokens = count_tokens(snippet)
+        if not snippet.strip() or used + tokens > token_budget:
+            continue
+        used += tokens
+        results.append(snippet)
+    return results
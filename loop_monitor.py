@@ -0,0 +1,178 @@
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+import traceback
+from dotenv import load_dotenv
+import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+# Режим диагностики: постоянное измерение задержки event loop и поиск блокирующих вызовов
+LOOP_MONITOR = os.getenv("LOOP_MONITOR", "0").lower() in ("1", "true", "yes")
+LOOP_MONITOR_INTERVAL_MS = int(os.getenv("LOOP_MONITOR_INTERVAL_MS", "50"))
+# Задержка, начиная с которой снимается стек и обработчик считается блокирующим
+LOOP_LAG_THRESHOLD_MS = int(os.getenv("LOOP_LAG_THRESHOLD_MS", "100"))
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+HANDLERS_DIR = os.path.join(ROOT, "handlers")
+STACK_LIMIT = 12
+
+loop_lag = metrics.registry.histogram("bot_event_loop_lag_seconds", "Event loop scheduling delay")
+loop_blocks = metrics.registry.counter("bot_event_loop_blocks_total",
+                                       "Event loop stalls over the threshold by blocking site", ("site",))
+
+
+def blocking_site(frame):
+    """
+    Место блокировки по стеку потока event loop: внешний кадр из handlers/ (сам обработчик),
+    иначе самый внутренний кадр кода бота. Возвращает (имя, отформатированный стек).
+    """
+    stack = traceback.extract_stack(frame)
+    start = None
+    for index, entry in enumerate(stack):
+        if entry.filename.startswith(HANDLERS_DIR):
+            start = index
+            break
+    if start is None:
+        own = [index for index, entry in enumerate(stack)
+               if entry.filename.startswith(ROOT) and entry.filename != __file__]
+        start = own[-1] if own else len(stack) - 1
+    entry = stack[start]
+    filename = os.path.relpath(entry.filename, ROOT) if entry.filename.startswith(ROOT) \
+        else os.path.basename(entry.filename)
+    site = f"{filename}:{entry.name}"
+    return site, "".join(traceback.format_list(stack[start:][-STACK_LIMIT:]))
+
+
+class Offender:
+    __slots__ = ("site", "count", "total", "worst", "stack")
+
+    def __init__(self, site):
+        self.site = site
+        self.count = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.stack = ""
+
+
+class LoopMonitor:
+    """
+    Задача в event loop просыпается каждые interval секунд и измеряет, насколько позже срока
+    ее разбудили. Сторожевой поток следит за временем последнего пробуждения: если loop не
+    отвечает уже половину threshold, он снимает стек потока loop (sys._current_frames) —
+    в этот момент там выполняется блокирующий код. Когда loop отпускает и задержка достигла
+    threshold, она приписывается снятому месту и попадает в лог, метрики и команду /lag.
+    """
+
+    def __init__(self, interval_ms=LOOP_MONITOR_INTERVAL_MS, threshold_ms=LOOP_LAG_THRESHOLD_MS):
+        self.interval = interval_ms / 1000
+        self.threshold = threshold_ms / 1000
+        self.offenders = {}
+        self.max_lag = 0.0
+        self._task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._loop_thread = None
+        self._heartbeat = 0.0
+        self._captured = None
+
+    @property
+    def running(self):
+        return self._task is not None
+
+    async def start(self):
+        if self._task is not None or not LOOP_MONITOR:
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._stopped.clear()
+        self._task = asyncio.create_task(self._measure())
+        self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._watchdog.start()
+        logger.info(f"Event loop monitor started: interval={self.interval * 1000:.0f}ms, "
+                    f"threshold={self.threshold * 1000:.0f}ms")
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stopped.set()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        await asyncio.to_thread(self._watchdog.join)
+        self._watchdog = None
+
+    async def _measure(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            loop_lag.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+            with self._lock:
+                captured, self._captured = self._captured, None
+            if lag >= self.threshold:
+                # Остановка короче шага сторожевого потока может пройти без снятого стека
+                site, stack = captured or ("unknown", "")
+                self._record(site, lag, stack)
+
+    def _watch(self):
+        step = min(self.interval, self.threshold) / 2
+        while not self._stopped.wait(step):
+            # Стек снимается, пока остановка еще длится: к половине порога
+            if time.monotonic() - self._heartbeat < self.interval + self.threshold / 2:
+                continue
+            with self._lock:
+                if self._captured is not None:
+                    continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+            captured = blocking_site(frame)
+            with self._lock:
+                self._captured = captured
+
+    def _record(self, site, lag, stack):
+        loop_blocks.inc(site=site)
+        with self._lock:
+            offender = self.offenders.get(site)
+            if offender is None:
+                offender = self.offenders[site] = Offender(site)
+            offender.count += 1
+            offender.total += lag
+            if lag >= offender.worst:
+                offender.worst = lag
+                offender.stack = stack
+        logger.warning(f"Event loop blocked for {lag * 1000:.0f}ms in {site}"
+                       + (f"\n{stack.rstrip()}" if stack else ""))
+
+    def worst(self, limit=10):
+        with self._lock:
+            offenders = sorted(self.offenders.values(), key=lambda item: item.total, reverse=True)
+        return offenders[:limit]
+
+    def summary(self, limit=10, with_stack=1):
+        """
+        Строки для команды /lag: места блокировки по суммарному времени, для первых with_stack —
+        стек самой долгой остановки.
+        """
+        lines = []
+        for number, offender in enumerate(self.worst(limit)):
+            lines.append(f"{offender.site}: остановок {offender.count}, всего {offender.total * 1000:.0f} мс, "
+                         f"максимум {offender.worst * 1000:.0f} мс")
+            if number < with_stack and offender.stack:
+                lines.append(offender.stack.rstrip())
+        return lines
+
+
+monitor = LoopMonitor()
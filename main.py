@@ -2,23 +2,68 @@ import os
 from aiogram import Bot, Dispatcher
 from handlers.start import router as start_router
 from handlers.admin import router as admin_router
+from handlers.knowledge import router as knowledge_router
 from database import init_db
+from middlewares import DbSessionMiddleware, IdentityMiddleware, MetricsMiddleware, HandlerNameMiddleware
+import broadcast
+import ingestion
+import ai_client
+import fsm_storage
+import metrics
+import loop_monitor
+import webhook
 from dotenv import load_dotenv
 import asyncio
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# polling | webhook (see webhook.py for WEBHOOK_* settings)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
 
 
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher()
+def create_dispatcher(storage=None, primary_worker=True):
+    """
+    Dispatcher with middlewares, routers and startup/shutdown hooks. primary_worker is passed to
+    the hooks through workflow data: with several webhook workers only the first one runs the
+    broadcast outbox and resumes interrupted knowledge base ingestion.
+    """
+    # In-progress flows (group wizards, payment steps, knowledge filters) survive restarts
+    dp = Dispatcher(storage=storage or fsm_storage.create_storage(), primary_worker=primary_worker)
+    # Outer middleware: runs after aiogram's built-in ones (errors, user context, FSM context)
+    # and wraps our middlewares, filters and handlers
+    dp.update.outer_middleware(MetricsMiddleware())
+    dp.update.middleware(DbSessionMiddleware())
+    dp.update.middleware(IdentityMiddleware())
+    # Inner middlewares of the dispatcher's observers also apply to the included routers
+    for observer in (dp.message, dp.callback_query, dp.inline_query):
+        observer.middleware(HandlerNameMiddleware())
     dp.include_router(start_router)
     dp.include_router(admin_router)
+    dp.include_router(knowledge_router)
+    dp.startup.register(loop_monitor.monitor.start)
+    dp.startup.register(ai_client.client.start)
+    dp.startup.register(broadcast.sender.start)
+    dp.startup.register(ingestion.pipeline.start)
+    dp.shutdown.register(ai_client.client.stop)
+    dp.shutdown.register(broadcast.sender.stop)
+    dp.shutdown.register(ingestion.pipeline.stop)
+    dp.shutdown.register(loop_monitor.monitor.stop)
+    return dp
+
+
+async def main():
     init_db()
+    if BOT_MODE == "webhook":
+        await webhook.serve(create_dispatcher)
+        return
+    bot = Bot(token=BOT_TOKEN)
+    dp = create_dispatcher()
+    metrics_server = await metrics.start_server()
     try:
         await dp.start_polling(bot, skip_updates=True)
     finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
         await bot.session.close()
 
 
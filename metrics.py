@@ -0,0 +1,265 @@
+import os
+import re
+import time
+import bisect
+import logging
+import threading
+import contextvars
+from dotenv import load_dotenv
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+# 0 отключает HTTP-эндпоинт /metrics (статистика остается доступна командой /stats)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels):
+        return self._values.get(tuple(labels.get(name, "") for name in self.labelnames), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_labels(self.labelnames, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """
+    Гистограмма с фиксированными корзинами в формате Prometheus (накопительные счетчики le).
+    """
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # key -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def keys(self):
+        with self._lock:
+            return list(self._series)
+
+    def stats(self, key):
+        """
+        (количество, среднее, оценка p95 по верхней границе корзины) для набора меток key.
+        """
+        with self._lock:
+            counts, total, count = self._series[key]
+            counts = list(counts)
+        if not count:
+            return 0, 0.0, 0.0
+        threshold, cumulative = 0.95 * count, 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            if cumulative >= threshold:
+                break
+        return count, total / count, bound
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = sorted((key, list(counts), total, count) for key, (counts, total, count) in self._series.items())
+        for key, counts, total, count in series:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, *args, **kwargs):
+        metric = Counter(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs):
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+handler_latency = registry.histogram("bot_handler_latency_seconds", "Update handling time by handler",
+                                     ("handler",))
+callback_latency = registry.histogram("bot_callback_latency_seconds", "Callback query handling time by data prefix",
+                                      ("prefix",))
+handler_errors = registry.counter("bot_handler_errors_total", "Unhandled exceptions by handler", ("handler",))
+db_queries = registry.histogram("bot_db_queries_per_update", "SQL statements per update by handler",
+                                ("handler",), buckets=COUNT_BUCKETS)
+db_time = registry.histogram("bot_db_time_seconds", "Time spent in SQL per update by handler", ("handler",))
+ai_queue_wait = registry.histogram("ai_queue_wait_seconds", "Time an AI request waited for the model")
+ai_tokens_per_second = registry.histogram("ai_tokens_per_second", "Generation speed per AI request",
+                                          buckets=RATE_BUCKETS)
+ai_tokens = registry.counter("ai_generated_tokens_total", "Tokens generated by the model")
+
+
+class UpdateMetrics:
+    """
+    Данные одного апдейта, которые собираются по ходу обработки.
+    """
+
+    def __init__(self):
+        self.handler = "unhandled"
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Текущий апдейт: контекст asyncio-задачи виден и в гринлетах SQLAlchemy, и в asyncio.to_thread
+current = contextvars.ContextVar("update_metrics", default=None)
+
+
+def callback_prefix(data):
+    """
+    Префикс callback_data без идентификаторов: edit_group_12 -> edit_group, kbp_v_1700000000_5 -> kbp_v.
+    """
+    parts = []
+    for part in (data or "").split("_"):
+        if re.search(r"\d", part):
+            break
+        parts.append(part)
+    return "_".join(parts) or "other"
+
+
+def record_update(metrics, seconds, error=False, prefix=None):
+    handler_latency.observe(seconds, handler=metrics.handler)
+    if prefix is not None:
+        callback_latency.observe(seconds, prefix=prefix)
+    if error:
+        handler_errors.inc(handler=metrics.handler)
+    db_queries.observe(metrics.queries, handler=metrics.handler)
+    db_time.observe(metrics.db_seconds, handler=metrics.handler)
+
+
+def record_generation(queue_wait, seconds, tokens):
+    ai_queue_wait.observe(queue_wait)
+    ai_tokens.inc(tokens)
+    if seconds > 0 and tokens:
+        ai_tokens_per_second.observe(tokens / seconds)
+
+
+# События движка, а не ORM: так учитываются и запросы flush (INSERT/UPDATE/DELETE) при commit().
+# Engine как цель — слушатели действуют для всех движков, в том числе синхронного в фоновых потоках
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    if context is not None and current.get() is not None:
+        context._metrics_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    metrics = current.get()
+    started = getattr(context, "_metrics_started", None)
+    if metrics is None or started is None:
+        return
+    metrics.queries += 1
+    metrics.db_seconds += time.perf_counter() - started
+
+
+@event.listens_for(Engine, "commit")
+def _count_commit(conn):
+    # COMMIT выполняется в обход курсора: учитывается в числе запросов, но не во времени
+    metrics = current.get()
+    if metrics is not None:
+        metrics.queries += 1
+
+
+def summary(limit=15):
+    """
+    Строки для команды /stats: самые медленные обработчики по p95 и показатели ИИ.
+    """
+    rows = []
+    for key in handler_latency.keys():
+        count, mean, p95 = handler_latency.stats(key)
+        rows.append((p95, mean, count, key[0]))
+    rows.sort(reverse=True)
+    lines = []
+    for p95, mean, count, handler in rows[:limit]:
+        errors = handler_errors.get(handler=handler)
+        _, queries, _ = db_queries.stats((handler,))
+        _, db_seconds, _ = db_time.stats((handler,))
+        lines.append(f"{handler}: p95 ≤{p95:g} с, среднее {mean:.3f} с, вызовов {count}, ошибок {errors}, "
+                     f"SQL {queries:.1f} запр./{db_seconds * 1000:.0f} мс")
+    if ai_queue_wait.keys():
+        count, wait, wait_p95 = ai_queue_wait.stats(())
+        speed = ai_tokens_per_second.stats(())[1] if ai_tokens_per_second.keys() else 0.0
+        lines.append(f"ИИ: запросов {count}, ожидание в очереди среднее {wait:.2f} с (p95 ≤{wait_p95:g} с), "
+                     f"скорость {speed:.1f} ток/с")
+    return lines
+
+
+async def start_server(port=METRICS_PORT, host=METRICS_HOST):
+    """
+    Поднимает HTTP-эндпоинт /metrics в формате Prometheus. Возвращает AppRunner или None.
+    """
+    if not port:
+        return None
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics available at http://{host}:{port}/metrics")
+    return runner
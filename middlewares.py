@@ -0,0 +1,66 @@
+import time
+from aiogram import BaseMiddleware
+from database import AsyncSessionLocal
+import identity
+import metrics
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """
+    Открывает асинхронную сессию БД на время обработки апдейта и передает ее обработчикам как `session`.
+    """
+
+    async def __call__(self, handler, event, data):
+        async with AsyncSessionLocal() as session:
+            data["session"] = session
+            return await handler(event, data)
+
+
+class IdentityMiddleware(BaseMiddleware):
+    """
+    Определяет роль пользователя по кэшу identity.cache и передает обработчикам `identity`
+    (роль, Trainer.id / Student.id) без запроса к БД.
+    """
+
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user is not None:
+            data["identity"] = await identity.cache.resolve(user.id)
+        return await handler(event, data)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware апдейтов (outer_middleware): время обработки, ошибки и число/время SQL-запросов
+    по обработчикам и префиксам callback_data. Выполняется после встроенных внешних middleware aiogram
+    (контекст пользователя и FSM) и учитывает работу наших middleware, фильтров и обработчиков.
+    """
+
+    async def __call__(self, handler, event, data):
+        record = metrics.UpdateMetrics()
+        token = metrics.current.set(record)
+        prefix = metrics.callback_prefix(event.callback_query.data) if event.callback_query else None
+        started = time.perf_counter()
+        error = False
+        try:
+            return await handler(event, data)
+        except Exception:
+            error = True
+            raise
+        finally:
+            metrics.current.reset(token)
+            metrics.record_update(record, time.perf_counter() - started, error, prefix)
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware событий: к этому моменту обработчик уже выбран фильтрами,
+    его имя становится меткой метрик апдейта.
+    """
+
+    async def __call__(self, handler, event, data):
+        record = metrics.current.get()
+        handler_object = data.get("handler")
+        if record is not None and handler_object is not None:
+            record.handler = getattr(handler_object.callback, "__name__", "handler")
+        return await handler(event, data)
@@ -0,0 +1,81 @@
+import logging
+import datetime
+from sqlalchemy import text
+from database import engine, Base, add_missing_columns
+import models
+import knowledge_search
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_DDL = """
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        name VARCHAR NOT NULL,
+        applied_at DATETIME NOT NULL
+    )
+"""
+
+
+def create_indexes(*indexes):
+    def step(connection):
+        for index in indexes:
+            index.create(connection, checkfirst=True)
+    return step
+
+
+def baseline(connection):
+    """
+    Таблицы из models.py и колонки, добавленные в модели до появления миграций.
+    """
+    Base.metadata.create_all(connection, checkfirst=True)
+    add_missing_columns(connection)
+
+
+def table_indexes(model, *names):
+    indexes = {index.name: index for index in model.__table__.indexes}
+    missing = set(names) - set(indexes)
+    if missing:
+        raise ValueError(f"{model.__tablename__} has no indexes {sorted(missing)}")
+    return [indexes[name] for name in names]
+
+
+# Миграции применяются по порядку и только один раз; номер последней хранится в schema_version.
+# Шаги должны быть идемпотентными: базы, созданные до миграций, проходят их все.
+MIGRATIONS = [
+    (1, "baseline schema", baseline),
+    (2, "knowledge base browsing and deduplication indexes", create_indexes(
+        *table_indexes(models.KnowledgeBase, "ix_knowledge_base_created_at_id",
+                       "ix_knowledge_base_category_created_at", "ix_knowledge_base_content_hash"))),
+    (3, "knowledge base full-text search", knowledge_search.create_index),
+    (4, "hot query path indexes", create_indexes(
+        *table_indexes(models.Progress, "ix_progress_student_type_date"),
+        *table_indexes(models.Group, "ix_groups_trainer_id"),
+        *table_indexes(models.GroupStudent, "ix_group_students_student_id"),
+        *table_indexes(models.Schedule, "ix_schedules_group_id"),
+        *table_indexes(models.PaymentRequest, "ix_payment_requests_student_status"),
+        *table_indexes(models.BroadcastDelivery, "ix_broadcast_outbox_status_next_attempt",
+                       "ix_broadcast_outbox_broadcast_status"))),
+]
+
+
+def current_version(connection):
+    connection.execute(text(SCHEMA_VERSION_DDL))
+    return connection.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+
+
+def migrate(target=None):
+    """
+    Применяет недостающие миграции, каждую в своей транзакции. Возвращает итоговую версию схемы.
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+    for number, name, step in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        with engine.begin() as connection:
+            step(connection)
+            connection.execute(text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+                               {"v": number, "n": name, "t": datetime.datetime.now()})
+        logger.info(f"Applied migration {number}: {name}")
+        version = number
+    return version
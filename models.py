@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, LargeBinary, Index
 from sqlalchemy.orm import relationship
 from database import Base
 from aiogram.fsm.state import State, StatesGroup
@@ -13,6 +13,8 @@ class Student(Base):
     name = Column(String, nullable=True)
     remaining_sessions = Column(Integer, default=0)
     payment_requests = relationship("PaymentRequest", back_populates="student")
+    # Только для чтения: состав групп меняется через Group.students
+    groups = relationship("Group", secondary="group_students", viewonly=True)
 
 
 class Trainer(Base):
@@ -27,7 +29,7 @@ class Group(Base):
     __tablename__ = 'groups'
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
-    trainer_id = Column(Integer, ForeignKey('trainers.id'))
+    trainer_id = Column(Integer, ForeignKey('trainers.id'), index=True)
     schedule = Column(String, nullable=True)
     program_file = Column(String, nullable=True)
     trainer = relationship("Trainer")
@@ -38,12 +40,14 @@ class GroupStudent(Base):
     __tablename__ = 'group_students'
     group_id = Column(Integer, ForeignKey('groups.id'), primary_key=True)
     student_id = Column(Integer, ForeignKey('students.id'), primary_key=True)
+    # Первичный ключ (group_id, student_id) покрывает поиск по группе; для групп ученика нужен отдельный индекс
+    __table_args__ = (Index('ix_group_students_student_id', 'student_id'),)
 
 
 class Schedule(Base):
     __tablename__ = 'schedules'
     id = Column(Integer, primary_key=True)
-    group_id = Column(Integer, ForeignKey('groups.id'))
+    group_id = Column(Integer, ForeignKey('groups.id'), index=True)
     content = Column(String, nullable=False)
     group = relationship("Group")
 
@@ -58,6 +62,7 @@ class PaymentRequest(Base):
     created_at = Column(DateTime, default=datetime.datetime.now)
     updated_at = Column(DateTime, default=datetime.datetime.now)
     student = relationship("Student", back_populates="payment_requests")
+    __table_args__ = (Index('ix_payment_requests_student_status', 'student_id', 'status'),)
 
 
 class Progress(Base):
@@ -69,6 +74,8 @@ class Progress(Base):
     file_path = Column(String, nullable=True)
     date = Column(DateTime, default=datetime.datetime.now)
     student = relationship("Student")
+    # Последние записи ученика по типу: WHERE student_id, type ORDER BY date DESC
+    __table_args__ = (Index('ix_progress_student_type_date', 'student_id', 'type', 'date'),)
 
 
 class KnowledgeBase(Base):
@@ -78,7 +85,70 @@ class KnowledgeBase(Base):
     content = Column(String, nullable=True)
     file_path = Column(String, nullable=True)
     text_content = Column(String, nullable=True)  # Added to store extracted text
+    title = Column(String, nullable=True)
+    category = Column(String, nullable=True)  # первый хэштег из текста или подписи материала
+    status = Column(String, default='ready')  # processing, пока файл обрабатывается в фоне; ready / failed
+    content_hash = Column(String, nullable=True, index=True)  # sha256 файла или текста, для поиска дубликатов
+    uploaded_by = Column(String, nullable=True)  # telegram_id тренера, которому сообщить об обработке
     created_at = Column(DateTime, default=datetime.datetime.now)
+    # Ключ постраничного просмотра: (created_at, id) по убыванию
+    __table_args__ = (
+        Index('ix_knowledge_base_created_at_id', 'created_at', 'id'),
+        Index('ix_knowledge_base_category_created_at', 'category', 'created_at'),
+    )
+
+
+class AIResponseCache(Base):
+    __tablename__ = 'ai_response_cache'
+    key = Column(String, primary_key=True)  # sha256 от нормализованного запроса и отпечатка контекста
+    query = Column(String, nullable=False)
+    context_hash = Column(String, nullable=False, index=True)
+    response = Column(String, nullable=False)
+    embedding = Column(LargeBinary, nullable=True)  # для поиска похожих запросов
+    hits = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    last_used_at = Column(DateTime, default=datetime.datetime.now)
+
+
+class TelegramFile(Base):
+    __tablename__ = 'telegram_files'
+    file_path = Column(String, primary_key=True)  # локальный файл материала или программы
+    file_id = Column(String, nullable=False)
+    file_size = Column(Integer, nullable=True)  # размер файла на диске, для которого получен file_id
+    updated_at = Column(DateTime, default=datetime.datetime.now)
+
+
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+    id = Column(Integer, primary_key=True)
+    group_id = Column(Integer, ForeignKey('groups.id', ondelete='SET NULL'), nullable=True)
+    trainer_chat_id = Column(String, nullable=False)  # куда отправлять отчет о доставке
+    progress_message_id = Column(Integer, nullable=True)
+    text = Column(String, nullable=True)
+    file_id = Column(String, nullable=True)  # документ, уже загруженный в Telegram
+    status = Column(String, default='pending')  # pending / done
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class BroadcastDelivery(Base):
+    __tablename__ = 'broadcast_outbox'
+    id = Column(Integer, primary_key=True)
+    broadcast_id = Column(Integer, ForeignKey('broadcasts.id'), nullable=False)
+    chat_id = Column(String, nullable=False)
+    status = Column(String, default='pending')  # pending / sent / failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.datetime.now)
+    error = Column(String, nullable=True)
+    sent_at = Column(DateTime, nullable=True)
+    broadcast = relationship("Broadcast")
+    __table_args__ = (
+        Index('ix_broadcast_outbox_status_next_attempt', 'status', 'next_attempt_at'),
+        Index('ix_broadcast_outbox_broadcast_status', 'broadcast_id', 'status'),
+    )
 
 
 class GroupCreation(StatesGroup):
@@ -0,0 +1,152 @@
+import os
+import re
+import hashlib
+import logging
+import datetime
+from dotenv import load_dotenv
+from database import Session
+from models import AIResponseCache
+import knowledge_index
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+AI_CACHE_ENABLED = os.getenv("AI_CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", str(24 * 60 * 60)))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "5000"))
+# Поиск похожих запросов по эмбеддингам (нужны faiss и sentence-transformers)
+AI_CACHE_SEMANTIC = os.getenv("AI_CACHE_SEMANTIC", "0").lower() in ("1", "true", "yes")
+AI_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("AI_CACHE_SEMANTIC_THRESHOLD", "0.92"))
+
+
+def normalize_query(query):
+    """
+    Приводит запрос к каноническому виду: нижний регистр, без пунктуации и лишних пробелов.
+    """
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+def context_fingerprint(*parts):
+    """
+    Хэш контекста, который реально попал в промпт (тренировки, питание, база знаний).
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """
+    Кэш ответов ИИ в SQLite с TTL и ограничением размера. Ключ — нормализованный запрос
+    и отпечаток контекста; при AI_CACHE_SEMANTIC=1 промах по ключу дополнительно ищет
+    похожий запрос с тем же контекстом по косинусной близости эмбеддингов.
+    """
+
+    def __init__(self, ttl=AI_CACHE_TTL, max_entries=AI_CACHE_MAX_ENTRIES, semantic=AI_CACHE_SEMANTIC,
+                 semantic_threshold=AI_CACHE_SEMANTIC_THRESHOLD):
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.max_entries = max_entries
+        self.semantic = semantic and knowledge_index.KnowledgeIndex.available()
+        self.semantic_threshold = semantic_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(query, context_hash):
+        return hashlib.sha256(f"{normalize_query(query)}\0{context_hash}".encode("utf-8")).hexdigest()
+
+    def _embed(self, query):
+        return knowledge_index.index.embed([normalize_query(query)])[0]
+
+    def _find_similar(self, session, query, context_hash, oldest):
+        import numpy as np
+        candidates = (
+            session.query(AIResponseCache)
+            .filter(AIResponseCache.context_hash == context_hash,
+                    AIResponseCache.created_at >= oldest,
+                    AIResponseCache.embedding.isnot(None))
+            .all()
+        )
+        if not candidates:
+            return None
+        vector = self._embed(query)
+        best, best_score = None, self.semantic_threshold
+        for entry in candidates:
+            score = float(np.dot(vector, np.frombuffer(entry.embedding, dtype="float32")))
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def get(self, query, context_hash):
+        """
+        Возвращает сохраненный ответ или None. Блокирующий вызов, выполняется в потоке.
+        """
+        session = Session()
+        try:
+            now = datetime.datetime.now()
+            oldest = now - self.ttl
+            entry = session.query(AIResponseCache).filter_by(key=self.make_key(query, context_hash)).first()
+            if entry is not None and entry.created_at < oldest:
+                entry = None
+            if entry is None and self.semantic:
+                entry = self._find_similar(session, query, context_hash, oldest)
+                if entry is not None:
+                    self.semantic_hits += 1
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            logger.info(f"AI response cache hit: hits={self.hits}, misses={self.misses}")
+            entry.hits = (entry.hits or 0) + 1
+            entry.last_used_at = now
+            session.commit()
+            return entry.response
+        finally:
+            session.close()
+
+    def put(self, query, context_hash, response):
+        session = Session()
+        try:
+            now = datetime.datetime.now()
+            entry = session.get(AIResponseCache, self.make_key(query, context_hash))
+            if entry is None:
+                entry = AIResponseCache(key=self.make_key(query, context_hash), query=normalize_query(query),
+                                        context_hash=context_hash, hits=0)
+                session.add(entry)
+            entry.response = response
+            entry.created_at = now
+            entry.last_used_at = now
+            if self.semantic:
+                entry.embedding = self._embed(query).tobytes()
+            session.commit()
+            self._evict(session, now)
+        finally:
+            session.close()
+
+    def _evict(self, session, now):
+        session.query(AIResponseCache).filter(AIResponseCache.created_at < now - self.ttl).delete()
+        overflow = session.query(AIResponseCache).count() - self.max_entries
+        if overflow > 0:
+            stale_keys = [
+                key for (key,) in session.query(AIResponseCache.key)
+                .order_by(AIResponseCache.last_used_at).limit(overflow)
+            ]
+            session.query(AIResponseCache).filter(AIResponseCache.key.in_(stale_keys)).delete(
+                synchronize_session=False)
+        session.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+cache = ResponseCache()
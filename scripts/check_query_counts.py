@@ -0,0 +1,101 @@
+"""
+Проверка числа SQL-запросов в представлениях тренера: профили учеников и список групп
+должны выполняться за постоянное число запросов, независимо от количества учеников и групп.
+Данные создаются во временной SQLite-базе:
+
+    python scripts/check_query_counts.py
+
+Завершается с кодом 1, если число запросов растет вместе с данными или превышает допустимое.
+"""
+import os
+import sys
+import asyncio
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Допустимое число запросов на одно представление
+EXPECTED = {
+    "student profiles": 2,
+    "trainer groups": 1,
+}
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+async def seed(prefix, students, groups):
+    """
+    Тренер со своими учениками и группами. prefix делает telegram_id уникальными между вызовами.
+    """
+    from database import AsyncSessionLocal
+    from models import Student, Trainer, Group
+    async with AsyncSessionLocal() as session:
+        trainer = Trainer(telegram_id=f"{prefix}-trainer", username=f"{prefix}_trainer")
+        session.add(trainer)
+        members = [Student(telegram_id=f"{prefix}-student{i}", username=f"{prefix}_student{i}",
+                           name=f"Student {i}")
+                   for i in range(students)]
+        session.add_all(members)
+        await session.flush()
+        for number in range(groups):
+            session.add(Group(name=f"Group {number}", trainer_id=trainer.id,
+                              students=members[number::groups]))
+        await session.commit()
+        return trainer.id
+
+
+async def measure(counter, trainer_id):
+    from database import AsyncSessionLocal
+    from handlers.admin import get_student_profiles, get_trainer_groups
+    counts = {}
+    async with AsyncSessionLocal() as session:
+        counter.count = 0
+        profiles = await get_student_profiles(session)
+        # Группы уже загружены: обращение к ним не должно выполнять запросы
+        sum(len(student.groups) for student in profiles)
+        counts["student profiles"] = counter.count
+        counter.count = 0
+        await get_trainer_groups(session, trainer_id)
+        counts["trainer groups"] = counter.count
+    return counts, len(profiles)
+
+
+async def run():
+    import migrations
+    from database import async_engine
+    migrations.migrate()
+    counter = QueryCounter(async_engine)
+    trainer_id = await seed("small", students=30, groups=3)
+    small, small_students = await measure(counter, trainer_id)
+    # Профили загружаются по всем ученикам базы, поэтому во втором замере их 30 + 300
+    trainer_id = await seed("large", students=300, groups=20)
+    large, large_students = await measure(counter, trainer_id)
+    await async_engine.dispose()
+    failures = 0
+    for name, limit in EXPECTED.items():
+        ok = small[name] == large[name] <= limit
+        print(f"{'ok' if ok else 'FAIL':5} {name}: {small[name]} queries for {small_students} students, "
+              f"{large[name]} for {large_students} (limit {limit})")
+        failures += not ok
+    return failures
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = f"sqlite:///{os.path.join(tmp, 'counts.db')}"
+        os.environ.pop("ASYNC_DB_PATH", None)
+        sys.path.insert(0, ROOT)
+        failures = asyncio.run(run())
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
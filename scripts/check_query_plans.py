@@ -0,0 +1,84 @@
+"""
+Проверка планов запросов на горячих путях обработчиков: каждый запрос должен идти по индексу,
+а не полным просмотром таблицы. Схема создается миграциями во временной SQLite-базе:
+
+    python scripts/check_query_plans.py
+
+Завершается с кодом 1, если хотя бы один запрос выполняет SCAN таблицы без индекса.
+"""
+import os
+import re
+import sys
+import datetime
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# SQLite: "SCAN progress" (или "SCAN TABLE progress" в старых версиях) — полный просмотр;
+# "SCAN progress USING INDEX ..." и "SEARCH ..." — доступ по индексу
+FULL_SCAN = re.compile(r"^SCAN (TABLE )?(\w+)$")
+
+
+def hot_queries():
+    from sqlalchemy import select, func, or_, and_
+    from models import (Student, Group, GroupStudent, Schedule, PaymentRequest, Progress, KnowledgeBase,
+                        BroadcastDelivery, AIResponseCache)
+    now = datetime.datetime.now()
+    return {
+        "student by telegram_id": select(Student).filter_by(telegram_id="1"),
+        "latest progress entry": select(Progress).filter_by(student_id=1, type='training')
+        .order_by(Progress.date.desc()).limit(1),
+        "history export by period": select(Progress.id, Progress.date, Progress.content, Progress.file_path)
+        .filter(Progress.student_id == 1, Progress.type == 'photo', Progress.date >= now)
+        .order_by(Progress.date),
+        "trainer groups": select(Group).filter_by(trainer_id=1),
+        "student groups": select(Group).join(GroupStudent).filter(GroupStudent.student_id == 1),
+        "group students": select(GroupStudent.student_id).filter_by(group_id=1),
+        "group schedule": select(Schedule).filter_by(group_id=1),
+        "pending payment request": select(PaymentRequest).filter_by(student_id=1, status='pending'),
+        "knowledge base page": select(KnowledgeBase)
+        .filter(or_(KnowledgeBase.created_at < now, and_(KnowledgeBase.created_at == now, KnowledgeBase.id < 10)))
+        .order_by(KnowledgeBase.created_at.desc(), KnowledgeBase.id.desc()).limit(9),
+        "knowledge base category page": select(KnowledgeBase).filter(KnowledgeBase.category == "питание")
+        .order_by(KnowledgeBase.created_at.desc(), KnowledgeBase.id.desc()).limit(9),
+        "knowledge duplicate by hash": select(KnowledgeBase).filter_by(content_hash="0" * 64),
+        "due broadcast deliveries": select(BroadcastDelivery)
+        .filter(BroadcastDelivery.status == 'pending', BroadcastDelivery.next_attempt_at <= now)
+        .order_by(BroadcastDelivery.id).limit(50),
+        "broadcast progress counts": select(BroadcastDelivery.broadcast_id, BroadcastDelivery.status, func.count())
+        .filter(BroadcastDelivery.broadcast_id.in_([1, 2]))
+        .group_by(BroadcastDelivery.broadcast_id, BroadcastDelivery.status),
+        "ai response cache candidates": select(AIResponseCache).filter(AIResponseCache.context_hash == "0" * 64),
+    }
+
+
+def explain(connection, statement):
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    return [row[-1] for row in connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").all()]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["DB_PATH"] = f"sqlite:///{os.path.join(tmp, 'plans.db')}"
+        os.environ.pop("ASYNC_DB_PATH", None)
+        sys.path.insert(0, ROOT)
+        import migrations
+        from database import engine
+        migrations.migrate()
+        failures = 0
+        with engine.connect() as connection:
+            for name, statement in hot_queries().items():
+                plan = explain(connection, statement)
+                scans = [step for step in plan if FULL_SCAN.match(step)]
+                status = "FULL SCAN" if scans else "ok"
+                print(f"{status:9} {name}: {'; '.join(plan)}")
+                failures += bool(scans)
+        engine.dispose()
+    if failures:
+        print(f"\n{failures} hot queries fall back to a full table scan")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
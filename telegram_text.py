@@ -0,0 +1,37 @@
+# Максимальная длина текста одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def chunk_lines(lines, header="", separator="\n", limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Собирает строки в сообщения не длиннее limit, не разрывая строки между сообщениями.
+    Заголовок добавляется только к первому сообщению; строка длиннее limit обрезается.
+    """
+    chunks, current = [], header
+    for line in lines:
+        line = line[:limit]
+        candidate = f"{current}{separator}{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            current = line
+        else:
+            current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def truncate_lines(lines, header="", separator="\n", limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Текст для одного сообщения (например, edit_text): строки, которые не поместились,
+    заменяются припиской с их количеством.
+    """
+    lines = list(lines)
+    # Запас под приписку о скрытых строках
+    text, budget = header, limit - 32
+    for shown, line in enumerate(lines):
+        candidate = f"{text}{separator}{line}" if text else line
+        if len(candidate) > budget:
+            return f"{text}{separator}… и еще {len(lines) - shown}"
+        text = candidate
+    return text
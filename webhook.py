@@ -0,0 +1,225 @@
+import os
+import hmac
+import queue
+import asyncio
+import logging
+import secrets
+import multiprocessing
+from aiohttp import web
+from aiogram import Bot
+from aiogram.fsm.storage.memory import MemoryStorage
+from dotenv import load_dotenv
+import metrics
+
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Публичный https-адрес, на который Telegram будет присылать апдейты, например https://bot.example.com
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Без заданного секрета при каждом запуске генерируется новый: вебхук все равно переустанавливается
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "1"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+# Сколько чатов обрабатывается одновременно внутри одного процесса
+WEBHOOK_LANES = int(os.getenv("WEBHOOK_LANES", "16"))
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def route_key(update):
+    """
+    Чат, к которому относится апдейт (для inline-запросов — пользователь). Апдейты одного чата
+    всегда попадают в один процесс и одну очередь, поэтому шаги FSM выполняются по порядку.
+    """
+    for payload in update.values():
+        if not isinstance(payload, dict):
+            continue
+        chat = payload.get("chat") or (payload.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+        user = payload.get("from") or payload.get("user")
+        if user and "id" in user:
+            return int(user["id"])
+    return int(update.get("update_id", 0))
+
+
+class UpdateLanes:
+    """
+    Ограниченная очередь апдейтов внутри процесса, разбитая на дорожки по чатам: разные чаты
+    обрабатываются параллельно, апдейты одного чата — строго последовательно.
+    """
+
+    def __init__(self, dp, bot, lanes=WEBHOOK_LANES, queue_size=WEBHOOK_QUEUE_SIZE):
+        self.dp = dp
+        self.bot = bot
+        self._queues = [asyncio.Queue(maxsize=max(1, queue_size // lanes)) for _ in range(lanes)]
+        self._tasks = [asyncio.create_task(self._run(q)) for q in self._queues]
+
+    def _lane(self, update):
+        return self._queues[route_key(update) % len(self._queues)]
+
+    def put_nowait(self, update):
+        """
+        False, если очередь дорожки заполнена: вызывающий отвечает Telegram ошибкой,
+        и тот повторит доставку позже, вместо того чтобы апдейт потерялся.
+        """
+        try:
+            self._lane(update).put_nowait(update)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def put(self, update):
+        await self._lane(update).put(update)
+
+    async def _run(self, lane):
+        while True:
+            update = await lane.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Update {update.get('update_id')} failed: {str(e)}")
+            finally:
+                lane.task_done()
+
+    async def close(self):
+        """
+        Дожидается обработки уже принятых апдейтов и останавливает дорожки.
+        """
+        for lane in self._queues:
+            await lane.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+def create_app(dispatch, secret=WEBHOOK_SECRET, path=WEBHOOK_PATH):
+    """
+    aiohttp-приложение, принимающее апдейты. dispatch(update) возвращает False при переполнении.
+    """
+
+    async def handle_update(request):
+        token = request.headers.get(SECRET_HEADER, "")
+        if not hmac.compare_digest(token, secret):
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        if not dispatch(update):
+            logger.warning(f"Update queue is full, update {update.get('update_id')} rejected for redelivery")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    return app
+
+
+def run_worker(index, updates, create_dispatcher):
+    """
+    Точка входа процесса-воркера: свой Bot и Dispatcher, апдейты приходят из updates
+    (multiprocessing.Queue), None — сигнал остановки.
+    """
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_worker(index, updates, create_dispatcher))
+
+
+async def _worker(index, updates, create_dispatcher):
+    bot = Bot(token=BOT_TOKEN)
+    # Фоновые задачи (outbox рассылок, возобновление обработки материалов) — только в первом воркере
+    dp = create_dispatcher(primary_worker=index == 0)
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    lanes = UpdateLanes(dp, bot)
+    # Метрики собираются в каждом воркере отдельно: /metrics воркера i слушает METRICS_PORT + i
+    metrics_server = await metrics.start_server(metrics.METRICS_PORT + index if metrics.METRICS_PORT else 0)
+    logger.info(f"Webhook worker {index} started (pid {os.getpid()})")
+    try:
+        while True:
+            update = await asyncio.to_thread(updates.get)
+            if update is None:
+                break
+            # Блокирующая постановка: пока дорожка занята, очередь процесса копится и переполняется
+            await lanes.put(update)
+        await lanes.close()
+    finally:
+        if metrics_server is not None:
+            await metrics_server.cleanup()
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+        await bot.session.close()
+
+
+async def _serve_app(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(f"Webhook server listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    return runner
+
+
+async def _set_webhook(bot, allowed_updates):
+    if not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL is required when BOT_MODE=webhook")
+    # drop_pending_updates=False: апдейты, пришедшие во время перезапуска, Telegram доставит после него
+    await bot.set_webhook(f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                          allowed_updates=allowed_updates, drop_pending_updates=False)
+
+
+async def serve(create_dispatcher, workers=WEBHOOK_WORKERS):
+    """
+    Запускает прием апдейтов через вебхук. При workers == 1 апдейты обрабатываются в этом же
+    процессе; иначе запускаются процессы-воркеры, и апдейт каждого чата уходит в свой воркер.
+    """
+    bot = Bot(token=BOT_TOKEN)
+    if workers <= 1:
+        dp = create_dispatcher()
+        await dp.emit_startup(bot=bot, **dp.workflow_data)
+        lanes = UpdateLanes(dp, bot)
+        runner = await _serve_app(create_app(lanes.put_nowait))
+        metrics_server = await metrics.start_server()
+        try:
+            await _set_webhook(bot, dp.resolve_used_update_types())
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            if metrics_server is not None:
+                await metrics_server.cleanup()
+            await lanes.close()
+            await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+            await bot.session.close()
+        return
+
+    # spawn: процессы не наследуют потоки и открытые соединения родителя. Не daemon: воркеры
+    # запускают свои дочерние процессы (пул обработки материалов), остановка — через None и join
+    context = multiprocessing.get_context("spawn")
+    queues = [context.Queue(maxsize=WEBHOOK_QUEUE_SIZE) for _ in range(workers)]
+    processes = [context.Process(target=run_worker, args=(index, queues[index], create_dispatcher),
+                                 name=f"webhook-worker-{index}", daemon=False)
+                 for index in range(workers)]
+    for process in processes:
+        process.start()
+
+    def dispatch(update):
+        try:
+            queues[route_key(update) % workers].put_nowait(update)
+        except queue.Full:
+            return False
+        return True
+
+    runner = await _serve_app(create_app(dispatch))
+    try:
+        # Dispatcher здесь нужен только для списка используемых типов апдейтов
+        allowed_updates = create_dispatcher(storage=MemoryStorage(), primary_worker=False).resolve_used_update_types()
+        await _set_webhook(bot, allowed_updates)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        for updates in queues:
+            updates.put(None)
+        for process in processes:
+            await asyncio.to_thread(process.join, 30)
+        await bot.session.close()